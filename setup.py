@@ -10,7 +10,7 @@ setup(
     description='Wetsuite',
     packages=['wetsuite.datasets', 'wetsuite.helpers', 'wetsuite.datacollect', 'wetsuite.extras'],
     package_dir={"": "src"},
-    python_requires=">=3",
+    python_requires=">=3.9",   # e.g. concurrent.futures shutdown(cancel_futures=)
     install_requires=[
         'lxml',                # BSD
         'requests',            # Apache2
@@ -33,6 +33,7 @@ setup(
         ],
         'ocr':'easyocr',         # Apache2
         'extras':['wordcloud',], # MIT
+        'seekable':['apsw',],    # zlib   (for datasets.load(..., seekable=True))
         # all?
     },
 )
@@ -1,13 +1,16 @@
 ''' Helps interact with the EUR-Lex website and APIs.
 '''
-import re, datetime, urllib.parse
+import os, io, datetime, warnings, collections, urllib.parse
+import concurrent.futures
 
-import requests
+import lxml.etree
+import lxml.html
 
-import bs4
+import wetsuite.helpers.net
+import wetsuite.helpers.util
 
 
-def fetch_by_resource_type(typ='JUDG'):
+def fetch_by_resource_type(typ='JUDG', **kwargs):
     ''' Intends to query the SPARQL endpoint to ask for most CELEXes of a specific type, 
         (defaulting to court judgments for no particular reason)
 
@@ -17,10 +20,15 @@ def fetch_by_resource_type(typ='JUDG'):
 
         Asks to give its semantic results as JSON data,  which we parse and return as a python structure.
 
+        This is now a wrapper around L{iter_by_resource_type} (which fetches in pages) that collects everything it gives
+        into the same structure that a single query would have given. 
+        For large types (e.g. JUDG, REG) you may prefer to use that directly.
+
 
         @param typ: the type to fetch, e.g. 
           - 'JUDG'  for court judgments
           - 'REG'   for regulations (but there are a handful of related things) 
+        @param kwargs: handed to L{iter_by_resource_type}, e.g. workers, cache_store
 
         @return: a (possibly-many-item'd) nested structure (python structure, loaded from JSON)
 
@@ -58,27 +66,219 @@ def fetch_by_resource_type(typ='JUDG'):
                 }
             }
     '''
+    return {
+        'head':    {'link': [], 'vars': list(_RESOURCE_TYPE_VARS)},
+        'results': {'distinct': False, 'ordered': False, 'bindings': list( iter_by_resource_type(typ, **kwargs) )},
+    }
+
+
+_RESOURCE_TYPE_VARS = ('work', 'type', 'celex', 'date', 'force')
+
+_SPARQL_MAX_ROWS = 10000
+' the endpoint returns at most this many rows per query, regardless of the LIMIT you ask for '
+
+_CELLAR_PREFIX = 'http://publications.europa.eu/resource/cellar/'
+
+
+def _work_ranges():
+    ''' (start, end) ranges of work URIs that together cover all of them (None meaning unbounded),
+        which iter_by_resource_type pages through independently, so that it can do several at the same time.
+        Work URIs are almost all cellar UUIDs, so this splits on the first hex digit of those.
+    '''
+    bounds = [None] + list( _CELLAR_PREFIX + c  for c in '123456789abcdef' ) + [None]
+    return list( zip( bounds[:-1], bounds[1:] ) )
+
+
+def _sparql_string(s):
+    ' s as a SPARQL string literal '
+    return '"%s"'%s.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def _resource_type_query_url(typ, limit, start=None, end=None):
+    ''' The SPARQL query URL for one page of L{iter_by_resource_type}: 
+        the first limit results, ordered by work URI, for works with start <= URI < end  (None meaning unbounded).
+
+        Paging by the work URI (rather than OFFSET) means each page is a cheap range query for the endpoint however deep we are,
+        and that changes to the data between pages cannot make us skip or repeat rows.
+    '''
     # The proper way would be to use a library like sparqlwrapper
     #   but for now we can get away with hardcodig a query like:
+    work_range = ''
+    if start is not None:
+        work_range += 'FILTER(STR(?work) >= %s) '%_sparql_string(start)
+    if end is not None:
+        work_range += 'FILTER(STR(?work) < %s) '%_sparql_string(end)
     query = '''PREFIX cdm: <http://publications.europa.eu/ontology/cdm#>
       select distinct ?work ?type ?celex ?date ?force 
       WHERE {
           ?work cdm:work_has_resource-type ?type. 
           FILTER(?type=<http://publications.europa.eu/resource/authority/resource-type/%s>)
+          %s
           FILTER not exists{?work cdm:work_has_resource-type <http://publications.europa.eu/resource/authority/resource-type/CORRIGENDUM>
       } 
       OPTIONAL { ?work cdm:resource_legal_id_celex ?celex. } 
       OPTIONAL { ?work cdm:work_date_document ?date. } 
       OPTIONAL { ?work cdm:resource_legal_in-force ?force. } 
-      FILTER not exists{?work cdm:do_not_index "true"^^<http://www.w3.org/2001/XMLSchema#boolean>}. }'''%typ
+      FILTER not exists{?work cdm:do_not_index "true"^^<http://www.w3.org/2001/XMLSchema#boolean>}. }
+      ORDER BY ?work
+      LIMIT %d'''%(typ, work_range, limit)
 
-    url = ''.join([
+    return ''.join([
         'http://publications.europa.eu/webapi/rdf/sparql?default-graph-uri=&query=',
         urllib.parse.quote(query),
         '&format=application%2Fsparql-results%2Bjson&timeout=0&debug=on&run=+Run+Query+'
     ])
-    resp = requests.get(url, timeout=30)
-    return resp.json()
+
+
+def _fetch_sparql_page(url, timeout):
+    ' Runs in a worker thread: fetches one page, returns (its data, its bindings) '
+    data = wetsuite.helpers.net.download( url, timeout=timeout )
+    return data, list( wetsuite.helpers.util.json_stream_items( io.BytesIO(data), ('results', 'bindings') ) )
+
+
+def iter_by_resource_type(typ='JUDG', page_size=5000, workers=4, cache_store=None, timeout=120, verbose=False):
+    ''' Like L{fetch_by_resource_type}, but yields the result bindings (see its docstring for what they look like) one at a time,
+        while fetching them in pages, several at a time, which is how large types actually finish.
+
+        We page by work URI (each query asks for what comes after the last work we saw), 
+        in a number of URI ranges (see _work_ranges) that are fetched at the same time.
+        Within a range, results come in work URI order, but pages from different ranges are interleaved,
+        so sort them if you care about order (or use workers=1).
+        All rows for a work are always given together.
+
+        @param typ: the resource type, see L{fetch_by_resource_type}
+        @param page_size: how many results to ask for per query. 
+        The endpoint has its own upper limit (_SPARQL_MAX_ROWS); we use that if you ask for more.
+        @param workers: how many pages (of different ranges) to fetch at the same time.
+        @param cache_store: if not None, a str:bytes LocalKV that full pages are kept in (keyed by query URL),
+        so that running this again (e.g. after an interruption) only fetches pages it has not got yet, 
+        plus the last one of each range, which may have grown.
+        Use a new store if you want to fetch everything again.
+        It is only used from the thread you iterate in.
+        @param timeout: per page fetch
+        @param verbose: print each page as it comes in
+        @raise ValueError: if a single work has more than page_size rows (use a larger page_size)
+    '''
+    if page_size > _SPARQL_MAX_ROWS: # otherwise a capped page would look like the last page
+        warnings.warn( 'page_size %d is more than the endpoint gives, using %d'%(page_size, _SPARQL_MAX_ROWS) )
+        page_size = _SPARQL_MAX_ROWS
+
+    pool = concurrent.futures.ThreadPoolExecutor( max_workers=workers )
+    try:
+        pending_ranges = collections.deque( _work_ranges() )
+        in_flight = {}  # future -> (url, end)
+
+        def submit(start, end):
+            url = _resource_type_query_url( typ, page_size, start, end )
+            data = None
+            if cache_store is not None:
+                data = cache_store.get( url, missing_as_none=True )
+            if data is None:
+                future = pool.submit( _fetch_sparql_page, url, timeout )
+            else: # so that cached and fetched pages are handled the same way below
+                future = concurrent.futures.Future()
+                future.set_result( (None, list( wetsuite.helpers.util.json_stream_items( io.BytesIO(data), ('results', 'bindings') ) )) )
+            in_flight[future] = (url, end)
+
+        while True:
+            while len(pending_ranges) > 0  and  len(in_flight) < workers:
+                submit( *pending_ranges.popleft() )
+            if len(in_flight) == 0:
+                break
+
+            done, _ = concurrent.futures.wait( in_flight, return_when=concurrent.futures.FIRST_COMPLETED )
+            for future in done:
+                url, end = in_flight.pop( future )
+                data, bindings = future.result()
+                if verbose:
+                    print( '%s: %d results up to %s'%(typ, len(bindings), bindings[-1]['work']['value'] if len(bindings) > 0 else '(end)') )
+
+                if len(bindings) < page_size: # the last page of this range
+                    yield from bindings
+                    continue
+
+                if data is not None  and  cache_store is not None: # only full pages; a partial one may still grow
+                    cache_store.put( url, data )
+                # The page may have cut off the rows of its last work, so leave that work for the next page, which starts at it.
+                last_work = bindings[-1]['work']['value']
+                complete = list( binding  for binding in bindings  if binding['work']['value'] != last_work )
+                if len(complete) == 0:
+                    raise ValueError( 'work %r has at least %d rows, use a larger page_size'%(last_work, page_size) )
+                yield from complete
+                submit( last_work, end )
+    finally:
+        pool.shutdown( wait=False, cancel_futures=True )
+
+
+def _text(node):
+    ' all text under a node, as a plain str (not the lxml smart string, which would drag the whole tree along when pickled) '
+    return str( node.text_content() )
+
+
+def _text_fragments(node):
+    ' the non-empty text fragments under a node, as plain strs (the fragments themselves are not stripped) '
+    return list( str(frag)  for frag in node.itertext()  if len(frag.strip())>0 )
+
+
+def _classes(node):
+    ' the class attribute as a list '
+    return (node.get('class') or '').split()
+
+
+# precompiled, because when you re-extract a large set of cached pages, XPath compilation is a noticeable part of the work
+_html_parser              = lxml.html.HTMLParser( encoding='utf-8' )
+_xpath_by_id              = lxml.etree.XPath( ".//*[@id=$id]" )   # (relative: _by_id on a section should only look inside it)
+_xpath_docid_meta         = lxml.etree.XPath( "//meta[@name='WT.z_docID']/@content" )
+_xpath_first_dl           = lxml.etree.XPath( "(.//dl)[1]" )
+_xpath_datalist_children  = lxml.etree.XPath( "dt|dd" )
+_xpath_has_list           = lxml.etree.XPath( "boolean(.//ul|.//ol)" )
+_xpath_list_items         = lxml.etree.XPath( ".//li" )
+_xpath_first_link         = lxml.etree.XPath( "(.//a)[1]" )
+_xpath_first_div          = lxml.etree.XPath( "(.//div)[1]" )
+_xpath_first_span         = lxml.etree.XPath( "(.//span)[1]" )
+_xpath_ecli_paragraph     = lxml.etree.XPath( ".//p[contains(., 'ECLI identifier')]" )
+_xpath_uls                = lxml.etree.XPath( ".//ul" )
+_xpath_div_paragraphs     = lxml.etree.XPath( ".//p[parent::div]" )
+
+
+def _by_id(root, idstr):
+    ' the first element with that id under root (not root itself), or None '
+    found = _xpath_by_id( root, id=idstr )
+    if len(found) == 0:
+        return None
+    return found[0]
+
+
+def _first(xpath, node):
+    ' the first result of a precompiled XPath, or None '
+    found = xpath( node )
+    if len(found) == 0:
+        return None
+    return found[0]
+
+
+def _parse_datalist(under_dl_node):
+    ''' pick out the basic parts of a data list:
+        generally we have a dt used as a label, and dd with a value.
+
+        However, the dd can contain a list instead of just a string
+        The structure is consistent only within each section,
+        so we leave it for code calling this function to process usefully:
+        in that case the value is a list of li elements, otherwise a string.
+    '''
+    ret = {}
+    if under_dl_node is None:
+        return ret
+    what = None
+    for node in _xpath_datalist_children( under_dl_node ):
+        if node.tag == 'dt':
+            what = _text(node).strip().strip(':')
+        else: # dd
+            if _xpath_has_list( node ):
+                ret[what] = _xpath_list_items( node )
+            else:
+                ret[what] = _text(node).strip()
+    return ret
 
 
 def extract_html(htmlbytes):
@@ -89,55 +289,41 @@ def extract_html(htmlbytes):
         Also, there are plenty of assumptions in this code that probably won't hold over time,
         so for serious projects you should probably use a data API instead.
 
+        This used to be written with BeautifulSoup, and was rewritten with lxml and precompiled XPath
+        because re-extracting many cached pages took a while. 
+        It should give the same output, except that text in HTML comments is no longer included in the text.
+        If you have a store full of pages, see also L{extract_html_store}.
+
         TODO: see how language-sensitive this is.
         CONSIDER: extract more link hrefs (would probably need to hand in page url to)
 
         @param htmlbytes: the page, as a bytes object
-        @return: a nested structure
+        @return: a nested structure (of only dicts, lists, tuples, and strs)
     '''
     # This code turned messier than it originally was,
     # because the page turned out to be more flexible
-
-    def parse_datalist(under_dl_node):
-        ' pick out the basic parts of a data list '
-        ret = {}
-        for node in under_dl_node.children:
-            # generally we have a dt used as a label, and dd with a value
-            if node.name == 'dt':
-                what = node.text.strip().strip(':')
-            elif node.name == 'dd':
-                # however, the dd can contain a list instead of just a string
-                #    the structure is consistent only within each section,
-                #    so leave it for code calling this function to process usefully
-                #    (forced to be - JSON would choke on it if you insert it as-is)
-                if node.find(['ul','ol']):
-                    ret[what] = node.findAll('li')
-                else:
-                    ret[what] = node.text.strip()
-        return ret
-
     ret = {}
-    soup = bs4.BeautifulSoup( htmlbytes, features='lxml' )
+    root = lxml.html.fromstring( htmlbytes, parser=_html_parser )
 
     # the CELEX appears on the page a lot but I'm not sure what the most stable source would be.
-    celex = soup.find('meta', attrs={'name':'WT.z_docID'}).get('content')
+    celex = str( _xpath_docid_meta( root )[0] )
     ret['celex'] = celex
 
     ret['titles']={}
-    PP1Contents = soup.find(id='PP1Contents')
+    PP1Contents = _by_id( root, 'PP1Contents' )
     if PP1Contents is not None:
-        ret['titles']['title'] = PP1Contents.find(id='title').text
-        ret['titles']['englishTitle'] = PP1Contents.find(id='englishTitle').text
-        ret['titles']['originalTitle'] = PP1Contents.find(id='originalTitle').text
+        ret['titles']['title']         = _text( _by_id( PP1Contents, 'title' ) )
+        ret['titles']['englishTitle']  = _text( _by_id( PP1Contents, 'englishTitle' ) )
+        ret['titles']['originalTitle'] = _text( _by_id( PP1Contents, 'originalTitle' ) )
 
-        eid = PP1Contents.find('p', text=re.compile(r'.*ECLI identifier.*'))
+        eid = _first( _xpath_ecli_paragraph, PP1Contents )
         if eid is not None:
-            ret['ecli'] = eid.text.split(':', 1)[1].strip()
+            ret['ecli'] = _text(eid).split(':', 1)[1].strip()
 
-    PPDates_Contents = soup.find(id='PPDates_Contents')
+    PPDates_Contents = _by_id( root, 'PPDates_Contents' )
     ret['dates'] = {}
     if PPDates_Contents is not None:
-        for what, val in parse_datalist( PPDates_Contents.find('dl') ).items():
+        for what, val in _parse_datalist( _first( _xpath_first_dl, PPDates_Contents ) ).items():
             if ';' in val:
                 val = val.split(';')[0].strip()
             if '/' in val: # format ISO8601 style for less ambiguity
@@ -145,55 +331,41 @@ def extract_html(htmlbytes):
             ret['dates'][what] = val
 
     ret['misc'] = {}
-    PPMisc_Contents = soup.find(id='PPMisc_Contents')
+    PPMisc_Contents = _by_id( root, 'PPMisc_Contents' )
     if PPMisc_Contents is not None:
-        ret['misc'] = parse_datalist( PPMisc_Contents.find('dl') )
+        ret['misc'] = _parse_datalist( _first( _xpath_first_dl, PPMisc_Contents ) )
 
 
     ret['proc'] = {}
-    PPProc_Contents = soup.find(id='PPProc_Contents')
+    PPProc_Contents = _by_id( root, 'PPProc_Contents' )
     if PPProc_Contents is not None:
         # procedure looks like a key:value thing (e.g. Defendant:Raad),
-        # but there are cases where the value is a list, which parse_datalist doesn't handle for us so we have to.
+        # but there are cases where the value is a list, which _parse_datalist doesn't handle for us so we have to.
         # for consistency's sake, even the single-value cases are returned as a list
-        for k, v in parse_datalist( PPProc_Contents.find('dl') ).items():
+        for k, v in _parse_datalist( _first( _xpath_first_dl, PPProc_Contents ) ).items():
             if isinstance(v, str):
                 ret['proc'][k] = [v]
-            else: # will be a list of bs4 nodes, e.g.  [<li><a href="./../../../procedure/EN/2018_395">2018/0395/NLE</a></li>]
+            else: # will be a list of li elements, e.g.  <li><a href="./../../../procedure/EN/2018_395">2018/0395/NLE</a></li>
                 ret['proc'][k] = []
                 for li in v:
-                    a = li.find('a')
+                    a = _first( _xpath_first_link, li )
                     if a is not None:
-                        ret['proc'][k].append( a.text ) # TODO: consider actually figuring out the link
-                #print( ret['proc'][k] )
-                #print( k, type(v), v )
-
-            # print( dlitem )
-            # if type(dlitem) in (str, dict): # dict seems typical; TODO: rewrite the other cases to dict
-            #     ret['proc'] = dlitem
-            # else:
-            #     # is still the bs4 object
-            #     # e.g.  in 62020CJ0180
-            #     # ignore for now? TODO: Warn?
-            #     print("WARNING - didn't think proc would have a %s in %s"%(type(dlitem).__class__.__name__, celex))
-            #     print('DLITEM',dlitem)
-            #     raise
-            #     #ret['proc'] = it
+                        ret['proc'][k].append( _text(a) ) # TODO: consider actually figuring out the link
 
 
     ret['linked'] = {}
-    PPLinked_Contents = soup.find(id='PPLinked_Contents')
+    PPLinked_Contents = _by_id( root, 'PPLinked_Contents' )
     if PPLinked_Contents is not None:
         parsed_link = {}
-        for what, val in parse_datalist(PPLinked_Contents.find('dl')).items(): 
-            if isinstance(val, bs4.element.ResultSet):
+        for what, val in _parse_datalist( _first( _xpath_first_dl, PPLinked_Contents ) ).items():
+            if isinstance(val, list):
                 parsedval = []
                 # This is far from complete
                 for li in val:
-                    a = li.find('a')
+                    a = _first( _xpath_first_link, li )
                     data_celex = a.get('data-celex')
                     if data_celex is not None:
-                        parsedval.append(   (  'CELEX:'+data_celex, ''.join( li.findAll(text=True) ).strip()  )   )
+                        parsedval.append(   (  'CELEX:'+data_celex, _text(li).strip()  )   )
                     else:
                         pass # TODO: handle other types
                 parsed_link[what] = parsedval
@@ -204,16 +376,12 @@ def extract_html(htmlbytes):
 
     # Doctrine
     ret['doctrine'] = {}
-    PPDoc_Contents = soup.find(id='PPDoc_Contents')
+    PPDoc_Contents = _by_id( root, 'PPDoc_Contents' )
     if PPDoc_Contents is not None:
         parsed_doctr = {}
-        for what, val in parse_datalist(PPDoc_Contents.find('dl')).items():
-            if isinstance(val, bs4.element.ResultSet):
-                parsedval = []
-                for li in val:
-                    a = li.find('a')
-                    parsedval.append(  li.text  ) # TODO: check that doesn't need to be a join-findall too
-                parsed_doctr[what] = parsedval
+        for what, val in _parse_datalist( _first( _xpath_first_dl, PPDoc_Contents ) ).items():
+            if isinstance(val, list):
+                parsed_doctr[what] = list( _text(li)  for li in val )
             else:
                 parsed_doctr[what] = val
         ret['doctrine'] = parsed_doctr
@@ -221,18 +389,18 @@ def extract_html(htmlbytes):
 
     # Classifications
     ret['classifications'] = {}
-    PPClass_Contents = soup.find(id='PPClass_Contents')
+    PPClass_Contents = _by_id( root, 'PPClass_Contents' )
     if PPClass_Contents is not None:
         parsed_class = {}
-        for what, val in parse_datalist(PPClass_Contents.find('dl')).items():
-            if isinstance(val, bs4.element.ResultSet):
+        for what, val in _parse_datalist( _first( _xpath_first_dl, PPClass_Contents ) ).items():
+            if isinstance(val, list):
                 parsedval = []
                 for li in val:
-                    div = li.find('div')
+                    div = _first( _xpath_first_div, li )
                     if div is not None:
-                        parsedval.append(  list(s.strip()   for s in div.findAll(text=True)  if len(s.strip())>0 )  )
+                        parsedval.append(  list( s.strip()   for s in _text_fragments(div) )  )
                     else:
-                        parsedval.append( ''.join( li.findAll(text=True) ).strip() )
+                        parsedval.append( _text(li).strip() )
                 parsed_class[what] = parsedval
             else:
                 parsed_class[what] = val
@@ -241,19 +409,19 @@ def extract_html(htmlbytes):
 
     # Languages and formats available   (not always there)
     ret['contents'] = []
-    PP2Contents = soup.find(id='PP2Contents')
+    PP2Contents = _by_id( root, 'PP2Contents' )
     if PP2Contents is not None:
         parsed_contents = []
-        for ul in PP2Contents.findAll('ul'):
+        for ul in _xpath_uls( PP2Contents ):
             format = None
-            for maybe_format in ul.get('class'):
+            for maybe_format in _classes(ul):
                 if maybe_format.startswith('PubFormat'):
                     format = maybe_format[9:]
             if format is not None:
-                for li in ul.findAll('li'):
-                    if 'disabled' not in li.get('class',''):
-                        a = li.find('a')
-                        lang = a.find('span').text
+                for li in _xpath_list_items( ul ):
+                    if 'disabled' not in _classes(li):
+                        a = _first( _xpath_first_link, li )
+                        lang = _text( _first( _xpath_first_span, a ) )
                         if format == 'VIEW':
                             continue
                         # constructing the URL like that is cheating and may not always work. 
@@ -264,84 +432,83 @@ def extract_html(htmlbytes):
 
 
     #Document text  (not always there)
-    PP4Contents = soup.find(id='PP4Contents')
+    PP4Contents = _by_id( root, 'PP4Contents' )
     txt = []
     if PP4Contents is not None:
 
         # TODO: review, this may be overkill and/or not complete
         titerate = []
-        TexteOnly = PP4Contents.find(id='TexteOnly') # probably better if it's there?
+        TexteOnly = _by_id( PP4Contents, 'TexteOnly' ) # probably better if it's there?
         if TexteOnly is not None:
             titerate.append( TexteOnly )
         else: #  currently looks for  div > p    (because p also appears e.g. inside tables)
-            for p in PP4Contents.findAll('p'):
-                if p.parent.name in ('div',)   and  p.parent not in titerate: # yeah okay, that's nasty
-                    titerate.append( p.parent )
+            for p in _xpath_div_paragraphs( PP4Contents ):
+                if p.getparent() not in titerate:
+                    titerate.append( p.getparent() )
 
         # txt will become a list of (section_name_str, section_contents_strlist)
         #   and all the parts will collect into:
         cur_section_name, cur_section_txt = '', []
 
+        def add_string(s):
+            if s is not None:
+                s = s.strip()
+                if len(s)>0:
+                    cur_section_txt.append( str(s) )
+
         for iterate_under in titerate:
-            for node in iterate_under.children:
-                if isinstance(node, bs4.element.NavigableString):
-                    s = node.string.strip()
-                    if len(s)>0:
-                        cur_section_txt.append(s)
-                else: # assume Tag
-                    if node.name in ('h2',
-                                     'h3' # arguably this should not split?
-                                     ):
-                        if len(cur_section_txt) > 0: # flush
-                            txt.append( (cur_section_name, cur_section_txt) )
-                        cur_section_name, cur_section_txt = '', []
-                        cur_section_name = node.text
-
-                    elif node.name in ('p',):
-                        txtfrags = list(  frag  for frag in node.findAll(text=True) if len(frag.strip())>0)
-                        cur_section_txt.extend( txtfrags )
-                    elif node.name in ('em','b','i',
-                                       'center',
-                                       ):
-                        txtfrags = list(  frag  for frag in node.findAll(text=True) if len(frag.strip())>0)
-                        cur_section_txt.extend( txtfrags )
-                    elif node.name in ('br','hr'):
-                        pass # is nothing
-                    elif node.name in ('a',): # seem to be used mainly as anchors for browsers to #go to, so skippable
-                        if len(node.text.strip())>0:
-                            cur_section_txt.extend( node.text.strip() ) # probably used as a header
-                            #raise ValueError("Bad assumption, that an  a  tag has no text, in %r"%(node))
-
-                    # not really inspected, add flattened for now
-                    elif node.name in (
-                        'title',
-                        'div',
-                        'span',
-                        'table',
-                        'dl','dt','dd',
-
-                        'td' # TODO: think
-                    ):
-                        #print( node.name.upper(), node)
-                        txtfrags = list(  frag  for frag in node.findAll(text=True) if len(frag.strip())>0)
-                        cur_section_txt.extend( txtfrags )
-
-                    # ignore
-                    elif node.name in ('img',):
-                        pass
-                    elif node.name in ('link',): # seems to be stylesheets
-                        #print('LINK', node)
-                        pass
-                    elif node.name in ('meta', # probably just a charset?
-                                    'font'): 
-                        #print('META', node)
-                        pass
-
-                    elif node.name is None:
-                        print('NONE', node)
+            add_string( iterate_under.text )
+            for node in iterate_under:
+                if not isinstance(node.tag, str): # comment or processing instruction
+                    pass
+
+                elif node.tag in ('h2',
+                                  'h3' # arguably this should not split?
+                                  ):
+                    if len(cur_section_txt) > 0: # flush
+                        txt.append( (cur_section_name, cur_section_txt) )
+                    cur_section_name, cur_section_txt = '', []
+                    cur_section_name = _text(node)
+
+                elif node.tag in ('p',):
+                    cur_section_txt.extend( _text_fragments(node) )
+                elif node.tag in ('em','b','i',
+                                  'center',
+                                  ):
+                    cur_section_txt.extend( _text_fragments(node) )
+                elif node.tag in ('br','hr'):
+                    pass # is nothing
+                elif node.tag in ('a',): # seem to be used mainly as anchors for browsers to #go to, so skippable
+                    if len(_text(node).strip())>0:
+                        # TODO: this adds it character by character, which is probably not what was intended,
+                        #       but is kept the same as before so that re-extracted results are comparable
+                        cur_section_txt.extend( _text(node).strip() ) # probably used as a header
+
+                # not really inspected, add flattened for now
+                elif node.tag in (
+                    'title',
+                    'div',
+                    'span',
+                    'table',
+                    'dl','dt','dd',
+
+                    'td' # TODO: think
+                ):
+                    cur_section_txt.extend( _text_fragments(node) )
+
+                # ignore
+                elif node.tag in ('img',):
+                    pass
+                elif node.tag in ('link',): # seems to be stylesheets
+                    pass
+                elif node.tag in ('meta', # probably just a charset?
+                                  'font'):
+                    pass
 
-                    else:
-                        raise ValueError( "Don't yet handle %r"%node.name )
+                else:
+                    raise ValueError( "Don't yet handle %r"%node.tag )
+
+                add_string( node.tail )
 
         if len(cur_section_txt) > 0: # final flush
             txt.append( (cur_section_name, cur_section_txt) )
@@ -349,3 +516,72 @@ def extract_html(htmlbytes):
     ret['text'] = txt
 
     return ret
+
+
+def _extract_html_worker(pages):
+    ' runs in a worker process: takes a list of (key, htmlbytes), returns a list of (key, extracted dict, None) or (key, None, error message) '
+    ret = []
+    for key, htmlbytes in pages:
+        try:
+            ret.append( (key, extract_html( htmlbytes ), None) )
+        except Exception as e: # report it to the main process, rather than break the whole batch
+            ret.append( (key, None, '%s: %s'%(e.__class__.__name__, e)) )
+    return ret
+
+
+def extract_html_store(page_store, workers=None, chunk_size=16, skip_errors=False, verbose=False):
+    ''' Runs L{extract_html} on all pages in a store, spread over multiple processes
+        (the parsing is CPU-bound, so threads would not help much).
+
+        For example, to re-extract everything after a change to the parsing: ::
+            pages = wetsuite.helpers.localdata.LocalKV('eurlex_pages.db', str, bytes, read_only=True)
+            extracted = wetsuite.helpers.localdata.MsgpackKV('eurlex_extracted.db')
+            for url, data in extract_html_store( pages ):
+                extracted.put( url, data, commit=False )
+            extracted.commit()
+
+        Pages are read from the store in this (the calling) process, and only a limited amount of them 
+        are handed to the workers at a time, so this does not need to hold the whole store in memory.
+
+        @param page_store: a store with pages as values (bytes), e.g. a L{wetsuite.helpers.localdata.LocalKV}.
+        @param workers: the amount of worker processes. None means as many as there are CPUs.
+        @param chunk_size: how many pages to send to a worker at a time.  Larger is a little less overhead.
+        @param skip_errors: if False (default), a page that fails to parse raises a ValueError (mentioning the key).
+        If True, such pages are skipped (and mentioned on stdout if verbose).
+        @param verbose: whether to print progress.
+        @return: a generator that yields (key, extracted dict) tuples, in the order of the store's keys.
+    '''
+    if workers is None:
+        workers = os.cpu_count() or 1
+    max_in_flight = 4 * workers  # enough to keep every worker busy, while bounding how many pages are in memory
+
+    done = 0
+    in_flight = collections.deque()
+    with concurrent.futures.ProcessPoolExecutor( max_workers=workers ) as executor:
+
+        def results_of_oldest():
+            nonlocal done
+            for key, data, error in in_flight.popleft().result():
+                done += 1
+                if error is None:
+                    yield key, data
+                elif skip_errors:
+                    if verbose:
+                        print( 'skipping %r, %s'%(key, error) )
+                else:
+                    raise ValueError( 'extracting %r failed, %s'%(key, error) )
+            if verbose and done % 1000 < chunk_size:
+                print( 'extracted %d pages'%done )
+
+        chunk = []
+        for key, htmlbytes in page_store.iteritems():
+            chunk.append( (key, htmlbytes) )
+            if len(chunk) >= chunk_size:
+                in_flight.append( executor.submit( _extract_html_worker, chunk ) )
+                chunk = []
+                if len(in_flight) >= max_in_flight:
+                    yield from results_of_oldest()
+        if len(chunk) > 0:
+            in_flight.append( executor.submit( _extract_html_worker, chunk ) )
+        while len(in_flight) > 0:
+            yield from results_of_oldest()
@@ -8,18 +8,25 @@ An interface to repositories managed by KOOP
   - Right now, only BWB and CVDR have been used seriously, the rest still needs testing.
   - See also sru.py
 
+- IncrementalHarvester, to keep a local copy of (a subset of) such a repository up to date
+
 - The repository wit FRBR-style organization, at https://repository.overheid.nl/frbr/
 
 '''
 import time
+import hashlib
 import urllib.parse
-import random
+import collections
+import concurrent.futures
 
-import bs4
 import requests
+import lxml.etree
+import lxml.html
 
 import wetsuite.helpers.net
+import wetsuite.helpers.etree
 import wetsuite.helpers.localdata
+import wetsuite.helpers.koop_parse
 
 import wetsuite.datacollect.sru
 
@@ -200,7 +207,129 @@ class EuropeseRichtlijnen(wetsuite.datacollect.sru.SRUBase):
 
 
 
+class IncrementalHarvester:
+    ''' Keeps a local copy of an SRU repository (or a subset of it) up to date, 
+        by remembering the most recent dcterms.modified it has seen, and on each run asking only for things modified since.
+
+        Example use::
+            harvester = IncrementalHarvester( CVDR(), 
+                                              record_store = wetsuite.helpers.localdata.LocalKV('cvdr_records.db', str, bytes),
+                                              state_store  = wetsuite.helpers.localdata.MsgpackKV('harvest_state.db') )
+            harvester.harvest()   # the first run fetches everything since start_date, later runs only what changed since
+
+        It also checkpoints after each page, so when a run is interrupted (crash, network trouble, ctrl-C),
+        the next harvest() continues with the same query from the last completed page, rather than starting over.
+
+        Notes:
+          - We query with >= on the high-water mark, because dcterms.modified is typically a date, not a time,
+            so things modified later on that same day would otherwise be missed. 
+            This means each run re-fetches that day's records, which is harmless because we just overwrite them.
+          - Resuming by page assumes the result set didn't shift around in the meantime, 
+            which is not guaranteed, so you may want to occasionally do a run with a lower high-water mark.
+    '''
+    def __init__(self, sru_repo, record_store, state_store, name:str=None,
+                 record_key=None, record_value=None,
+                 start_date:str='1800-01-01', at_a_time:int=50, wait_between_sec:float=0.5, verbose:bool=False):
+        ''' 
+            @param sru_repo:     an SRUBase object, e.g. CVDR(), BWB(), OfficielePublicaties()
+            @param record_store: store to put each record in. 
+            By default that's the record XML (as bytes), so a str:bytes LocalKV; 
+            if you hand in a record_value function, use a store that can hold what that returns (e.g. a MsgpackKV for dicts).
+            @param state_store:  a MsgpackKV that keeps the high-water mark and checkpoint. Can be shared between harvesters, as long as their names differ.
+            @param name:         name for this harvester's state. Defaults to something based on the repository's URL, x-connection, and extra_query.
+            @param record_key:   function that takes a record node and returns the key to store it under.
+            The default looks for the first 'identifier' element in the record, which suits the KOOP repositories.
+            @param record_value: function that takes a record node and returns the value to store. 
+            The default stores the record's XML as bytes.
+            @param start_date:   on the very first run, fetch records modified since this date (as yyyy-mm-dd)
+            @param at_a_time:    page size
+            @param wait_between_sec: sleep between page fetches
+        '''
+        self.sru_repo         = sru_repo
+        self.record_store     = record_store
+        self.state_store      = state_store
+        if name is None:
+            name = '%s %s %s'%(sru_repo.base_url, sru_repo.x_connection, sru_repo.extra_query)
+        self.name             = name
+        self.record_key       = record_key   if record_key   is not None else _default_record_key
+        self.record_value     = record_value if record_value is not None else wetsuite.helpers.etree.tostring
+        self.start_date       = start_date
+        self.at_a_time        = at_a_time
+        self.wait_between_sec = wait_between_sec
+        self.verbose          = verbose
+
+
+    def state(self) -> dict:
+        ''' Returns the stored state for this harvester, a dict like::
+                {'high_water_mark': '2024-01-15',     # the most recent dcterms.modified we have completely harvested up to 
+                 'run_since': '2024-01-15',           # only present while a run is in progress (or was interrupted)
+                 'run_next_start_record': 451,        # same
+                 'run_high_water_mark': '2024-01-19'} # same
+            or an empty dict if it has never run.
+        '''
+        state = self.state_store.get( self.name, missing_as_none=True )
+        if state is None:
+            return {}
+        return state
+
+
+    def harvest(self) -> int:
+        ''' Fetch everything modified since the last completed run (or continue an interrupted one) into the record store.
+            @return: the amount of records stored in this call.
+        '''
+        state = self.state()
+        if 'run_since' not in state: # start a new run
+            state['run_since']             = state.get('high_water_mark', self.start_date)
+            state['run_next_start_record'] = 1
+            state['run_high_water_mark']   = state['run_since']
+            self.state_store.put( self.name, state )
+        elif self.verbose:
+            print( "[harvest %s] resuming at startRecord=%d"%(self.name, state['run_next_start_record']) )
+
+        query = 'dcterms.modified>=%s'%state['run_since']
+        count = 0
+        while True:
+            start_record = state['run_next_start_record']
+            records = self.sru_repo.search_retrieve_retrying( query=query, start_record=start_record, maximum_records=self.at_a_time, retries=3 )
+            if self.verbose:
+                print( "[harvest %s] %d..%d of %s"%(self.name, start_record, start_record+len(records)-1, self.sru_repo.number_of_records) )
+
+            for record in records:
+                self.record_store.put( self.record_key(record), self.record_value(record), commit=False )
+                for modified in record.iter('modified'):
+                    if modified.text is not None:
+                        state['run_high_water_mark'] = max( state['run_high_water_mark'], modified.text.strip()[:10] )
+            self.record_store.commit()  # records first, then the checkpoint, so a crash in between means re-fetching a page, not skipping one
+            count += len(records)
+
+            state['run_next_start_record'] = start_record + len(records)
+            if len(records) == 0  or  state['run_next_start_record'] > self.sru_repo.number_of_records:
+                break
+            self.state_store.put( self.name, state )
+            time.sleep( self.wait_between_sec )
+
+        # completed this run
+        state = {'high_water_mark': state['run_high_water_mark']}
+        self.state_store.put( self.name, state )
+        return count
+
+
+def _default_record_key(record) -> str:
+    ' The text of the first identifier element in a record (the KOOP repositories have one in their metadata). '
+    for identifier in record.iter('identifier'):
+        if identifier.text is not None  and  len(identifier.text.strip()) > 0:
+            return identifier.text.strip()
+    raise ValueError("Could not find an identifier in record")
+
+
+
+
 # Code that accesses the https://repository.overheid.nl/frbr/ data
+def _url_digest(url:str) -> bytes:
+    ' A short fixed-size stand-in for an URL, for sets of visited URLs that need to be exact (and saved) but should not hold the URL strings '
+    return hashlib.sha1( url.encode('utf8') ).digest()
+
+
 class FRBRFetcher:
     ''' Helper class to fetch data from an area of https://repository.overheid.nl/frbr/
         See the constructor's docstring for more.
@@ -211,7 +340,8 @@ class FRBRFetcher:
         (SFTP imitating anonymous FTP, which is a grea idea in theory).
     '''
 
-    def __init__(self, fetch_store, cache_store, verbose=True, waittime_sec=1.0):
+    def __init__(self, fetch_store, cache_store, verbose=True, waittime_sec=1.0, state_store=None, state_name='frbrfetcher', checkpoint_every=100,
+                 workers=1, commit_every=50):
         ''' Hand in two LocalKV style stores: one that the documents will get fetched into,
             and one that the intermediate folders get fetched into
             (the former is almost all useful content, 
@@ -231,16 +361,47 @@ class FRBRFetcher:
             @param cache_store:
             @param verbose:
             @param waittime_sec: How long to sleep after every actual network fetch, to be nicer to the servers.            
+            @param state_store: if not None, a MsgpackKV that we save the crawl state (frontier and visited set) into, 
+            every checkpoint_every handled URLs and whenever work() stops, and load it from on construction,
+            so that an interrupted crawl continues where it left off instead of starting over.
+            (if you then add_page() the same starting point, that is ignored because it was already visited)
+            @param state_name: the key we store the state under, so that multiple crawls can share a state_store
+            @param checkpoint_every: see state_store
+            @param workers: if more than 1, work() fetches that many folders, pages, and documents at the same time.
+            waittime_sec then instead means the minimum time between the start of any two requests to the same host
+            (shared between all workers), so that we stop sitting idle while waiting for responses 
+            without becoming less polite to the server.
+            @param commit_every: in that concurrent mode, documents are written to fetch_store in transactions of this many.
         '''
         self.fetch_store = fetch_store
         self.cache_store = cache_store
         self.verbose     = int(verbose)
 
-        self.to_fetch_pages   = set()
-        self.to_fetch_folders = set()
-        self.fetched = {} # url -> True
+        # The frontier: folders are handled as a stack (so depth-first), pages in the order we found them.
+        # to_fetch_queued mirrors their contents, so that 'is this already queued' is a cheap check.
+        self.to_fetch_pages   = collections.deque()
+        self.to_fetch_folders = collections.deque()
+        self.to_fetch_items   = collections.deque() # only used in the concurrent mode
+        self.to_fetch_queued  = set()
+        self.in_flight        = {'folder':set(), 'page':set(), 'item':set()}  # also only in the concurrent mode
+        # What listings we have handled, and what documents are in fetch_store.   Bloom filters, so that memory use stays small
+        # for million-URL crawls, and so that most "do we have this document" questions can skip the store - see add_folder() and the item fetching
+        self.fetched      = wetsuite.helpers.localdata.ScalableBloomFilter()
+        # Pages have no store to double-check a "yes" from that filter against (see _page_visited), so we also keep their digests.
+        # There are far fewer pages than documents, so this stays small.
+        self.visited_pages = set()
+        self.known_items  = None  # created from fetch_store's keys when work() starts, unless we resumed it from state
         self.waittime_sec = waittime_sec
 
+        self.state_store      = state_store
+        self.state_name       = state_name
+        self.checkpoint_every = checkpoint_every
+        self._handled_since_checkpoint = 0
+
+        self.workers      = max(1, int(workers))
+        self.commit_every = commit_every
+        self._host_spacing = {}
+
         self.count_fetches   = 0
         self.count_cacheds   = 0
 
@@ -251,6 +412,50 @@ class FRBRFetcher:
         self.count_skipped = 0
         self.count_errors  = 0
 
+        if self.state_store is not None:
+            self.load_state()
+
+
+    def save_state(self):
+        ' Saves the frontier and visited set into the state_store (does nothing if we were not given one) '
+        if self.state_store is None:
+            return
+        # things that were being fetched when we stopped count as not done
+        self.state_store.put( self.state_name, {
+            'folders': list( self.to_fetch_folders ) + sorted( self.in_flight['folder'] ),
+            'pages':   sorted( self.in_flight['page'] ) + list( self.to_fetch_pages ),
+            'items':   sorted( self.in_flight['item'] ) + list( self.to_fetch_items ),
+            'visited': self.fetched.to_bytes(),
+            'visited_pages': list( self.visited_pages ),
+            'known_items': None if self.known_items is None else self.known_items.to_bytes(),
+        } )
+        self._handled_since_checkpoint = 0
+
+
+    def load_state(self):
+        ' Loads the frontier and visited set from the state_store, if there is anything stored there '
+        state = self.state_store.get( self.state_name, missing_as_none=True )
+        if state is None:
+            return
+        self.to_fetch_folders = collections.deque( state['folders'] )
+        self.to_fetch_pages   = collections.deque( state['pages'] )
+        self.to_fetch_items   = collections.deque( state.get('items', ()) )
+        self.to_fetch_queued  = set( state['folders'] ) | set( state['pages'] ) | set( self.to_fetch_items )
+        self.fetched          = wetsuite.helpers.localdata.ScalableBloomFilter.from_bytes( state['visited'] )
+        self.visited_pages    = set( state.get('visited_pages', ()) )
+        if state.get('known_items') is not None:
+            self.known_items  = wetsuite.helpers.localdata.ScalableBloomFilter.from_bytes( state['known_items'] )
+        if self.verbose >= 1:
+            print( 'RESUMING with %d folders and %d pages to go, %d visited'%(
+                len(self.to_fetch_folders), len(self.to_fetch_pages), len(self.fetched)) )
+
+
+    def _handled(self):
+        ' called after each URL we handled, to checkpoint every so often '
+        self._handled_since_checkpoint += 1
+        if self._handled_since_checkpoint >= self.checkpoint_every:
+            self.save_state()
+
 
     def uncached_fetch(self, url, retries = 3):
         ' Unconditional fetch from an URL '
@@ -297,24 +502,48 @@ class FRBRFetcher:
 
     def add_page(self, page_url):
         ''' add an URL to an internal "pages to still look at" set  
-            (unless it was previously added / fetched)
+            (unless it was previously added / fetched, or is being fetched right now)
             Mostly intended to be used by handle_url()
         '''
-        if page_url not in self.fetched:
+        if not self._page_visited( page_url )  and  page_url not in self.to_fetch_queued  and  page_url not in self.in_flight['page']:
             if self.verbose >= 1:
                 print('ADD_PAGE',page_url)
-            self.to_fetch_pages.add( page_url )
+            self.to_fetch_pages.append( page_url )
+            self.to_fetch_queued.add( page_url )
+
+
+    def _page_visited(self, page_url):
+        ''' Whether we handled this page already.
+            The visited filter can be wrong in the "yes" direction, so when it says yes, check the exact set of page digests.
+            (the filter still answers the common "no" without hashing into that set)
+        '''
+        return page_url in self.fetched  and  _url_digest( page_url ) in self.visited_pages
+
+
+    def _mark_visited(self, url, is_folder:bool):
+        ' Remember that we handled this folder or page '
+        self.fetched.add( url )
+        if not is_folder:
+            self.visited_pages.add( _url_digest( url ) )
+
+
+    def _folder_visited(self, folder_url):
+        ''' Whether we handled this folder already.
+            The visited filter can be wrong in the "yes" direction, so since folders we handled are always in cache_store, check there when it says yes.
+        '''
+        return folder_url in self.fetched  and  folder_url in self.cache_store
 
 
     def add_folder(self, folder_url):
         ''' add an URL to an internal "folders to still look at" set  
-            (unless it was previously added / fetched) 
+            (unless it was previously added / fetched, or is being fetched right now) 
             Mostly intended to be used by handle_url()
         '''
-        if folder_url not in self.fetched:
+        if not self._folder_visited( folder_url )  and  folder_url not in self.to_fetch_queued  and  folder_url not in self.in_flight['folder']:
             if self.verbose >= 2:
                 print('ADD_FOL',folder_url)
-            self.to_fetch_folders.add( folder_url )
+            self.to_fetch_folders.append( folder_url )
+            self.to_fetch_queued.add( folder_url )
 
 
     def handle_url(self, h_url, is_folder=False):
@@ -332,18 +561,14 @@ class FRBRFetcher:
                 # TODO: count error
                 return
 
-        self.fetched[ h_url ] = True
-        soup = bs4.BeautifulSoup( pagebytes, features='lxml' )
+        self._mark_visited( h_url, is_folder )
+        items, folders, pages, num_skipped = self.parse_listing( h_url, pagebytes )
+        self.count_skipped += num_skipped
 
         # browse items that are files - download
-        for li in soup.select("ul[class*='list--sources'] > li "):
-            si = li.select("div[class*='list--source__information'] ")[0]
-            a  = li.find("a")
-            txt = si.find_all(text=True, recursive=False)[0]
-            fil_absurl = urllib.parse.urljoin( h_url, a.get('href') )
-
+        for fil_absurl, txt in items:
             try:
-                _, cached = wetsuite.helpers.localdata.cached_fetch( self.fetch_store, fil_absurl )
+                _, cached = wetsuite.helpers.localdata.cached_fetch( self.fetch_store, fil_absurl, known=self.known_items )
                 self.count_items += 1
                 if cached:
                     self.count_cacheds += 1
@@ -354,37 +579,64 @@ class FRBRFetcher:
                     if self.verbose >= 2:
                         print( f' ITEM FETCHED {txt:25s}  {fil_absurl}' )
             except ValueError as ve: # probably a 404
+                self.count_errors += 1
                 print( f' ERROR {repr(ve):25s}  {fil_absurl}' )
             except Exception as e: # e.g. OperationalError
+                self.count_errors += 1
                 print( f' ERROR TODO {repr(e):25s}  {fil_absurl}' )
 
         # browse items that are folders - recurse
-        folder_soup  = soup.select(
-            "div > ul[class*='browse__list'] > li[class*='browse__item'] > a "
-        )
-        folder_names = list(a.find( text=True )  for a in folder_soup)
+        for fol_absurl in reversed(folders): # reversed, so that popping the stack handles them in listed order
+            self.add_folder( fol_absurl )
+
+        # get links to other pagination - add and get to eventually
+        for pag_absurl in pages:
+            self.add_page( pag_absurl )
+
+
+    def parse_listing(self, h_url, pagebytes):
+        ''' Takes a listing page from the repository and picks out what it links to.
+            @param h_url: the URL it came from, to resolve relative links against
+            @param pagebytes: the HTML, as bytes
+            @return: a 4-tuple of 
+              - a list of (url, description) for documents 
+              - a list of folder URLs, only the document types we prefer (see koop_parse.prefer_types)
+              - a list of pagination URLs
+              - the number of folders we skipped because of that type preference
+        '''
+        if len(pagebytes.strip()) == 0:
+            return [], [], [], 0
+        root = lxml.html.fromstring( pagebytes, parser=_listing_parser )
+
+        items = []
+        for li in _xpath_source_items( root ):
+            si  = _xpath_source_info( li )[0]
+            a   = _xpath_first_link( li )[0]
+            txt = _xpath_direct_text( si )[0]
+            items.append( (urllib.parse.urljoin( h_url, a.get('href') ), str(txt)) )
+
+        folder_links = _xpath_folder_links( root )
+        folder_names = list( _first_text(a)  for a in folder_links )
         chosen_types = wetsuite.helpers.koop_parse.prefer_types( folder_names )
 
-        for a in folder_soup:
+        folders, num_skipped = [], 0
+        for a, text in zip( folder_links, folder_names ):
             fol_absurl = urllib.parse.urljoin( h_url, a.get('href') )
-            text = a.find( text=True )
-            #self.itemlinks[ fol_absurl ] = text
             # TODO: change to 'decide what subset to fetch based on what there is'
             if text not in chosen_types:
                 # in ('pdf','odt', 'jpg','coordinaten','ocr'):
                 # 'metadata' 'metadataowms' 'xml' 'html'
-                self.count_skipped += 1
-                #print( f' SKIP FOLDER: {url}  {text:8s}   {fol_absurl}       (of {folder_names})' )
+                num_skipped += 1
             else:
-                if fol_absurl not in self.fetched and fol_absurl not in self.to_fetch_folders:
-                    self.add_folder( fol_absurl )
+                folders.append( fol_absurl )
 
-        # get links to other pagination - add and get to eventually
-        for a in soup.select("div[class*='pagination__index'] > ul > li > a"):
+        pages = []
+        for a in _xpath_pagination_links( root ):
             pag_absurl = urllib.parse.urljoin( h_url, a.get('href') )
             if 'start=' in pag_absurl:
-                if pag_absurl not in self.fetched and pag_absurl not in self.to_fetch_pages:
-                    self.add_page( pag_absurl )
+                pages.append( pag_absurl )
+
+        return items, folders, pages, num_skipped
 
 
     def work(self):
@@ -407,6 +659,8 @@ class FRBRFetcher:
             before what we added as pages, 
             so that we can act depth-first-like
             and will e.g. start fetching documents before we've gone through all pages.
+            (In the concurrent mode, see the constructor's workers, that is still the preference order,
+            and documents go before both, but many things are underway at the same time, so it is approximate)
             (which seems like a good idea when some things have 100K pages, 
             and there are reasons our fetching gets interrupted)
 
@@ -415,33 +669,241 @@ class FRBRFetcher:
             at which things get added over time. As such, you can make the folder store persistent
             and it saves _some_ time updating a local copy.
         '''
-        did_new_things = True
-        while did_new_things:
-            did_new_things = False
-            yield "LOOP" # dummy value
-
-            while len(self.to_fetch_folders) > 0:
-                folder_url = random.sample(list(self.to_fetch_folders), 1)[0]
-                self.to_fetch_folders.remove( folder_url )
+        if self.known_items is None:
+            self.known_items = wetsuite.helpers.localdata.ScalableBloomFilter.from_store_keys( self.fetch_store )
+
+        if self.workers > 1:
+            yield from self._work_concurrent()
+            return
+
+        try:
+            did_new_things = True
+            while did_new_things:
+                did_new_things = False
+                yield "LOOP" # dummy value
+
+                while len(self.to_fetch_items) > 0: # only if we resumed state from the concurrent mode
+                    item_url = self.to_fetch_items.popleft()
+                    self.to_fetch_queued.discard( item_url )
+                    try:
+                        _, cached = wetsuite.helpers.localdata.cached_fetch( self.fetch_store, item_url, known=self.known_items )
+                        self.count_items += 1
+                        if cached:
+                            self.count_cacheds += 1
+                        else:
+                            self.count_fetches += 1
+                    except ValueError as ve: # probably a 404
+                        self.count_errors += 1
+                        print( f' ERROR {repr(ve):25s}  {item_url}' )
+                    except Exception as e: # e.g. OperationalError
+                        self.count_errors += 1
+                        print( f' ERROR TODO {repr(e):25s}  {item_url}' )
+                    except BaseException: # e.g. interrupted - put it back so that a resume will still do it
+                        self.to_fetch_items.appendleft( item_url )
+                        self.to_fetch_queued.add( item_url )
+                        raise
+
+                while len(self.to_fetch_folders) > 0:
+                    folder_url = self.to_fetch_folders.pop()   # most recently added, so depth-first
+                    self.to_fetch_queued.discard( folder_url )
+                    if self.verbose >= 2:
+                        print('HANDLE_FOL',folder_url)
+                    try:
+                        self.handle_url( folder_url, is_folder=True )
+                        self.count_folders += 1
+                    except ValueError:
+                        self.count_errors += 1
+                    except BaseException: # e.g. interrupted - put it back so that a resume will still do it
+                        self.to_fetch_folders.append( folder_url )
+                        self.to_fetch_queued.add( folder_url )
+                        raise
+                    self._handled()
+                    did_new_things = True
+                    #yield "LOOP" # dummy value
+                    yield folder_url
+
+
+                if len(self.to_fetch_pages) > 0:
+                    page_url = self.to_fetch_pages.popleft()
+                    self.to_fetch_queued.discard( page_url )
+                    if self.verbose >= 1:
+                        print('HANDLE_PAGE',page_url)
+                    try:
+                        self.handle_url( page_url, is_folder=False )
+                    except BaseException:
+                        self.to_fetch_pages.appendleft( page_url )
+                        self.to_fetch_queued.add( page_url )
+                        raise
+                    self.count_pages += 1
+                    self._handled()
+                    did_new_things = True
+                    #yield "LOOP" # dummy value
+                    yield page_url
+        finally: # also when you stop iterating, or something raised (including KeyboardInterrupt)
+            self.save_state()
+
+
+
+    def _spacing_for(self, url):
+        ' the RequestSpacing for the host in this URL (created as necessary) '
+        host = urllib.parse.urlparse( url ).netloc
+        if host not in self._host_spacing:
+            self._host_spacing[host] = wetsuite.helpers.net.RequestSpacing( self.waittime_sec )
+        return self._host_spacing[host]
+
+
+    def _fetch_spaced(self, url, spacing, retries=3):
+        ' download, respecting the per-host spacing, retrying timeouts.  Runs in worker threads, so touches no state. '
+        for attempt in range( max(1, retries) ):
+            spacing.wait()
+            try:
+                return wetsuite.helpers.net.download( url )
+            except requests.exceptions.Timeout:
+                if attempt == retries-1:
+                    raise
                 if self.verbose >= 2:
-                    print('HANDLE_FOL',folder_url)
-                try:
-                    self.handle_url( folder_url, is_folder=True )
-                    self.count_folders += 1
-                except ValueError:
-                    self.count_errors += 1
-                did_new_things = True
-                #yield "LOOP" # dummy value
-                yield folder_url
-
-
-            if len(self.to_fetch_pages) > 0:
-                page_url = random.sample(list(self.to_fetch_pages), 1)[0]
-                self.to_fetch_pages.remove( page_url )
-                if self.verbose >= 1:
-                    print('HANDLE_PAGE',page_url)
-                self.handle_url( page_url, is_folder=False )
-                self.count_pages += 1
-                did_new_things = True
-                #yield "LOOP" # dummy value
-                yield page_url
+                    print(f"W TRYAGAIN {url}")
+
+
+    def _concurrent_task(self, kind, url, spacing, cached_data=None):
+        ''' What a worker thread does for one URL: fetch it (unless cached_data was handed in) and, for listings, parse it.
+            It touches neither the stores nor our state: the thread running work() looks in the stores before handing out a URL,
+            and does all changes to the frontier, stores, and counters, 
+            which keeps those simple, the counters accurate, and each store used from only one thread.
+            @return: (data that was fetched, or None if cached_data was used;   parsed listing, or None for items)
+        '''
+        if kind == 'item':
+            return self._fetch_spaced( url, spacing ), None
+        elif kind == 'folder'  and  cached_data is not None:
+            return None, self.parse_listing( url, cached_data )
+        else:
+            data = self._fetch_spaced( url, spacing )
+            return data, self.parse_listing( url, data )
+
+
+    def _next_task(self):
+        ''' pick the next thing to fetch: documents first, then folders (depth-first), then pages.  Returns (kind, url), or None if there is nothing queued.
+            Listings that were handled since they were queued are skipped.
+        '''
+        while True:
+            if len(self.to_fetch_items) > 0:
+                kind, url = 'item',   self.to_fetch_items.popleft()
+            elif len(self.to_fetch_folders) > 0:
+                kind, url = 'folder', self.to_fetch_folders.pop()
+            elif len(self.to_fetch_pages) > 0:
+                kind, url = 'page',   self.to_fetch_pages.popleft()
+            else:
+                return None
+            self.to_fetch_queued.discard( url )
+            if kind == 'folder'  and  self._folder_visited( url ):
+                continue
+            if kind == 'page'  and  self._page_visited( url ):
+                continue
+            self.in_flight[kind].add( url )
+            return kind, url
+
+
+    def _work_concurrent(self):
+        ' The workers>1 variant of work() '
+        uncommitted = 0
+        in_flight = {} # future -> (kind, url)
+        pool = concurrent.futures.ThreadPoolExecutor( max_workers=self.workers )
+        try:
+            while True:
+                while len(in_flight) < 2*self.workers:
+                    task = self._next_task()
+                    if task is None:
+                        break
+                    kind, url = task
+                    cached_data = None
+                    if kind == 'item':
+                        if url in self.known_items  and  url in self.fetch_store: # the filter answers most 'no's without asking the store
+                            self.in_flight['item'].discard( url )
+                            self.count_items   += 1
+                            self.count_cacheds += 1
+                            continue
+                    elif kind == 'folder':
+                        cached_data = self.cache_store.get( url, missing_as_none=True )
+                    in_flight[ pool.submit( self._concurrent_task, kind, url, self._spacing_for(url), cached_data ) ] = task
+
+                if len(in_flight) == 0:
+                    break
+
+                done, _ = concurrent.futures.wait( in_flight, return_when=concurrent.futures.FIRST_COMPLETED )
+                for future in done:
+                    kind, url = in_flight.pop( future )
+                    try:
+                        data, listing = future.result()
+                    except (ValueError, requests.exceptions.RequestException) as e: # probably a 404, or repeated timeouts
+                        self.in_flight[kind].discard( url )
+                        self.count_errors += 1
+                        print( f' ERROR {repr(e):25s}  {url}' )
+                        continue
+                    # (anything else propagates while url is still in self.in_flight, so the saved state still has it)
+                    self.in_flight[kind].discard( url )
+
+                    if kind == 'item':
+                        self.count_items   += 1
+                        self.count_fetches += 1
+                        self.fetch_store.put( url, data, commit=False )
+                        self.known_items.add( url )
+                        uncommitted += 1
+                        if uncommitted >= self.commit_every:
+                            self.fetch_store.commit()
+                            uncommitted = 0
+                    else:
+                        if kind == 'folder':
+                            self.count_folders += 1
+                            if data is None:
+                                self.count_cacheds += 1
+                            else:
+                                self.count_fetches += 1
+                                self.cache_store.put( url, data )
+                        else:
+                            self.count_pages += 1
+                            self.count_fetches += 1
+                        self._mark_visited( url, kind == 'folder' )
+
+                        items, folders, pages, num_skipped = listing
+                        self.count_skipped += num_skipped
+                        for item_url, _ in items:
+                            if item_url not in self.to_fetch_queued  and  item_url not in self.in_flight['item']:
+                                self.to_fetch_items.append( item_url )
+                                self.to_fetch_queued.add( item_url )
+                        # reversed, so that popping the stack handles them in listed order
+                        for fol_absurl in reversed(folders):
+                            self.add_folder( fol_absurl )
+                        for pag_absurl in pages:
+                            self.add_page( pag_absurl )
+
+                    self._handled_since_checkpoint += 1
+                    if self._handled_since_checkpoint >= self.checkpoint_every:
+                        self.fetch_store.commit() # so that the saved state does not get ahead of what fetch_store has
+                        uncommitted = 0
+                        self.save_state()
+                    yield url
+        finally:
+            pool.shutdown( wait=False, cancel_futures=True )
+            if uncommitted > 0:
+                self.fetch_store.commit()
+            self.save_state()
+
+
+
+# Used by FRBRFetcher.parse_listing.  Compiled once, because we use them on every listing page we see.
+# These are the equivalents of the CSS selectors we used with BeautifulSoup before, which was several times slower.
+_listing_parser         = lxml.html.HTMLParser( encoding='utf-8' )
+_xpath_source_items     = lxml.etree.XPath( "//ul[contains(@class,'list--sources')]/li" )
+_xpath_source_info      = lxml.etree.XPath( ".//div[contains(@class,'list--source__information')]" )
+_xpath_first_link       = lxml.etree.XPath( ".//a" )
+_xpath_direct_text      = lxml.etree.XPath( "text()" )
+_xpath_all_text         = lxml.etree.XPath( ".//text()" )
+_xpath_folder_links     = lxml.etree.XPath( "//div/ul[contains(@class,'browse__list')]/li[contains(@class,'browse__item')]/a" )
+_xpath_pagination_links = lxml.etree.XPath( "//div[contains(@class,'pagination__index')]/ul/li/a" )
+
+def _first_text(node):
+    ' the first text under a node (like find(string=True) in BeautifulSoup), or None '
+    texts = _xpath_all_text( node )
+    if len(texts) == 0:
+        return None
+    return str( texts[0] )
@@ -10,27 +10,43 @@ https://www.rechtspraak.nl/Uitspraken/paginas/open-data.aspx
 
 If you want to save time, and server load for them, you would probably start with fetching OpenDataUitspraken.zip via
 https://www.rechtspraak.nl/Uitspraken/paginas/open-data.aspx and inserting those so you can avoid 3+ million fetches.
+See import_opendata_zip(), which puts them in a store the same way cached_fetch() on the search results' 'xml' URLs would.
 
 
 There is an API at https://uitspraken.rechtspraak.nl/api/zoek that backs the website search
 I'm not sure whether we're supposed to use it like this, but it's one of the better APIs I've seen in this context :)
 '''
 
+import os
+import io
 import json
 import re
+import queue
+import zipfile
+import threading
+import math
+import datetime
+import collections
 import urllib.parse
+import concurrent.futures
 
 import requests
+import lxml.etree
 
 import wetsuite.helpers.net
 import wetsuite.helpers.etree
 import wetsuite.helpers.escape
 import wetsuite.helpers.koop_parse
+import wetsuite.helpers.date
+import wetsuite.helpers.localdata
 
 
 BASE_URL = "https://data.rechtspraak.nl/"
 ' base URL for search as well as value lists '
 
+CONTENT_URL = "https://data.rechtspraak.nl/uitspraken/content?id="
+' the URL to fetch a document by its ECLI, when you append that ECLI '
+
 def search(params):
     ''' 
     Post a search to the public API on data.rechtspraak.nl,
@@ -86,106 +102,345 @@ def parse_search_results(tree):
           - 'xml' is augmented based on the ecli and does not come from the search results
           - keys may be missing (in practice probably just summary?)
     '''
-    tree = wetsuite.helpers.etree.strip_namespace(tree)
     # tree.find('subtitle') # its .text will be something like 'Aantal gevonden ECLI's: 3178259'
     ret = []
-    for entry in tree.findall('entry'):
-        entry_dict = {#'links':[]
-                      }
-        for ch in entry.getchildren():
-            if ch.tag=='id':
-                entry_dict['ecli'] = ch.text
-                entry_dict['xml'] = 'https://data.rechtspraak.nl/uitspraken/content?id='+ch.text
-            elif ch.tag=='title':
-                entry_dict['title'] = ch.text
-            elif ch.tag=='summary':
-                txt = ch.text
-                if txt!='-':
-                #    txt = ''
-                    entry_dict['summary'] = txt
-            elif ch.tag=='updated':
-                entry_dict['updated'] = ch.text
-            elif ch.tag=='link':
-                entry_dict['link'] = ch.get('href')
-                #entry_dict['links'].append( ch.get('href') ) # maybe also type?
-            else: # don't think this happens, but it'd be good to know when it does.
-                raise ValueError( "Don't understand tag %r"%wetsuite.helpers.etree.tostring(ch) )
-        ret.append( entry_dict )
+    for entry in tree:
+        if _localname( entry.tag ) == 'entry':
+            ret.append( _entry_dict( entry ) )
     return ret
 
 
-def _para_text(treenode):
-    ' TODO: '
-    ret = []
+def _localname(tag):
+    ' "{http://www.w3.org/2005/Atom}entry" -> "entry", so that we can look at trees without making a namespace-stripped copy '
+    if not isinstance(tag, str): # comments and processing instructions
+        return None
+    return tag.rsplit('}', 1)[-1]
 
-    for ch in treenode.getchildren():
 
-        if isinstance(ch, (wetsuite.helpers.etree._Comment, wetsuite.helpers.etree._ProcessingInstruction)):
+def _entry_dict(entry):
+    ' parse one search result entry node into a dict, see parse_search_results() '
+    entry_dict = {#'links':[]
+                  }
+    for ch in entry:
+        tag = _localname( ch.tag )
+        if tag is None:
             continue
-
-        if ch.tag in ('para', 'title', 'bridgehead', 'nr',
-                      'footnote', 'blockquote'):
-            if len( ch.getchildren() )>0:
-                # HACK: just assume it's flattenable
-                ret.extend( wetsuite.helpers.etree.all_text_fragments( ch ) )
-                #raise ValueError("para has children")
+        if tag=='id':
+            entry_dict['ecli'] = ch.text
+            entry_dict['xml'] = CONTENT_URL+ch.text
+        elif tag=='title':
+            entry_dict['title'] = ch.text
+        elif tag=='summary':
+            txt = ch.text
+            if txt!='-':
+            #    txt = ''
+                entry_dict['summary'] = txt
+        elif tag=='updated':
+            entry_dict['updated'] = ch.text
+        elif tag=='link':
+            entry_dict['link'] = ch.get('href')
+            #entry_dict['links'].append( ch.get('href') ) # maybe also type?
+        else: # don't think this happens, but it'd be good to know when it does.
+            raise ValueError( "Don't understand tag %r"%wetsuite.helpers.etree.tostring(ch) )
+    return entry_dict
+
+
+def _iter_search_feed(chunks):
+    ''' Incrementally parses a search result feed, given as an iterable of bytes chunks, 
+        and yields ('count', int) (once, if the feed says) and ('entry', dict) for each entry as soon as it is complete.
+        Entries are removed from the tree once handled, so this never holds more than a little of the document.
+    '''
+    parser = lxml.etree.XMLPullParser( events=('end',) )
+    def events():
+        for _, elem in parser.read_events():
+            tag = _localname( elem.tag )
+            if tag == 'subtitle':
+                match = re.search(r'([0-9]+)', elem.text or '')
+                if match is not None:
+                    yield 'count', int( match.group(1) )
+            elif tag == 'entry':
+                yield 'entry', _entry_dict( elem )
             else:
-                if ch.text is None:
-                    ret.append('')
-                else:
-                    ret.append(ch.text)
-
-
-        elif ch.tag in ('orderedlist','itemizedlist'):
-            ret.append('')
-            ret.extend(_para_text(ch))
-            ret.append('')
-
-        elif ch.tag in ('listitem',):
-            ret.append('')
-            ret.extend(_para_text(ch))
-            ret.append('')
+                continue
+            # drop what we handled, and anything before it, to keep the tree small
+            elem.clear()
+            parent = elem.getparent()
+            if parent is not None:
+                while elem.getprevious() is not None:
+                    del parent[0]
+    for chunk in chunks:
+        parser.feed( chunk )
+        yield from events()
+    parser.close()
+    yield from events()
+
+
+def search_iter(params, chunk_size=65536):
+    ''' Like search() followed by parse_search_results(), but parses the response while it downloads,
+        and yields each entry dict as soon as it is complete, rather than building the whole tree 
+        (and then the namespace-stripped copy that parse_search_results used to make).
+        @param params: see search()
+    '''
+    for kind, value in _search_iter_events( params, chunk_size ):
+        if kind == 'entry':
+            yield value
 
 
-        elif ch.tag in ('informaltable', 'table'):
-            ret.append('')
-            # HACK: just pretend it's flattenable
-            ret.extend( wetsuite.helpers.etree.all_text_fragments( ch ) )
-            ret.append('')
-        #elif ch.tag in ('tgroup','colspec','tobody','row','entry',''):
-        #    ret.append('')
-        #    ret.append(_para_text(ch))
-        #   ret.append('')
+def _search_iter_events(params, chunk_size=65536):
+    ' the fetching part of search_iter, yielding what _iter_search_feed does '
+    url = urllib.parse.urljoin(BASE_URL, "/uitspraken/zoeken?"+urllib.parse.urlencode(params))
+    response = wetsuite.helpers.net.get( url, stream=True, timeout=30 )
+    if not response.ok:
+        raise ValueError( str(response.status_code) )
+    yield from _iter_search_feed( response.iter_content( chunk_size=chunk_size ) )
 
 
-        elif ch.tag in ('mediaobject','inlinemediaobject','imageobject', 'imagedata'):
-            pass
+def search_result_count(tree):
+    ''' Takes search result etree (as given by search()), and returns how many results there are in total
+        (which can be more than the amount of entries in it), from its subtitle, which looks like "Aantal gevonden ECLI's: 3178259".
+        Returns None if that is not there.
+    '''
+    for subtitle in tree.iter('{http://www.w3.org/2005/Atom}subtitle', 'subtitle'):
+        match = re.search(r'([0-9]+)', subtitle.text or '')
+        if match is not None:
+            return int( match.group(1) )
+    return None
+
+
+def _harvest_fetch(field:str, params, part, max_per_request:int):
+    ' Runs in a worker thread: searches for one partition, returns (total count, list of entry dicts) '
+    frm, to, offset = part
+    if field == 'modified': # which wants a datetime
+        frm, to = frm+'T00:00:00', to+'T23:59:59'
+    count, entries = None, []
+    for kind, value in _search_iter_events( list(params) + [ (field, frm), (field, to), ('max', str(max_per_request)), ('from', str(offset)) ] ):
+        if kind == 'count':
+            count = value
+        else:
+            entries.append( value )
+    return count, entries
+
+
+def harvest_search(from_date, to_date, field:str='date', params=(), increment_days:int=31, workers:int=4,
+                   max_per_request:int=1000, state_store=None, state_name:str='rechtspraaknl_harvest', verbose:bool=False):
+    ''' Enumerates everything in a date range, which search() alone will not do because it gives at most 1000 results at a time.
+
+        Splits the range into parts of increment_days (see wetsuite.helpers.date.date_ranges), 
+        and searches for those in parallel. 
+        Any part with more results than fit in one search is split in half, recursively, 
+        down to a single day, which (if still necessary) is paged through.
+        (If a search result does not mention how many results there are, we instead page through that part until a page comes back short)
+
+        This is a generator that yields the same dicts that parse_search_results() gives, as they come in
+        (so not in date order).
+
+        @param from_date: start of the range, as a date, datetime, or string (see date_ranges)
+        @param to_date: end of the range, inclusive
+        @param field: 'date' (of the decision) or 'modified' (of the entry)
+        @param params: any further search() parameters, e.g. [('return','DOC')]
+        @param increment_days: the initial partition size. Smaller means more initial requests, larger means more splitting.
+        @param workers: how many searches to do at the same time.
+        Consider also wetsuite.helpers.net.rate_limit('rechtspraak.nl', ...) to limit the rate rather than just the concurrency.
+        @param max_per_request: the 'max' search parameter
+        @param state_store: if not None, a MsgpackKV we keep the partitions still to do in, under state_name, 
+        so that an interrupted harvest continues where it was (and a finished one yields nothing; use another state_name, or delete that key).
+        A partition only counts as done after you have taken all its entries from this generator, 
+        so an interruption can lead to some entries being given twice, but none being lost.
+        @param state_name: see state_store
+        @param verbose: print what we are doing with which partitions
+    '''
+    if field not in ('date', 'modified'):
+        raise ValueError("field should be 'date' or 'modified', not %r"%field)
+
+    state = None
+    if state_store is not None:
+        state = state_store.get( state_name, missing_as_none=True )
+    if state is None:
+        pending = collections.deque( [frm, to, 0]  for frm, to in wetsuite.helpers.date.date_ranges(
+            from_date, to_date, increment_days, strftime_format='%Y-%m-%d', overlap=False ) )
+    else:
+        pending = collections.deque( state['pending'] )
+
+    in_flight = {} # future -> part
+    def save_state():
+        if state_store is not None:
+            state_store.put( state_name, {'pending': list( in_flight.values() ) + list( pending )} )
+    save_state()
+
+    pool = concurrent.futures.ThreadPoolExecutor( max_workers=workers )
+    try:
+        while len(pending) > 0  or  len(in_flight) > 0:
+            while len(pending) > 0  and  len(in_flight) < workers:
+                part = pending.popleft()
+                in_flight[ pool.submit( _harvest_fetch, field, params, part, max_per_request ) ] = part
+
+            done, _ = concurrent.futures.wait( in_flight, return_when=concurrent.futures.FIRST_COMPLETED )
+            for future in done:
+                part = in_flight[future]
+                count, entries = future.result() # if this raises, part is still in the saved state
+                frm, to, offset = part
+
+                if count is not None  and  count > max_per_request  and  offset == 0:
+                    if frm != to:   # split in half (and ignore these entries, the halves will get them)
+                        days = ( datetime.date.fromisoformat(to) - datetime.date.fromisoformat(frm) ).days + 1
+                        halves = wetsuite.helpers.date.date_ranges( frm, to, math.ceil(days/2), strftime_format='%Y-%m-%d', overlap=False )
+                        if verbose:
+                            print( 'SPLIT %s..%s (%d results) into %s'%(frm, to, count, halves) )
+                        pending.extend( [h_frm, h_to, 0]  for h_frm, h_to in halves )
+                        entries = []
+                    else:           # a single day with too many results - page through it
+                        if verbose:
+                            print( 'PAGING %s (%d results)'%(frm, count) )
+                        pending.extend( [frm, to, page_offset]  for page_offset in range(max_per_request, count, max_per_request) )
+                elif count is None  and  len(entries) >= max_per_request:
+                    # The feed did not say how many there are, so we cannot plan splits or pages. 
+                    # A full page may not be all of it, so ask for the next one, until a page comes back short.
+                    if verbose:
+                        print( 'GOT %s..%s offset %d (%d results, no count, so asking for more)'%(frm, to, offset, len(entries)) )
+                    pending.append( [frm, to, offset + len(entries)] )
+                elif verbose:
+                    print( 'GOT %s..%s offset %d (%d results)'%(frm, to, offset, len(entries)) )
+
+                yield from entries
+                del in_flight[future]
+                save_state()
+    finally:
+        pool.shutdown( wait=False, cancel_futures=True )
+
+
+_re_ecli_filename = re.compile( r'^ECLI_[A-Z]{2}_[A-Za-z0-9.]{1,7}_[0-9]{4}_[A-Za-z0-9.]{1,25}$' )
+
+def _ecli_from_filename(name:str):
+    " e.g. '2021/202101/ECLI_NL_RBAMS_2021_1234.xml' -> 'ECLI:NL:RBAMS:2021:1234', or None if it does not look like that "
+    base = os.path.basename( name )
+    if not base.endswith('.xml'):
+        return None
+    base = base[:-4]
+    if _re_ecli_filename.match( base ) is None:
+        return None
+    return base.replace('_', ':')
+
+
+def _opendata_inner_worker(zip_path:str, inner_name:str, store_path:str, out_queue, stop):
+    ''' Runs in a thread: reads one inner (year/month) archive from the outer zip, 
+        puts (key, xmlbytes) on out_queue for each document not already in the store, 
+        and ('DONE', skipped_count) at the end.
+        Each thread opens the outer zip itself, because ZipFile objects should not be shared between threads,
+        and opens the store itself (read-only), so that it only sees what the writing thread committed.
+        (That is enough, because each document is in only one inner archive)
+        If store_path is None (e.g. an in-memory store), we skip nothing, and leave that to the writing thread.
+    '''
+    skipped = 0
+    store = None
+    if store_path is not None:
+        store = wetsuite.helpers.localdata.LocalKV( store_path, None, None, read_only=True )
+    with zipfile.ZipFile( zip_path ) as outer:
+        info = outer.getinfo( inner_name )
+        if info.compress_type == zipfile.ZIP_STORED:
+            inner_file = outer.open( info )  # seekable, and cheaply so when not compressed
+        else:
+            inner_file = io.BytesIO( outer.read( info ) ) # seeking in a compressed member means decompressing again, so take it into memory
+        with zipfile.ZipFile( inner_file ) as inner:
+            for name in inner.namelist():
+                if stop.is_set():
+                    break
+                ecli = _ecli_from_filename( name )
+                if ecli is None:
+                    continue
+                key = CONTENT_URL + ecli
+                if store is not None  and  key in store:
+                    skipped += 1
+                    continue
+                out_queue.put( (key, inner.read( name )) )
+    if store is not None:
+        store.close()
+    out_queue.put( ('DONE', skipped) )
+
+
+def import_opendata_zip(zip_path:str, store, batch_size:int=1000, workers:int=None, verbose:bool=False):
+    ''' Inserts the documents from rechtspraak.nl's OpenDataUitspraken.zip into a store,
+        without extracting anything to disk.
+        That zip contains a zip per month, which contain an XML file per ECLI.
+
+        Keys are the same content URLs that parse_search_results() gives you as 'xml' (see CONTENT_URL),
+        so the result is what you would get from cached_fetch() on those, and you can keep using that to update it.
+
+        @param zip_path: path to the downloaded OpenDataUitspraken.zip
+        @param store: a str:bytes LocalKV. Documents already in there are skipped, so you can also resume an interrupted import.
+        @param batch_size: commit every this many documents (much faster than committing each)
+        @param workers: how many inner archives to decompress at the same time (zlib does that outside the GIL, so threads help).
+        Defaults to the amount of CPUs, up to 4.
+        @param verbose: print progress per inner archive
+        @return: (amount inserted, amount skipped because they were already there)
+    '''
+    if workers is None:
+        workers = min(4, os.cpu_count() or 1)
+
+    with zipfile.ZipFile( zip_path ) as outer:
+        inner_names = list( name  for name in outer.namelist()  if name.lower().endswith('.zip') )
+
+    # bounded, so that decompression cannot run arbitrarily far ahead of the writing
+    out_queue = queue.Queue( maxsize=batch_size * 2 )
+    stop = threading.Event()
+    inserted, skipped, uncommitted, done = 0, 0, 0, 0
+    pool = concurrent.futures.ThreadPoolExecutor( max_workers=workers )
+    try:
+        store_path = None  if store.path == ':memory:'  else  store.path
+        futures = list( pool.submit( _opendata_inner_worker, zip_path, inner_name, store_path, out_queue, stop )  for inner_name in inner_names )
+        while done < len(futures):
+            try:
+                key, value = out_queue.get( timeout=1 )
+            except queue.Empty:
+                for future in futures: # a worker that failed will never say DONE, so check for that
+                    if future.done() and future.exception() is not None:
+                        raise future.exception()
+                continue
+
+            if key == 'DONE':
+                done    += 1
+                skipped += value
+                if verbose:
+                    print( 'inner archives: %d/%d,  inserted %d, skipped %d'%(done, len(futures), inserted, skipped) )
+                continue
+
+            if store_path is None  and  key in store:
+                skipped += 1
+                continue
+            store.put( key, value, commit=False )
+            inserted    += 1
+            uncommitted += 1
+            if uncommitted >= batch_size:
+                store.commit()
+                uncommitted = 0
+    finally:
+        stop.set()
+        while not out_queue.empty(): # unblock workers waiting to put, so they can notice stop
+            out_queue.get_nowait()
+        pool.shutdown( wait=False, cancel_futures=True )
+        if uncommitted > 0:
+            store.commit()
+    return inserted, skipped
+
+
+_PARA_CONTAINER_TAGS = ('orderedlist', 'itemizedlist', 'listitem', 'section', 'parablock', 'paragroup')
+' the elements that _para_text recurses into, with an empty line before and after their contents '
 
-        elif ch.tag =='uitspraak.info':
-            #TODO: parse this
-            pass
-        elif ch.tag =='conclusie.info':
-            #TODO: parse this
-            pass
+def _para_text(treenode):
+    ' TODO: '
+    ret = []
 
-        elif ch.tag =='section':
-            ret.append('')
-            ret.extend(_para_text(ch))
-            ret.append('')
+    for ch in treenode.getchildren():
 
-        elif ch.tag =='parablock':
-            ret.append('')
-            ret.extend(_para_text(ch))
-            ret.append('')
+        if isinstance(ch, (wetsuite.helpers.etree._Comment, wetsuite.helpers.etree._ProcessingInstruction)):
+            continue
 
-        elif ch.tag =='paragroup':
+        tag = _localname( ch.tag ) # so that this works on trees with or without namespaces
+        if tag in _PARA_CONTAINER_TAGS:
             ret.append('')
             ret.extend(_para_text(ch))
             ret.append('')
-
         else:
-            raise ValueError("Do not understand tag name %r"%ch.tag)
-
+            ret.extend( _para_leaf_text(ch, tag) )
 
     return ret # '\n'.join( ret )
 
@@ -216,64 +471,189 @@ def _para_text(treenode):
     # return ret
 
 
+def _para_leaf_text(ch, tag):
+    ' for _para_text: the text fragments for one node that is not in _PARA_CONTAINER_TAGS (raises ValueError for tags we do not know) '
+    ret = []
+    if tag in ('para', 'title', 'bridgehead', 'nr',
+                  'footnote', 'blockquote'):
+        if len( ch.getchildren() )>0:
+            # HACK: just assume it's flattenable
+            ret.extend( wetsuite.helpers.etree.all_text_fragments( ch ) )
+            #raise ValueError("para has children")
+        else:
+            if ch.text is None:
+                ret.append('')
+            else:
+                ret.append(ch.text)
+
+    elif tag in ('informaltable', 'table'):
+        ret.append('')
+        # HACK: just pretend it's flattenable
+        ret.extend( wetsuite.helpers.etree.all_text_fragments( ch ) )
+        ret.append('')
+    #elif tag in ('tgroup','colspec','tobody','row','entry',''):
+    #    ret.append('')
+    #    ret.append(_para_text(ch))
+    #   ret.append('')
+
+    elif tag in ('mediaobject','inlinemediaobject','imageobject', 'imagedata'):
+        pass
+
+    elif tag =='uitspraak.info':
+        #TODO: parse this
+        pass
+    elif tag =='conclusie.info':
+        #TODO: parse this
+        pass
+
+    else:
+        raise ValueError("Do not understand tag name %r"%ch.tag)
+
+    return ret
+
+
 def parse_content(tree):
     '''
     Parse the type of XML you get when you stick an ECLI onto  https://data.rechtspraak.nl/uitspraken/content?id=
     and tries to give you metadata and text. 
     CONSIDER: separating those
 
+    Works on the tree as-is (namespaces and all), without making a namespace-stripped copy. 
+    See also parse_content_stream(), which does the same on the bytes, without ever having the whole tree in memory.
+
     @return: a dict with TODO
         
     TODO: actually read the schema - see https://www.rechtspraak.nl/Uitspraken/paginas/open-data.aspx
     '''
     ret = {}
-    tree = wetsuite.helpers.etree.strip_namespace( tree )
+    if hasattr(tree, 'getroot'):
+        tree = tree.getroot()
+
+    for rdf in tree:
+        if _localname( rdf.tag ) == 'RDF':
+            for descr in rdf:
+                if _localname( descr.tag ) == 'Description': # TODO: figure out why there are multiple
+                    _content_description( ret, descr )
+                    break # for now assume that the most recent update (RDF/Description block) is the first, and the most detailed
+            break
+
+    sections = {}
+    for elem in tree:
+        tag = _localname( elem.tag )
+        if tag in _CONTENT_SECTION_TAGS  and  tag not in sections: # first, like find() would
+            sections[tag] = _para_text( elem )
+    _content_sections( ret, sections )
 
-    for descr in tree.findall('RDF/Description'): # TODO: figure out why there are multiple
-        for key in ('identifier', 'issued', 'publisher', 'replaces', 'date', 'type',  # maybe make this a map so we can give it better names
-                    #'format', 'language',
-                    'modified',
-                    'zaaknummer', 
-                    'title', 
-                    'creator', 'subject',
+    return ret
 
-                    # TODO: inspect to see whether they need specialcasing. And in general which things can appear multiple times
-                    'spatial',
-                    #'procedure', # can have multiple
 
-                    ):
-            kelem = descr.find(key)
-            if kelem is not None:
-                ret[key] = kelem.text
+_CONTENT_DESCRIPTION_KEYS = ('identifier', 'issued', 'publisher', 'replaces', 'date', 'type',  # maybe make this a map so we can give it better names
+                             #'format', 'language',
+                             'modified',
+                             'zaaknummer', 
+                             'title', 
+                             'creator', 'subject',
 
-        # things where we want attributes
-        #creator, subject, relation
+                             # TODO: inspect to see whether they need specialcasing. And in general which things can appear multiple times
+                             'spatial',
+                             #'procedure', # can have multiple
+                            )
 
-        # other specific cases
-        #hasVersion
+def _content_description(ret, descr):
+    ' for parse_content: takes metadata from a RDF/Description node into ret '
+    for kelem in descr:
+        key = _localname( kelem.tag )
+        if key in _CONTENT_DESCRIPTION_KEYS  and  key not in ret: # first, like find() would
+            ret[key] = kelem.text
 
-        break # for now assume that the most recent update (RDF/Description block) is the first, and the most detailed
+    # things where we want attributes
+    #creator, subject, relation
 
-    #for elem in list(RDF):
-    #    print( wetsuite.helpers.etree.debug_pretty(elem))
-    #ret['identifier'] = RDF.find
+    # other specific cases
+    #hasVersion
 
-    inhoudsindicatie = tree.find('inhoudsindicatie')
-    if inhoudsindicatie is not None:
-        ret['inhoudsindicatie'] = re.sub(  '[\n]{2,}','\n\n',   '\n'.join( _para_text( inhoudsindicatie ) )  )
 
-    conclusie = tree.find('conclusie')
-    if conclusie is not None:
-        ret['bodytext'] = re.sub(  '[\n]{2,}','\n\n',   '\n'.join( _para_text( conclusie ) )  )
-        #_, t = _para_text( uitspraak )
-        #ret['conclusie'] = ' '.join(t)
+_CONTENT_SECTION_TAGS = ('inhoudsindicatie', 'conclusie', 'uitspraak')
 
-    uitspraak = tree.find('uitspraak')
-    if uitspraak is not None:
-        ret['bodytext'] = re.sub(  '[\n]{2,}','\n\n',   '\n'.join( _para_text( uitspraak ) )  )
-        #_, t = _para_text( uitspraak )
-        #ret['uitspraak'] = ' '.join(t)
+def _content_sections(ret, sections):
+    ''' for parse_content: takes the text of the inhoudsindicatie, conclusie, and uitspraak nodes into ret.
+        sections maps each of those tags (if present) to the _para_text fragments of the first such node.
+        If there is both a conclusie and an uitspraak, the uitspraak is the bodytext.
+    '''
+    if 'inhoudsindicatie' in sections:
+        ret['inhoudsindicatie'] = re.sub(  '[\n]{2,}','\n\n',   '\n'.join( sections['inhoudsindicatie'] )  )
+    for tag in ('uitspraak', 'conclusie'):
+        if tag in sections:
+            ret['bodytext'] = re.sub(  '[\n]{2,}','\n\n',   '\n'.join( sections[tag] )  )
+            break
+
+
+def parse_content_stream(source):
+    ''' Does the same as parse_content(), but on the XML itself, parsing it incrementally:
+        each part is handled as soon as it is complete, then removed. 
+        Inside the inhoudsindicatie, conclusie, and uitspraak, that goes down to paragraph level (para, title, table, and such, 
+        with section, paragroup, and such handled at their start and end), so memory use stays at about the size of the largest paragraph
+        rather than the whole document.
+
+        @param source: the XML as bytes, or a file object (e.g. from zipfile.open(), or open(path,'rb'))
+        @return: the same dict as parse_content() gives
+    '''
+    if isinstance(source, bytes):
+        source = io.BytesIO( source )
+    ret = {}
+    seen_description = False
+    sections = {}    # see _content_sections
+    fragments = None # the list in sections that we are currently adding to
+    # what each currently open element is to us:
+    #   'root';  'section' for the first inhoudsindicatie/conclusie/uitspraak;  'other' for the root's other children;
+    #   'container' and 'leaf' for what is in a section (see _para_text);  'inside' for what is in an 'other' or 'leaf' (handled as part of that)
+    roles = []
+    for event, elem in lxml.etree.iterparse( source, events=('start', 'end') ):
+        if event == 'start':
+            tag = _localname( elem.tag )
+            if len(roles) == 0:
+                role = 'root'
+            elif roles[-1] == 'root':
+                if tag in _CONTENT_SECTION_TAGS  and  tag not in sections:
+                    role = 'section'
+                    fragments = sections[tag] = []
+                else:
+                    role = 'other'
+            elif roles[-1] in ('section', 'container'):
+                if tag in _PARA_CONTAINER_TAGS:
+                    role = 'container'
+                    fragments.append('')
+                else:
+                    role = 'leaf'
+            else:
+                role = 'inside'
+            roles.append( role )
+            continue
 
+        role = roles.pop()
+        if role == 'root': # which ends last
+            break
+        elif role == 'inside':
+            parent = elem.getparent()
+            if _localname( elem.tag ) == 'Description'  and  _localname( parent.tag ) == 'RDF'  and  roles[-1] == 'other':
+                if not seen_description: # see the note in parse_content
+                    _content_description( ret, elem )
+                    seen_description = True
+            continue # otherwise left to whatever contains it
+        elif role == 'leaf':
+            fragments.extend( _para_leaf_text( elem, _localname( elem.tag ) ) )
+        elif role == 'container':
+            fragments.append('')
+        elif role == 'section':
+            fragments = None
+
+        # we are done with this element, and with what came before it
+        elem.clear()
+        parent = elem.getparent()
+        while elem.getprevious() is not None:
+            del parent[0]
+
+    _content_sections( ret, sections )
     return ret
 
 
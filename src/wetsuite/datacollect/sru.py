@@ -15,9 +15,12 @@ here's a just-enough-to-work implementation for our specific use cases.
 # https://www.loc.gov/standards/sru/sru-1-1.html
 
 import time, sys
+import collections
+import concurrent.futures
 
 import requests
 
+import wetsuite.helpers.net
 import wetsuite.helpers.escape
 import wetsuite.helpers.etree
 
@@ -25,6 +28,13 @@ import wetsuite.helpers.etree
 # TODO: centralize parsing of originalData / enrichedData as much as we can, so that each individual user doesn't have to.
 
 
+class SRUServerError(ValueError):
+    ''' The SRU server answered with a server error (HTTP 5xx) or said we were going too fast (HTTP 429), 
+        which is likely to be transient, so worth retrying.  
+        (A ValueError, as search_retrieve raised before there was this more specific one)
+    '''
+
+
 
 class SRUBase:
     ' Very minimal SRU implementation - just enough to access the KOOP repositories. '
@@ -74,7 +84,7 @@ class SRUBase:
         '''
         url = self._url()
         url += '&operation=explain'
-        r = requests.get( url, timeout=timeout )
+        r = wetsuite.helpers.net.get( url, timeout=timeout )
         if readable:
             tree = wetsuite.helpers.etree.fromstring(r.content)
             if strip_namespaces is True:
@@ -98,7 +108,7 @@ class SRUBase:
 
         if self.verbose:
             print( url )
-        r = requests.get( url, timeout=timeout )
+        r = wetsuite.helpers.net.get( url, timeout=timeout )
         tree = wetsuite.helpers.etree.fromstring( r.content )
         tree = wetsuite.helpers.etree.strip_namespace( tree ) # easier without namespaces
 
@@ -218,13 +228,12 @@ class SRUBase:
             print( "[SRU searchRetrieve] fetching %r"%url )
 
         try:
-            r = requests.get( url, timeout=(20,20) ) # CONSIDER: use general fetcher?
+            r = wetsuite.helpers.net.get( url, timeout=(20,20) )
         except requests.exceptions.ReadTimeout:
-            r = requests.get( url, timeout=(20,20) ) # TODO: this makes no sense, don't do it
+            r = wetsuite.helpers.net.get( url, timeout=(20,20) ) # TODO: this makes no sense, don't do it
 
-        if r.status_code == 500:
-            raise ValueError( "SRU server reported an Internal Server Error (HTTP status 500) for %r"%url )
-            #raise RuntimeError( "SRU server reported an Internal Server Error (HTTP status 500) for %r"%url )
+        if r.status_code >= 500  or  r.status_code == 429:
+            raise SRUServerError( "SRU server reported an error (HTTP status %d) for %r"%(r.status_code, url) )
 
         tree = wetsuite.helpers.etree.fromstring( r.content )
 
@@ -260,6 +269,9 @@ class SRUBase:
                              at_a_time:int=10, start_record:int=1, up_to:int=250,
                              callback=None,
                              wait_between_sec:float=0.5,
+                             workers:int=1,
+                             adaptive:bool=False,
+                             page_size_store=None,
                              verbose:bool=False):
         ''' This function builds on search_retrieve() to "fetch _many_ results results in chunks", by calling search_retrieve() repeatedly.
             (search_retrieve() will have a limit on how many to search at once, though is still useful to see e.g. if there are results at all)
@@ -269,6 +281,9 @@ class SRUBase:
              - and if callback is not None, this will be called on each result _during_ the fetching process.
                (this can be more convenient way of dealing with many results while they come in)
 
+            Note that this keeps all records (and with them, all response documents) in memory until the end.
+            For large result sets, you probably want L{iter_search_retrieve} instead.
+
             @param query:            like in search_retrieve()
             @param start_record:     like in search_retrieve()
             @param callback:         like in search_retrieve()
@@ -277,30 +292,106 @@ class SRUBase:
             @param wait_between_sec: a backoff sleep between each search request, to avoid hammering a server too much.
             you can lower this where you know this is overly cautious
             note that we skip this sleep if one fetch was enough
+            @param workers:          fetch pages concurrently, see L{iter_search_retrieve}
+            @param adaptive:         vary the page size, see L{iter_search_retrieve}
+            @param page_size_store:  remember the learned page size there, see L{iter_search_retrieve}
 
             since we fetch in chunks, we may overshoot in the last fetch, by up to at_a_time amount of entries
             The code should avoid returning those.
-
-            CONSIDER: 
-              - maybe yield something including numberOfRecords before yielding results?
         '''
         ret = []
+        for record in self.iter_search_retrieve(query=query, at_a_time=at_a_time, start_record=start_record, up_to=up_to,
+                                                wait_between_sec=wait_between_sec, workers=workers, adaptive=adaptive,
+                                                page_size_store=page_size_store, verbose=verbose):
+            ret.append( record )
+            if callback is not None:
+                callback( record )
+        return ret
+
+
+    def iter_search_retrieve(self, query:str,
+                             at_a_time:int=10, start_record:int=1, up_to:int=250,
+                             wait_between_sec:float=0.5,
+                             workers:int=1, retries:int=3,
+                             adaptive:bool=False,
+                             page_size_store=None,
+                             verbose:bool=False):
+        ''' Like search_retrieve_many(), but returns a generator that yields records as each page comes in, 
+            instead of collecting them all into a list.
+            We only hold on to one response document at a time, so as long as you don't keep the records around, 
+            memory use stays at about one page, regardless of how many records you go through.
+
+            The first page is fetched when you call this (not when you first iterate), 
+            so that num_records() is filled in before you start consuming, e.g.::
+                records = cvdr.iter_search_retrieve('workid = CVDR101405', up_to=100000)
+                print( cvdr.num_records() )
+                for record in records:
+                    ...
+
+            Note that each record is still part of its response document, so keeping a record keeps that document alive.
+            If you want to keep only some records around, consider copy.deepcopy() on them.
+
+            @param query:            like in search_retrieve()
+            @param at_a_time:        like in search_retrieve_many()
+            @param start_record:     like in search_retrieve_many()
+            @param up_to:            like in search_retrieve_many()
+            @param wait_between_sec: like in search_retrieve_many()
+            When workers>1, this is instead the minimum time between the _start_ of any two requests,
+            so it is still a bound on how often the server sees us, but we don't spend the request's latency idle.
+            @param workers: if more than 1, then after the first page we know numberOfRecords, 
+            so can plan all the startRecord offsets, and fetch the remaining pages using this many threads.
+            Records are still yielded in order.
+            @param retries: when workers>1, how often to retry a page on what looks like a transient failure 
+            (timeouts, connection errors, and server errors, see L{SRUServerError}), with some backoff.
+            @param adaptive: if True, vary the page size (starting at at_a_time, or what we learned earlier for this repository):
+            grow it while responses are fast and error-free, shrink it on slow responses, timeouts, and server errors (retrying that page smaller).
+            See L{AdaptivePageSize}. Cannot currently be combined with workers>1.
+            @param page_size_store: if adaptive, and this is not None, a store (e.g. a MsgpackKV) that the learned page size 
+            is read from and saved into, so that it also survives between runs.  See L{page_size_controller}.
+            @return: a generator of record elements
+        '''
+        if adaptive:
+            if workers > 1:
+                raise ValueError("adaptive page sizes and workers>1 cannot currently be combined")
+            controller = self.page_size_controller( initial=at_a_time, store=page_size_store )
+            records, at_a_time = self._search_retrieve_adaptive(query=query, start_record=start_record, controller=controller, retries=retries,
+                                                                store=page_size_store, verbose=verbose)
+            return self._iter_search_retrieve_pages(records, query=query, at_a_time=at_a_time, start_record=start_record, up_to=up_to,
+                                                    wait_between_sec=wait_between_sec, verbose=verbose, controller=controller, retries=retries,
+                                                    page_size_store=page_size_store)
+
+        records = self.search_retrieve(query=query, start_record=start_record, maximum_records=at_a_time, callback=None, verbose=verbose)
+        if workers > 1:
+            return self._iter_search_retrieve_parallel(records, query=query, at_a_time=at_a_time, start_record=start_record, up_to=up_to,
+                                                       wait_between_sec=wait_between_sec, workers=workers, retries=retries, verbose=verbose)
+        return self._iter_search_retrieve_pages(records, query=query, at_a_time=at_a_time, start_record=start_record, up_to=up_to,
+                                                wait_between_sec=wait_between_sec, verbose=verbose)
+
+
+    def _iter_search_retrieve_pages(self, records, query:str, at_a_time:int, start_record:int, up_to:int, wait_between_sec:float, verbose:bool,
+                                    controller=None, retries:int=3, page_size_store=None):
+        ''' Helper for iter_search_retrieve, that starts with an already-fetched first page of records. 
+            If controller is not None, at_a_time is what the first page was fetched with, and later page sizes come from that controller
+            (which is saved into page_size_store, if that is not None).
+        '''
         offset = start_record
 
         while True: # offset < up_to:
-            records = self.search_retrieve(query=query, start_record=offset, maximum_records=at_a_time, callback=None, verbose=verbose)
             if len(records)==0:
                 break
 
             for chunk_offset, record in enumerate(records):
-                ret.append( record )
-                if callback is not None:
-                    callback( record )
+                yield record
 
                 if offset+chunk_offset >= up_to: # we fetched more than was needed
                     break
 
-            offset += at_a_time
+            # what we got, not what we asked for: servers may return fewer than maximumRecords (e.g. when they cap it lower),
+            # and continuing from what we asked for would skip the records in between
+            got = len(records)
+            del records, record # don't keep the previous page's response document alive while we fetch the next
+
+            offset += got
 
             if offset >= up_to: # crossed beyond what was asked for  (we don't return it even if we fetched it)
                 break
@@ -310,4 +401,213 @@ class SRUBase:
 
             time.sleep( wait_between_sec ) # note that this is avoided if a single fetch was enough
 
+            if controller is None:
+                records = self.search_retrieve(query=query, start_record=offset, maximum_records=at_a_time, callback=None, verbose=verbose)
+            else:
+                records, at_a_time = self._search_retrieve_adaptive(query=query, start_record=offset, controller=controller, retries=retries,
+                                                                    store=page_size_store, verbose=verbose)
+
+
+    def _iter_search_retrieve_parallel(self, records, query:str, at_a_time:int, start_record:int, up_to:int,
+                                       wait_between_sec:float, workers:int, retries:int, verbose:bool):
+        ''' Helper for iter_search_retrieve, that fetches the pages after the (already-fetched) first one concurrently.
+            Which pages those are mirrors what _iter_search_retrieve_pages would do one at a time.
+        '''
+        if 0 < len(records) < at_a_time: # the server gives fewer per page than we asked for, so plan with what it gives
+            at_a_time = len(records)
+        offsets = []
+        offset = start_record + at_a_time
+        while offset < up_to  and  offset <= self.number_of_records:
+            offsets.append( offset )
+            offset += at_a_time
+
+        spacing = wetsuite.helpers.net.RequestSpacing( wait_between_sec )
+        def fetch_page(page_offset):
+            return self.search_retrieve_retrying(query=query, start_record=page_offset, maximum_records=at_a_time,
+                                                 retries=retries, spacing=spacing, verbose=verbose)
+
+        executor = concurrent.futures.ThreadPoolExecutor( max_workers=workers )
+        try:
+            in_flight = collections.deque() # of (offset, future), in order.  Bounded so that we don't fetch everything faster than you consume it.
+            planned   = collections.deque( offsets )
+            page_offset = start_record
+            while True:
+                if len(records)==0:
+                    break
+
+                for chunk_offset, record in enumerate(records):
+                    yield record
+                    if page_offset+chunk_offset >= up_to:
+                        break
+                del records, record
+
+                while len(planned) > 0  and  len(in_flight) < 2*workers:
+                    next_offset = planned.popleft()
+                    in_flight.append( (next_offset, executor.submit(fetch_page, next_offset)) )
+                if len(in_flight) == 0:
+                    break
+
+                page_offset, future = in_flight.popleft()
+                records = future.result() # raises if that page failed even after retrying
+        finally:
+            executor.shutdown( wait=False, cancel_futures=True ) # also if you stop consuming before we're done
+
+
+    def search_retrieve_retrying(self, query:str, start_record:int=None, maximum_records:int=None, retries:int=3, verbose:bool=False, spacing=None):
+        ''' Like search_retrieve(), but retries on things that look transient: timeouts, connection errors, and server errors (L{SRUServerError}),
+            waiting a little longer after each failure (2, 4, 8... seconds, up to a minute).
+            Anything else (e.g. diagnostics about your query, or a response we could not parse) is raised immediately.
+
+            Useful when you harvest something large, where an occasional hiccup of the server should not end the whole thing.
+
+            @param query:           like in search_retrieve()
+            @param start_record:    like in search_retrieve()
+            @param maximum_records: like in search_retrieve()
+            @param retries:         how many times to retry before we give up and raise the last error
+            @param verbose:         like in search_retrieve()
+            @param spacing:         mostly for internal use: a L{wetsuite.helpers.net.RequestSpacing}, waited on before each attempt
+            @return: a list of records, like search_retrieve()
+        '''
+        attempt = 0
+        while True:
+            if spacing is not None:
+                spacing.wait()
+            try:
+                return self.search_retrieve(query=query, start_record=start_record, maximum_records=maximum_records, callback=None, verbose=verbose)
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError, SRUServerError) as e:
+                attempt += 1
+                if attempt > retries:
+                    raise
+                if self.verbose:
+                    print( "[SRU searchRetrieve] retrying startRecord=%s after %r"%(start_record, e), file=sys.stderr )
+                time.sleep( min(60, 2**attempt) )
+
+
+
+    def page_size_controller(self, initial:int=10, store=None):
+        ''' Returns the L{AdaptivePageSize} for this repository, creating it if necessary (starting at the given size).
+            These are remembered per repository (base URL, x-connection, and extra_query) for the rest of this interpreter,
+            so that later harvests start at what earlier ones learned.
+
+            @param initial: the page size to start at, if we have not learned anything about this repository yet
+            @param store: if not None, a store (e.g. a MsgpackKV) to also look in, when we have not seen this repository 
+            yet in this interpreter, so that what an earlier run learned is not lost. 
+            (iter_search_retrieve(adaptive=True, page_size_store=...) saves the controller's state into it as it learns)
+        '''
+        key = (self._url(), self.extra_query)
+        if key not in _page_size_controllers:
+            stored = None
+            if store is not None:
+                stored = store.get( self._page_size_store_key(), missing_as_none=True )
+            if stored is not None:
+                _page_size_controllers[key] = AdaptivePageSize.from_dict( stored )
+            else:
+                _page_size_controllers[key] = AdaptivePageSize( initial=initial )
+        return _page_size_controllers[key]
+
+
+    def _page_size_store_key(self) -> str:
+        ' the key that page_size_controller() and _search_retrieve_adaptive() use in a page size store '
+        return '%s %s'%(self._url(), self.extra_query or '')
+
+
+    def _search_retrieve_adaptive(self, query:str, start_record:int, controller, retries:int=3, store=None, verbose:bool=False):
+        ''' search_retrieve() with the page size the controller suggests, 
+            telling the controller how that went, and retrying failures (with the smaller size it will then suggest).
+            If store is not None, the controller's state is saved into it after each request.
+            @return: (records, page_size_used)
+        '''
+        attempt = 0
+        while True:
+            page_size = controller.size()
+            started = time.time()
+            try:
+                records = self.search_retrieve(query=query, start_record=start_record, maximum_records=page_size, callback=None, verbose=verbose)
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError, SRUServerError) as e:
+                controller.failure()
+                if store is not None:
+                    store.put( self._page_size_store_key(), controller.to_dict() )
+                attempt += 1
+                if attempt > retries:
+                    raise
+                if self.verbose:
+                    print( "[SRU searchRetrieve] page size %d failed (%r), retrying with %d"%(page_size, e, controller.size()), file=sys.stderr )
+                time.sleep( min(60, 2**attempt - 1) ) # the first retry is already smaller, so needs less of a pause
+                continue
+            controller.success( time.time() - started )
+            if store is not None:
+                store.put( self._page_size_store_key(), controller.to_dict() )
+            return records, page_size
+
+
+
+_page_size_controllers = {}
+' (url, extra_query) -> AdaptivePageSize, see SRUBase.page_size_controller() '
+
+
+class AdaptivePageSize:
+    ''' Decides on a maximumRecords for SRU requests, based on how previous requests went:
+          - after a response that was fast enough, grow the size (multiplicatively)
+          - after a response that was slower than target_latency_sec, shrink it a little
+          - after a failure (HTTP 500, timeout), shrink it a lot, 
+            and remember that size as problematic, so that we don't grow back into it right away.
+            That ceiling is raised a little after every probe_after successes at it, in case it was a temporary problem.
+
+        Small pages waste round trips, large pages make some servers time out or fail, 
+        so the point is to sit somewhere near the best throughput without having to figure that out per server yourself.
+    '''
+    def __init__(self, initial:int=10, minimum:int=1, maximum:int=1000, target_latency_sec:float=5.0,
+                 grow_factor:float=1.5, shrink_factor:float=0.5, probe_after:int=20):
+        self.current            = float(initial)
+        self.minimum            = minimum
+        self.maximum            = maximum
+        self.ceiling            = float(maximum)
+        self.target_latency_sec = target_latency_sec
+        self.grow_factor        = grow_factor
+        self.shrink_factor      = shrink_factor
+        self.probe_after        = probe_after
+        self._at_ceiling_count  = 0
+
+    def size(self) -> int:
+        ' the page size to use for the next request '
+        return int( max(self.minimum, min(self.current, self.ceiling, self.maximum)) )
+
+    def success(self, latency_sec:float):
+        ' report that a request of the current size() worked, and how long it took '
+        if latency_sec > self.target_latency_sec:
+            self.current = max(self.minimum, self.current * 0.8)
+        else:
+            if self.current >= self.ceiling  and  self.ceiling < self.maximum:
+                self._at_ceiling_count += 1
+                if self._at_ceiling_count >= self.probe_after:
+                    self.ceiling = min(self.maximum, self.ceiling * 1.1 + 1)
+                    self._at_ceiling_count = 0
+            self.current = min(self.ceiling, self.current * self.grow_factor)
+
+    def failure(self):
+        ' report that a request of the current size() failed '
+        failed_size  = self.size()
+        self.ceiling = max(self.minimum, failed_size - 1)
+        self.current = max(self.minimum, failed_size * self.shrink_factor)
+        self._at_ceiling_count = 0
+
+    def to_dict(self) -> dict:
+        ' everything needed to reconstruct this controller, as a dict (e.g. to store in a MsgpackKV) '
+        return {
+            'current':self.current, 'minimum':self.minimum, 'maximum':self.maximum, 'ceiling':self.ceiling,
+            'target_latency_sec':self.target_latency_sec, 'grow_factor':self.grow_factor, 'shrink_factor':self.shrink_factor,
+            'probe_after':self.probe_after, 'at_ceiling_count':self._at_ceiling_count,
+        }
+
+    @classmethod
+    def from_dict(cls, d:dict):
+        ' the reverse of to_dict() '
+        ret = cls( initial=d['current'], minimum=d['minimum'], maximum=d['maximum'], target_latency_sec=d['target_latency_sec'],
+                   grow_factor=d['grow_factor'], shrink_factor=d['shrink_factor'], probe_after=d['probe_after'] )
+        ret.current           = float( d['current'] )    # (the constructor's initial would be fine, but don't lose the fraction)
+        ret.ceiling           = float( d['ceiling'] )
+        ret._at_ceiling_count = d['at_ceiling_count']
         return ret
+
+    def __repr__(self):
+        return '<AdaptivePageSize size=%d ceiling=%d>'%(self.size(), self.ceiling)
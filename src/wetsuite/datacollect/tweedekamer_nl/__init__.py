@@ -22,6 +22,10 @@
     (though we can get those via e.g. https://zoek.officielebekendmakingen.nl/dossier/36267)
 '''
 
+import datetime
+
+import dateutil.parser
+
 import wetsuite.helpers.net
 import wetsuite.helpers.etree
 
@@ -87,26 +91,13 @@ def fetch_all(soort="Persoon", break_actually=False, timeout=60):
         This is not immediately useful,
         and you probably want to feed this into L{merge_etrees} to make a single large document
         (some types are hundreds of MByte, though).
+
+        If you want all of a soort, and to keep it up to date, L{sync_feed} is probably the better choice.
     '''
     url = f'{SYNCFEED_BASE}Feed?category=%s'%soort
     ret = []
     while True:
-        xml  = wetsuite.helpers.net.download( url, timeout=timeout )
-        tree = wetsuite.helpers.etree.fromstring( xml )
-        tree = wetsuite.helpers.etree.strip_namespace( tree )
-
-        # is there a next page?
-        url = None
-        links = tree.findall('link')
-        for link in links:
-            # we're looking for something like
-            #  <link rel="next" href="https://gegevensmagazijn.tweedekamer.nl/SyncFeed/2.0/Feed?category=Persoon&amp;skiptoken=11902974"/>
-            rel = link.get('rel')
-            href = link.get('href')
-            if rel == 'next':
-                url = href
-            # edict['links'].append( (rel,href) )
-
+        tree, url = _fetch_feed_page( url, timeout=timeout )
         ret.append( tree )
 
         if break_actually:
@@ -118,6 +109,92 @@ def fetch_all(soort="Persoon", break_actually=False, timeout=60):
     return ret
 
 
+def _fetch_feed_page( url, timeout=60 ):
+    ''' Fetches a single page of a feed.
+        @return: (the etree for that page, stripped of namespaces,  the URL of the next page, or None if this was the last)
+    '''
+    xml  = wetsuite.helpers.net.download( url, timeout=timeout )
+    tree = wetsuite.helpers.etree.fromstring( xml )
+    tree = wetsuite.helpers.etree.strip_namespace( tree )
+
+    # is there a next page?
+    next_url = None
+    for link in tree.findall('link'):
+        # we're looking for something like
+        #  <link rel="next" href="https://gegevensmagazijn.tweedekamer.nl/SyncFeed/2.0/Feed?category=Persoon&amp;skiptoken=11902974"/>
+        if link.get('rel') == 'next':
+            next_url = link.get('href')
+    return tree, next_url
+
+
+def sync_feed( soort, store, state_store, timeout=60, verbose=False ):
+    ''' Fetches all feed items of a single soort into a store, one page at a time, 
+        and remembers where it got to, so that the next call only fetches what was added or changed since.
+
+        This is a generator: it yields the entry dicts (as L{entry_dicts} would make them) for each page as it is fetched,
+        and it is only while you iterate it that it does anything. If you only want the store filled, do `list( sync_feed(...) )` 
+        or `for _ in sync_feed(...): pass`.
+
+        Unlike L{fetch_all}, this holds only one page in memory at a time.
+
+        The SyncFeed is an ordered log of changes, where each page links to the next with a skiptoken,
+        and the last page links to nothing yet.  We store the next-page URL after every page,
+        and after the last page we store that page's own URL, so that the next sync starts by re-fetching it 
+        and follows a next link that has appeared since. 
+        Entries we already have are only replaced when the new one has a later 'updated'.
+
+        @param soort: what object type to fetch, see L{fetch_all}
+        @param store: a MsgpackKV that entry dicts go into, keyed by their id
+        @param state_store: a MsgpackKV that we keep the URL to continue from in (keyed by soort), can be shared between soorten
+        @param timeout: per fetch
+        @param verbose: print each page's URL and how many entries in it were new or newer
+    '''
+    url = state_store.get( soort, missing_as_none=True )
+    if url is None:
+        url = f'{SYNCFEED_BASE}Feed?category=%s'%soort
+
+    while True:
+        tree, next_url = _fetch_feed_page( url, timeout=timeout )
+        page = entry_dicts( tree )
+        del tree
+
+        changed = 0
+        for edict in page:
+            existing = store.get( edict['id'], missing_as_none=True )
+            if existing is None  or  _is_newer( edict['updated'], existing['updated'] ):
+                store.put( edict['id'], edict, commit=False )
+                changed += 1
+        store.commit()
+        if verbose:
+            print( '%s: %d entries, %d new or updated'%(url, len(page), changed) )
+
+        # only after the entries are committed, so that the state never gets ahead of the data
+        state_store.put( soort, url  if next_url is None  else  next_url )
+
+        yield from page
+
+        if next_url is None:
+            break
+        url = next_url
+
+
+def _is_newer( updated, than_updated ):
+    ' compares two "updated" timestamp strings  (parsed, so that differences in how precise they are or their time zone do not matter) '
+    if than_updated is None:
+        return True
+    if updated is None:
+        return False
+    return _parse_updated( updated ) > _parse_updated( than_updated )
+
+
+def _parse_updated( updated ):
+    ' parse an "updated" timestamp string to a datetime, assuming UTC when it does not say '
+    ret = dateutil.parser.isoparse( updated )
+    if ret.tzinfo is None:
+        ret = ret.replace( tzinfo=datetime.timezone.utc )
+    return ret
+
+
 def merge_etrees( trees ):
     ''' Merges a list of documents (etree documents, as fetch_all gives you) 
         into a single etree document.
@@ -11,12 +11,8 @@ CONSIDER:
 
 
 TODO: 
-  - decide how often to re-fetch the index client-side. 
-    Each interpreter (which is what it does right now)?   
-    Store and base on mtime with possible override? 
-    Decide it's cheap enough to fetch each time? (but fall back onto stored?)
-  - decide how to store and access. For very large datasets we may want something like HDF5 
-    because right now we don't have a choice but to have all the dataset in RAM
+  - decide how to store and access. For very large datasets we may want something like HDF5.
+    JSON datasets are converted to a store on first load (see _json_to_store), so at least those are no longer all in RAM.
 '''
 
 import sys
@@ -24,8 +20,16 @@ import os
 import re
 import json
 import time
+import struct
+import sqlite3
+import warnings
+import threading
 import tempfile
+import hashlib
+import collections
+import concurrent.futures
 import bz2
+import zlib
 import fnmatch
 import lzma # standard library since py3.3, before that we could fall back to backports.lzma
 import zipfile
@@ -34,6 +38,7 @@ import wetsuite.helpers.util
 import wetsuite.helpers.net
 import wetsuite.helpers.date
 import wetsuite.helpers.localdata
+import wetsuite.helpers.seekable
 from wetsuite.helpers.notebook import is_interactive
 
 
@@ -44,6 +49,8 @@ _INDEX_URL = 'https://wetsuite.knobs-dials.com/datasets/index.json'
 _index_data = None  # should be None, or a dict once loaded
 _index_fetch_time = 0
 _index_fetch_no_more_often_than_sec = 600
+_index_lock = threading.Lock()
+_index_refresh_thread = None
 
 
 def generated_today_text():
@@ -59,7 +66,7 @@ def list_datasets():
     #return list( _index.items() )
 
 
-def fetch_index():
+def fetch_index(force_refresh=False):
     ''' Index is expected to be a list of dicts, each with keys includin
           - url
           - version             (should probably become semver)
@@ -70,28 +77,138 @@ def fetch_index():
           - download_size_human, real_size_human: more readable version, 
             e.g. where real_size might be the integer 397740, real_size_human would be 388KiB
           - type                content type of dataset 
+          - sha256              (optional) hash of the file as downloaded, which we check against if present
+          - manifest_url, deltas  (optional) let us update an earlier version we have, rather than fetch it in full 
+                                  (see _update_from_delta)
          
         TODO: an example
 
         CONSIDER: keep hosting generic (HTTP fetch?) so that any hoster will do.
+
+        We keep a copy of the index in the datasets directory, so this is normally instant:
+          - if our copy is recent (see _index_fetch_no_more_often_than_sec), we just use it
+          - if it is older, we still use it, but also ask the server for a newer one in the background
+            (conditionally, so if nothing changed, the server only needs to say so),
+            so a later call will see that.
+          - only if we have no copy at all do we wait for the server
+        This also means that once you have loaded the index once, you can work without network access
+        (as long as the datasets you use are also already downloaded).
+
+        @param force_refresh: ask the server now and wait for the answer
+        (still falling back to our copy if that fails, with a warning).
     '''
-    global _index_data, _index_data, _index_fetch_time, _index_fetch_no_more_often_than_sec
+    global _index_data, _index_fetch_time
 
-    if (_index_data is None  or
-         time.time() - _index_fetch_time > _index_fetch_no_more_often_than_sec):
-        #print('FETCHING INDEX')
+    if force_refresh:
         try:
-            _fetched_data = wetsuite.helpers.net.download( _INDEX_URL )
-            _index_data = json.loads( _fetched_data )
-            #print("Fetched index")
-            _index_fetch_time = time.time()
+            return _refresh_index()
         except Exception as e:
-            raise
-    #else:
-    #    print('CACHED INDEX')
+            if _index_data is None:
+                cached = _read_index_cache()
+                if cached is None:
+                    raise
+                _index_data, _index_fetch_time = cached['index'], cached['fetched']
+            warnings.warn( 'Could not fetch the dataset index (%s), using our earlier copy'%e )
+            return _index_data
+
+    if _index_data is None:
+        cached = _read_index_cache()
+        if cached is not None:
+            _index_data, _index_fetch_time = cached['index'], cached['fetched']
+
+    if _index_data is None: # no copy to fall back on, so we have to wait (and fail if we can't fetch)
+        return _refresh_index()
+
+    if time.time() - _index_fetch_time > _index_fetch_no_more_often_than_sec:
+        _start_background_index_refresh()
     return _index_data
 
 
+def _index_cache_path():
+    ' where we keep our copy of the index '
+    return os.path.join( wetsuite.helpers.util.wetsuite_dir()['datasets_dir'], 'index_cache.json' )
+
+
+def _read_index_cache():
+    ''' our copy of the index, as a dict with keys index, fetched (unix time), etag, and last_modified,
+        or None if we don't have one (or it is unreadable).
+    '''
+    try:
+        with open( _index_cache_path(), 'rb' ) as f:
+            cached = json.loads( f.read() )
+        if 'index' in cached  and  'fetched' in cached:
+            return cached
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _write_index_cache(cached:dict):
+    ' write our copy of the index, via a temporary file so that concurrent readers only ever see a complete one '
+    path = _index_cache_path()
+    tmp_handle, tmp_path = tempfile.mkstemp( prefix='tmp_index_cache', dir=os.path.dirname(path) )
+    try:
+        with os.fdopen(tmp_handle, 'wb') as f:
+            f.write( json.dumps( cached ).encode('utf8') )
+        os.replace( tmp_path, path )
+    except:
+        if os.path.exists( tmp_path ):
+            os.unlink( tmp_path )
+        raise
+
+
+def _refresh_index(timeout=20):
+    ''' Ask the server for the index - conditionally, if we have a copy that says what version it is -
+        then update both our copy on disk and the module globals.
+        Raises on network errors and HTTP errors.
+        @return: the index
+    '''
+    global _index_data, _index_fetch_time
+    cached = _read_index_cache()
+    headers = {}
+    if cached is not None:
+        if cached.get('etag') is not None:
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified') is not None:
+            headers['If-Modified-Since'] = cached['last_modified']
+
+    response = wetsuite.helpers.net.get( _INDEX_URL, headers=headers, timeout=timeout )
+    if response.status_code == 304  and  cached is not None: # not modified
+        cached['fetched'] = time.time()
+    elif response.ok:
+        cached = {
+            'index':         json.loads( response.content ),
+            'etag':          response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'fetched':       time.time(),
+        }
+    else:
+        raise ValueError( 'Fetching the dataset index gave HTTP status %s'%response.status_code )
+
+    _write_index_cache( cached )
+    _index_data, _index_fetch_time = cached['index'], cached['fetched']
+    return _index_data
+
+
+def _start_background_index_refresh():
+    ' start a _refresh_index() in a thread, unless one is already running '
+    global _index_refresh_thread
+    with _index_lock:
+        if _index_refresh_thread is not None  and  _index_refresh_thread.is_alive():
+            return
+        _index_refresh_thread = threading.Thread( target=_background_index_refresh, name='wetsuite index refresh', daemon=True )
+        _index_refresh_thread.start()
+
+
+def _background_index_refresh():
+    global _index_fetch_time
+    try:
+        _refresh_index()
+    except Exception: # e.g. we are offline.  We keep using our copy,
+        # and pretend we just fetched, so that we don't try again on every call until the usual interval has passed
+        _index_fetch_time = time.time()
+
+
 
 class Dataset:
     '''
@@ -196,17 +313,410 @@ class Dataset:
 
 
 
-def _load_bare(dataset_name: str, verbose=None, force_refetch=False):
+class _StreamDecompressor:
+    ''' Wraps the incremental decompressor objects (from lzma, bz2, zlib, optionally zstandard)
+        so that you can feed it compressed chunks as they come in, and get back decompressed chunks.
+
+        The main addition is that it continues past the end of a compressed stream,
+        because parallel compressors (e.g. pbzip2, pigz, some xz settings) produce concatenated streams,
+        which the bare decompressor objects would consider the end of the data.
+    '''
+    def __init__(self, make_decompressor, padding_multiple:int=None):
+        ''' @param make_decompressor: a function that returns a new decompressor object, 
+            e.g. lzma.LZMADecompressor (the class, not an instance)
+            @param padding_multiple: if not None, the format allows NUL bytes between and after streams, 
+            in multiples of this many (the .xz format's stream padding, which is 4), which we then skip.
+        '''
+        self.make_decompressor = make_decompressor
+        self.decompressor      = make_decompressor()
+        self.padding_multiple  = padding_multiple
+        self.padding           = 0      # how many NUL bytes we skipped since the last stream ended
+        self.eof               = False  # True after a stream ended, False again as soon as we see the start of another
+
+
+    def decompress(self, data:bytes) -> bytes:
+        ' hand in the next chunk of compressed data, returns whatever decompressed data that yielded (may be empty) '
+        ret = []
+        while len(data) > 0:
+            if self.decompressor.eof: # previous stream ended, and there is more data - assume that's the next stream
+                if self.padding_multiple is not None: # ...after any stream padding
+                    stripped = data.lstrip( b'\x00' )
+                    self.padding += len(data) - len(stripped)
+                    data = stripped
+                    self.eof = self.padding % self.padding_multiple == 0  # (if not, it is only valid if more padding follows)
+                    if len(data) == 0:
+                        break
+                    if not self.eof:
+                        raise ValueError( "Stream padding of %d bytes, which should be a multiple of %d"%(self.padding, self.padding_multiple) )
+                    self.padding = 0
+                self.decompressor = self.make_decompressor()
+            self.eof = False
+            ret.append( self.decompressor.decompress( data ) )
+            if self.decompressor.eof:
+                self.eof = True
+                data = self.decompressor.unused_data
+            else:
+                data = b''
+        return b''.join( ret )
+
+
+    def finish(self) -> bytes:
+        ' call after the last decompress(); returns whatever was still held back (nothing, for this class) '
+        return b''
+
+
+def _decompress_unit(make_decompressor, unit:bytes, padding_multiple:int=None):
+    ''' Decompresses a piece of data that should be complete by itself (one or more whole streams).
+        @param padding_multiple: see _StreamDecompressor
+        @return: the decompressed data, or None if it was not complete (which for some splitters means it was split in the wrong place)
+    '''
+    decompressor = _StreamDecompressor( make_decompressor, padding_multiple )
+    data = decompressor.decompress( unit )
+    if not decompressor.eof:
+        return None
+    return data
+
+
+class _MagicSplitter:
+    ''' Cuts concatenated compressed streams (as e.g. pbzip2 makes) into pieces that start with the stream's magic bytes.
+
+        The magic could also appear inside compressed data, which would make us cut a stream in two.
+        We do not try to avoid that here - the first half will not decompress to a complete stream,
+        which _ParallelDecompressor notices, and it then decompresses the two together.
+    '''
+    def __init__(self, magic_re:bytes, min_unit:int=262144, max_unit:int=67108864):
+        ''' @param magic_re: a regular expression (as bytes) matching the start of a stream
+            @param min_unit: do not cut pieces smaller than this (when we find many small streams, we hand them over together)
+            @param max_unit: if we have seen this much without finding the start of another stream, 
+            assume this is one large stream and hand over everything from there on as-is (to be decompressed serially),
+            rather than keep it all in memory.
+        '''
+        self.magic_re = re.compile( magic_re )
+        self.min_unit = min_unit
+        self.max_unit = max_unit
+        self.buffer   = bytearray()
+        self.searched = 1  # how far we have looked for the next magic (skipping the first byte, which is where a stream starts)
+        self.serial   = False
+
+
+    def feed(self, data:bytes) -> list:
+        ' add compressed data, returns a list of ("unit", bytes) for pieces that are complete, and ("serial", bytes) '
+        if self.serial:
+            return [ ('serial', data) ]
+        self.buffer += data
+        ret = []
+        while True:
+            start_search = max( self.searched, self.min_unit )
+            match = self.magic_re.search( self.buffer, start_search )
+            if match is None:
+                if len(self.buffer) > self.max_unit:
+                    ret.append( ('serial', bytes(self.buffer)) )
+                    self.buffer = bytearray()
+                    self.serial = True
+                # the next search can start a little before the end, in case the magic was only partly here
+                self.searched = max( start_search, len(self.buffer) - 16 )
+                return ret
+            ret.append( ('unit', bytes(self.buffer[:match.start()])) )
+            del self.buffer[:match.start()]
+            self.searched = 1
+
+
+    def finish(self) -> list:
+        ' returns the rest '
+        ret = []
+        if len(self.buffer) > 0:
+            ret.append( ('unit', bytes(self.buffer)) )
+        self.buffer = bytearray()
+        return ret
+
+
+def _xz_multibyte(data:bytes, pos:int):
+    ' decodes the variable-length integers in the xz format, returns (value, position after it) '
+    value, shift = 0, 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80 == 0:
+            return value, pos
+        shift += 7
+        if shift > 63:
+            raise ValueError('bad integer in xz data')
+
+
+def _xz_encode_multibyte(value:int) -> bytes:
+    ret = bytearray()
+    while value >= 0x80:
+        ret.append( (value & 0x7f) | 0x80 )
+        value >>= 7
+    ret.append( value )
+    return bytes(ret)
+
+
+class _XZBlockSplitter:
+    ''' Cuts an .xz file into its blocks, each re-wrapped as a complete single-block .xz stream of its own,
+        so that each can be decompressed (including its integrity check) separately.
+
+        That is only possible when block headers say how large the block is, which multi-threaded xz (xz -T) and e.g. pixz do.
+        When the first block in a stream does not, we hand over everything from there as-is (to be decompressed serially).
+
+        For the format, see https://tukaani.org/xz/xz-file-format.txt
+    '''
+    _HEADER_MAGIC = b'\xfd7zXZ\x00'
+    _CHECK_SIZES  = (0, 4, 4, 4, 8, 8, 8, 16, 16, 16, 32, 32, 32, 64, 64, 64)
+
+    def __init__(self):
+        self.buffer        = bytearray()
+        self.state         = 'stream_header'  # or 'block', or 'serial'
+        self.stream_header = None
+        self.first_block   = True
+
+
+    def feed(self, data:bytes) -> list:
+        ' add compressed data, returns a list of ("unit", bytes) and ("serial", bytes) '
+        if self.state == 'serial':
+            return [ ('serial', data) ]
+        self.buffer += data
+        ret = []
+        while True:
+            if self.state == 'serial':
+                return ret
+
+            elif self.state == 'stream_header':
+                while self.buffer.startswith(b'\x00\x00\x00\x00'): # stream padding
+                    del self.buffer[:4]
+                if len(self.buffer) < 12:
+                    return ret
+                if not self.buffer.startswith( self._HEADER_MAGIC ):
+                    raise ValueError('Does not look like xz data')
+                self.stream_header = bytes( self.buffer[:12] )
+                self.check_size    = self._CHECK_SIZES[ self.buffer[7] & 0x0f ]
+                del self.buffer[:12]
+                self.first_block   = True
+                self.state         = 'block'
+
+            else: # 'block' - a block header, or the index that follows the last block
+                if len(self.buffer) < 1:
+                    return ret
+                if self.buffer[0] == 0x00: # index indicator
+                    index_end = self._index_end()
+                    if index_end is None:
+                        return ret
+                    del self.buffer[:index_end+12] # skip index and stream footer
+                    self.state  = 'stream_header'
+                    continue
+
+                header_size = (self.buffer[0] + 1) * 4
+                if len(self.buffer) < header_size:
+                    return ret
+                flags = self.buffer[1]
+                if not (flags & 0x40  and  flags & 0x80): # sizes not recorded
+                    if not self.first_block:
+                        raise ValueError("This .xz file's blocks only sometimes record their size, which we cannot decompress in parallel")
+                    ret.append( ('serial', self.stream_header + bytes(self.buffer)) )
+                    self.buffer = bytearray()
+                    self.state  = 'serial'
+                    continue
+                compressed_size,   pos = _xz_multibyte( self.buffer, 2 )
+                uncompressed_size, pos = _xz_multibyte( self.buffer, pos )
+
+                unpadded_size = header_size + compressed_size + self.check_size
+                block_size    = header_size + ((compressed_size + 3) & ~3) + self.check_size
+                if len(self.buffer) < block_size:
+                    return ret
+                ret.append( ('unit', self._wrap( bytes(self.buffer[:block_size]), unpadded_size, uncompressed_size )) )
+                del self.buffer[:block_size]
+                self.first_block = False
+
+
+    def _index_end(self):
+        ' if the whole index is in the buffer, where it ends (stream footer starts), otherwise None '
+        try:
+            count, pos = _xz_multibyte( self.buffer, 1 )
+            for _ in range(2*count):
+                _, pos = _xz_multibyte( self.buffer, pos )
+        except IndexError:
+            return None
+        pos = ((pos + 3) & ~3) + 4  # padding, CRC32
+        if len(self.buffer) < pos + 12:
+            return None
+        return pos
+
+
+    def _wrap(self, block:bytes, unpadded_size:int, uncompressed_size:int) -> bytes:
+        ' make a single block into a complete .xz stream '
+        index = b'\x00' + _xz_encode_multibyte(1) + _xz_encode_multibyte(unpadded_size) + _xz_encode_multibyte(uncompressed_size)
+        index += b'\x00' * (-len(index) % 4)
+        index += struct.pack( '<I', zlib.crc32(index) )
+        stream_flags  = self.stream_header[6:8]
+        footer_fields = struct.pack( '<I', len(index)//4 - 1 ) + stream_flags
+        footer = struct.pack( '<I', zlib.crc32(footer_fields) ) + footer_fields + b'YZ'
+        return self.stream_header + block + index + footer
+
+
+    def finish(self) -> list:
+        ' returns the rest, which should be nothing - unless the data was truncated, which we report as ("incomplete", bytes) '
+        ret = []
+        if self.state == 'block'  or  len(self.buffer) > 0: # in the middle of a stream
+            ret.append( ('incomplete', bytes(self.buffer)) )
+        self.buffer = bytearray()
+        return ret
+
+
+class _ParallelDecompressor:
+    ''' Like _StreamDecompressor (hand in compressed chunks as they arrive, get back decompressed data),
+        but decompresses independent pieces of the data (see the splitter classes above) in multiple threads.
+        The standard library's decompressors let go of the GIL while they work, so this does use multiple cores.
+
+        Output still comes out in order. Since the work happens in the background, decompress() returns only what is done,
+        so after the last chunk, call finish() to get the rest.
+    '''
+    def __init__(self, splitter, make_decompressor, workers:int=None, padding_multiple:int=None):
+        ''' @param padding_multiple: see _StreamDecompressor '''
+        self.splitter          = splitter
+        self.make_decompressor = make_decompressor
+        self.padding_multiple  = padding_multiple
+        self.workers           = workers or os.cpu_count() or 1
+        self.executor          = concurrent.futures.ThreadPoolExecutor( max_workers=self.workers )
+        self.in_flight         = collections.deque()  # (unit bytes, future), in order
+        self.carry             = None  # a unit that did not decompress by itself, to be tried together with the next
+        self.serial            = None  # for data that we could not split, a _StreamDecompressor
+        self.truncated         = False
+        self.eof               = False
+
+
+    def decompress(self, data:bytes) -> bytes:
+        ' hand in the next chunk of compressed data, returns whatever decompressed data is ready (may be empty) '
+        ret = []
+        for kind, piece in self.splitter.feed( data ):
+            if kind == 'unit':
+                self.in_flight.append( (piece, self.executor.submit(_decompress_unit, self.make_decompressor, piece, self.padding_multiple)) )
+            else: # serial data has to wait for everything before it
+                ret.append( self._collect(wait_all=True) )
+                if self.carry is not None: # the last unit was incomplete, and actually continues here
+                    piece = self.carry + piece
+                    self.carry = None
+                if self.serial is None:
+                    self.serial = _StreamDecompressor( self.make_decompressor, self.padding_multiple )
+                ret.append( self.serial.decompress( piece ) )
+        # wait when we have a lot in flight, both to bound memory use and to not fall behind on the download
+        ret.append( self._collect(wait_all=False) )
+        return b''.join( ret )
+
+
+    def _collect(self, wait_all:bool) -> bytes:
+        ret = []
+        while len(self.in_flight) > 0:
+            if not (wait_all  or  self.in_flight[0][1].done()  or  len(self.in_flight) > 2*self.workers):
+                break
+            unit, future = self.in_flight.popleft()
+            if self.carry is None:
+                data = future.result()
+            else: # the previous one was cut in the wrong place, so try it together with this one
+                unit = self.carry + unit
+                data = _decompress_unit( self.make_decompressor, unit, self.padding_multiple )
+            if data is None:
+                self.carry = unit
+            else:
+                self.carry = None
+                ret.append( data )
+        return b''.join( ret )
+
+
+    def finish(self) -> bytes:
+        ' call after the last decompress(); waits for and returns everything that is left, and sets eof '
+        ret = []
+        for kind, piece in self.splitter.finish():
+            if kind == 'incomplete':
+                self.truncated = True
+            else:
+                self.in_flight.append( (piece, self.executor.submit(_decompress_unit, self.make_decompressor, piece, self.padding_multiple)) )
+        ret.append( self._collect(wait_all=True) )
+        self.executor.shutdown()
+        self.eof = not self.truncated  and  self.carry is None  and  (self.serial is None  or  self.serial.eof)
+        return b''.join( ret )
+
+
+def _parallel_decompressor_for_url(url:str, workers:int=None):
+    ''' Like _decompressor_for_url, but for the formats where that is possible, 
+        returns a _ParallelDecompressor (which needs a finish() at the end, so check that it has one).
+
+        That is possible for
+          - .xz files with multiple blocks (as made by xz -T, pixz)
+          - .bz2 files that consist of many streams (as made by pbzip2, lbzip2)
+          - .zst files that consist of many frames (as made by pzstd).
+        For other files of those types, this is not slower than _decompressor_for_url, but not faster either.
+    '''
+    if url.endswith('.xz'):
+        return _ParallelDecompressor( _XZBlockSplitter(), lzma.LZMADecompressor, workers, padding_multiple=4 )
+    elif url.endswith('.bz2'): # stream header, and the magic of the first block
+        return _ParallelDecompressor( _MagicSplitter(rb'BZh[1-9]\x31\x41\x59\x26\x53\x59'), bz2.BZ2Decompressor, workers )
+    elif url.endswith('.zst'):
+        plain = _decompressor_for_url( url ) # also checks that zstandard is there
+        return _ParallelDecompressor( _MagicSplitter(rb'\x28\xb5\x2f\xfd'), plain.make_decompressor, workers )
+    else:
+        return _decompressor_for_url( url )
+
+
+def _decompressor_for_url(url:str):
+    ''' Based on the file extension in an URL, returns a _StreamDecompressor, 
+        or None if it does not seem to be compressed (or rather, not in a way we know about).
+    '''
+    if url.endswith('.xz'): # or file magic, b'\xfd7zXZ\x00\x00'
+        return _StreamDecompressor( lzma.LZMADecompressor, padding_multiple=4 )
+    elif url.endswith('.bz2'):
+        return _StreamDecompressor( bz2.BZ2Decompressor )
+    elif url.endswith('.gz'):
+        return _StreamDecompressor( lambda: zlib.decompressobj( 16+zlib.MAX_WBITS ) )  # 16+ means 'expect gzip header'
+    elif url.endswith('.zst'):
+        try:
+            import zstandard # not a hard dependency, so only import it when we need it
+        except ImportError as ie:
+            raise ImportError("This dataset is zstd-compressed, which needs the zstandard module (e.g. pip3 install zstandard)") from ie
+        return _StreamDecompressor( lambda: zstandard.ZstdDecompressor().decompressobj() )
+    else:
+        return None
+
+
+def _load_bare(dataset_name: str, verbose=None, force_refetch=False, seekable=False):
     ''' Note: You normally would use load(), which takes the same name but gives you a usable object, not a filename
 
         Takes a dataset name (that you learned of from the index),
         Downloads it if necessary - after the first time it's cached in your home directory
 
-        If compressed, will uncompress. 
-        Does not think about the type of data
+        If compressed, will uncompress - while downloading (see _fetch_to_temp).
+        If the index mentions a sha256 for the dataset, we check the download against it.
+        If we have an earlier version and the index mentions a delta from it, we fetch only that (see _update_from_delta).
+        Does not think about the type of data, except when seekable=True.
+
+        @param seekable: if True, and the dataset is a SQLite file, then keep it in the cache compressed, 
+        in a form that can still be read at any offset (see L{wetsuite.helpers.seekable}), which takes less disk space.
+        If it was already cached uncompressed, it is converted (not downloaded again).
+        If we have a compressed copy we use that, also if you did not ask for it this time.
         
+        Calls for the same dataset (e.g. a load() while a prefetch() of it is still going) are done one after the other,
+        so that the later one finds the earlier one's result instead of downloading it again.
+
         @return: the filename we fetched to
     '''
+    with _dataset_lock( dataset_name ):
+        return _load_bare_unlocked( dataset_name, verbose=verbose, force_refetch=force_refetch, seekable=seekable )
+
+
+_dataset_locks      = {}  # dataset name -> threading.Lock
+_dataset_locks_lock = threading.Lock()
+
+
+def _dataset_lock(dataset_name: str):
+    ' the lock for a dataset name, see _load_bare '
+    with _dataset_locks_lock:
+        if dataset_name not in _dataset_locks:
+            _dataset_locks[dataset_name] = threading.Lock()
+        return _dataset_locks[dataset_name]
+
+
+def _load_bare_unlocked(dataset_name: str, verbose=None, force_refetch=False, seekable=False):
+    ' does the work for _load_bare, which you should call instead '
     global _index_data
     if _index_data is None:
         _index_data = fetch_index()
@@ -218,7 +728,6 @@ def _load_bare(dataset_name: str, verbose=None, force_refetch=False):
         raise ValueError( "Do not know dataset name %r"%dataset_name )
 
     dir_dict = wetsuite.helpers.util.wetsuite_dir()
-    ws_dir       = dir_dict['wetsuite_dir']
     datasets_dir = dir_dict['datasets_dir']
 
 
@@ -232,64 +741,379 @@ def _load_bare(dataset_name: str, verbose=None, force_refetch=False):
     data_path       = os.path.join( datasets_dir, location_hash )
     # right now the data_path is a single file per dataset, expected to be a JSON file.
     # TODO: decide on whether that is our standard, or needs changing
+    seekable_path   = data_path + '.seekable'
 
-    # If we don't have it in our cache, or a re-fetch was forced, then download it.
+    if not force_refetch  and  os.path.exists( seekable_path ):
+        return seekable_path
+
+    # If we don't have it in our cache, or a re-fetch was forced, then download it
+    # - or, if we have an earlier version and the index says how to get from there to this one, update that.
     if force_refetch or not os.path.exists( data_path ):
-        if verbose:
-            print( "Downloading %r to %r"%(data_url, data_path), file=sys.stderr )
-
-        # CONSIDER: using context manager variant if that's cleaner
-        tmp_handle, tmp_path = tempfile.mkstemp(prefix='tmp_dataset_download', dir=ws_dir)
-        os.close(tmp_handle)  # the open file handle is fairly secure, but here we only care about a non-clashing filename
-
-        # download it to that temporary filename
-        wetsuite.helpers.net.download( data_url, tofile_path=tmp_path, show_progress=verbose)
-
-        ## if it was compressed, decompress it in the cache -
-        # as part of the download, not the load compressed into its fina place.
-        # There is a race condition in multiple loads() of the same thing. CONSIDER: fixing that via a second temporary file
-        # CONSIDER: it may be preferable to store it compressed, and decompress every load. Or at least make this a parameter
-        def decompress_stream(instream, outstream):
-            uncompressed_data_bytes = 0
-            while True:
-                data = instream.read( 2*1048576 )
-                if len(data)==0:
-                    break
-                outstream.write(data)
-                uncompressed_data_bytes += len(data)
-                if verbose:
-                    print( "\rDecompressing... %3sB    "%(wetsuite.helpers.format.kmgtp( uncompressed_data_bytes, kilo=1024 ), ),
-                           end='', file=sys.stderr )
+        if force_refetch  or  not _update_from_delta( dataset_name, dataset_details, data_path, verbose=verbose ):
+            if verbose:
+                print( "Downloading %r to %r"%(data_url, data_path), file=sys.stderr )
+            tmp_path = _fetch_to_temp( data_url, datasets_dir, expect_sha256=dataset_details.get('sha256'), verbose=verbose )
+            os.replace( tmp_path, data_path )
+        if not seekable: # (which would not keep data_path around)
+            _write_installed( dataset_name, dataset_details, data_path )
+    elif not seekable  and  _read_installed( dataset_name ) is None:
+        # A copy we fetched (and verified) before we kept these records: note it now, so that later versions can be deltas on it.
+        # (If there is a record about another file, leave it alone - that may be a newer version, that a process with a newer index installed)
+        _write_installed( dataset_name, dataset_details, data_path )
+
+    if seekable:
+        with open(data_path, 'rb') as f:
+            is_sqlite = f.read(15) == b'SQLite format 3'
+        if is_sqlite:
             if verbose:
-                print('', file=sys.stderr)
+                print( "Compressing %r into %r"%(data_path, seekable_path), file=sys.stderr )
+            tmp_handle, tmp_path = tempfile.mkstemp(prefix='tmp_dataset_compress', dir=datasets_dir)
+            os.close( tmp_handle )
+            try:
+                wetsuite.helpers.seekable.compress_file( data_path, tmp_path )
+                os.replace( tmp_path, seekable_path )
+            except:
+                if os.path.exists( tmp_path ):
+                    os.unlink( tmp_path )
+                raise
+            os.unlink( data_path )
+            return seekable_path
+    elif os.path.exists( seekable_path ): # we just refetched it uncompressed, so that is outdated
+        os.unlink( seekable_path )
+
+    return data_path
+
+
+def _fetch_to_temp(url:str, in_dir:str, expect_sha256:str=None, verbose=False):
+    ''' Downloads a URL into a temporary file in the given directory, decompressing while downloading
+        (so we never store the compressed form).
+        For compressed files made by parallel compressors (xz -T, pbzip2, pzstd) that uses multiple threads.
 
-        if data_url.endswith('.xz'): # or file magic, b'\xfd7zXZ\x00\x00'
-            with lzma.open(tmp_path) as compressed_file_object:
-                with open(data_path,'wb') as write_file_object:
-                    decompress_stream( compressed_file_object, write_file_object )
+        We hand back a temporary file so that the caller can rename it into place once it is complete and verified.
+        The rename is atomic, so concurrent load()s of the same thing won't see a half-written file,
+        and an interrupted download won't leave something that looks like a usable dataset.
+
+        @param expect_sha256: if not None, we check the download (as transferred, not as decompressed) against this.
+        @return: the path of that temporary file, which is now yours to rename or remove.
+        @raise ValueError: if the download was truncated, or does not match expect_sha256.
+    '''
+    # Where the compressed data allows, decompression happens in other threads, while we keep downloading.
+    decompressor = _parallel_decompressor_for_url( url )
+    hasher       = hashlib.sha256()
+
+    tmp_handle, tmp_path = tempfile.mkstemp(prefix='tmp_dataset_download', dir=in_dir)
+    try:
+        with os.fdopen(tmp_handle, 'wb') as write_file_object:
+            def handle_chunk(data):
+                hasher.update( data ) # hash what was transferred, not what it decompresses to
+                if decompressor is not None:
+                    data = decompressor.decompress( data )
+                write_file_object.write( data )
+
+            wetsuite.helpers.net.download( url, handle_chunk=handle_chunk, show_progress=verbose )
+            if decompressor is not None:
+                write_file_object.write( decompressor.finish() )
+
+        if decompressor is not None  and  not decompressor.eof:
+            raise ValueError("Download of %r ended in the middle of compressed data - probably truncated"%url)
+
+        if expect_sha256 is not None  and  hasher.hexdigest() != expect_sha256:
+            raise ValueError("Download of %r does not match the hash the index mentions (%r, got %r)"%(
+                url, expect_sha256, hasher.hexdigest()))
+    except:
+        if os.path.exists( tmp_path ):
             os.unlink( tmp_path )
+        raise
+    return tmp_path
+
+
+### Updating a cached dataset to a new version, by fetching only what changed
+#
+# An index entry may (optionally) have
+#   - 'manifest_url': a JSON object that maps each key in this version to item_hash() of its value as stored
+#   - 'deltas':       a dict from an earlier 'version' to {'url':..., 'sha256':... (optional)} of a SQLite store
+#                     that contains (only) the items that were added or changed since that version, and this version's meta table.
+# both of which you can make with store_manifest() and make_delta().
+#
+# We then also remember which version of each dataset we have, and in which file,
+# so that when the index mentions a newer version, we can fetch the delta from ours, apply it to our copy, and check the result against the manifest.
+# This only applies to SQLite datasets that we keep uncompressed (not JSON, not seekable=True).
+#
+# CONSIDER: chaining deltas, so that you can skip versions
+
+def item_hash(value):
+    ''' The hash of a store value, as we put it in manifests.
+        This is the first 16 hex digits of the SHA256 of the value as stored (str is hashed as UTF8).
+        That is not meant to be secure (the index's sha256 for the download is for that), just to notice changes, 
+        and to keep manifests of millions of items reasonably small.
+    '''
+    if isinstance(value, str):
+        value = value.encode('utf8')
+    return hashlib.sha256( value ).hexdigest()[:16]
 
-        elif data_url.endswith('.bz2'):
-            #print('Decompressing...', file=sys.stderr)
-            with bz2.BZ2File(tmp_path, 'rb') as compressed_file_object:
-                with open(data_path,'wb') as write_file_object:
-                    decompress_stream( compressed_file_object, write_file_object )
-            print('  done.', file=sys.stderr)
+
+def store_manifest(store_path:str):
+    ''' For dataset generation: returns a dict from each key in a store (as made by L{wetsuite.helpers.localdata}) to the item_hash() of its value.
+        Publish that (as JSON, compressed if you like) and mention it as manifest_url in the index.
+    '''
+    conn = sqlite3.connect( store_path )
+    try:
+        return { key:item_hash(value)   for key, value in conn.execute('SELECT key, value FROM kv') }
+    finally:
+        conn.close()
+
+
+def make_delta(old_path:str, new_path:str, delta_path:str):
+    ''' For dataset generation: write a store at delta_path with the items that are in the new version of a store but 
+        not in the old one, or have a different value, plus the new version's meta table.
+        (Removed items need not be in there; they follow from the manifest)
+        Publish that (compressed if you like) and mention it in the index, under deltas, under the old version.
+
+        @return: the amount of items in the delta
+    '''
+    old_manifest = store_manifest( old_path )
+    delta = wetsuite.helpers.localdata.LocalKV( delta_path, None, None )
+    new_conn = sqlite3.connect( new_path )
+    try:
+        count = 0
+        for key, value in new_conn.execute('SELECT key, value FROM kv'):
+            if old_manifest.get(key) != item_hash( value ):
+                delta.put( key, value, commit=False )
+                count += 1
+        delta.commit()
+        for key, value in new_conn.execute('SELECT key, value FROM meta'):
+            delta._put_meta( key, value )
+        return count
+    finally:
+        new_conn.close()
+        delta.close()
+
+
+def _installed_path(dataset_name:str):
+    ' where we remember which version of a dataset we have, and in which file '
+    return os.path.join( wetsuite.helpers.util.wetsuite_dir()['datasets_dir'],
+                         wetsuite.helpers.util.hash_hex( dataset_name.encode('utf8') ) + '.installed' )
+
+
+def _read_installed(dataset_name:str):
+    ' what _write_installed last wrote for this dataset, or None if there is no such record (or we cannot read it) '
+    try:
+        with open( _installed_path(dataset_name), 'rb' ) as f:
+            return json.loads( f.read() )
+    except (OSError, ValueError):
+        return None
+
+
+def _version_order(version):
+    ' something to compare the versions in the index with (numbers, or strings like "1.2.10"), or None if we cannot tell '
+    if isinstance(version, (int, float))  and  not isinstance(version, bool):
+        return (version,)
+    if isinstance(version, str):
+        try:
+            return tuple( int(part)  for part in version.split('.') )
+        except ValueError:
+            pass
+    return None
+
+
+def _is_newer(version, than_version) -> bool:
+    ' whether version is known to be strictly newer than than_version (False when we cannot tell) '
+    order, than_order = _version_order( version ), _version_order( than_version )
+    return order is not None  and  than_order is not None  and  order > than_order
+
+
+def _write_installed(dataset_name:str, dataset_details:dict, data_path:str):
+    ''' remember that data_path has this version of this dataset - if it is something we can update in place later.
+
+        If the record is about a newer version (e.g. another process, with a newer index, installed that), we leave it alone.
+        If it is about an older version in another file (which we then had to fetch in full, rather than update), 
+        that file is now superseded, so we remove it.
+    '''
+    with open(data_path, 'rb') as f:
+        if f.read(15) != b'SQLite format 3':
+            return
+    version  = dataset_details.get('version')
+    previous = _read_installed( dataset_name )
+    if previous is not None  and  _is_newer( previous.get('version'), version ):
+        return
+
+    path = _installed_path( dataset_name )  # via a temporary file, so that concurrent readers only ever see a complete one
+    tmp_handle, tmp_path = tempfile.mkstemp( prefix='tmp_installed', dir=os.path.dirname(path) )
+    try:
+        with os.fdopen(tmp_handle, 'wb') as f:
+            f.write( json.dumps( {'version':version, 'file':os.path.basename(data_path)} ).encode('utf8') )
+        os.replace( tmp_path, path )
+    except:
+        if os.path.exists( tmp_path ):
             os.unlink( tmp_path )
+        raise
 
-        # CONSIDER: add gz and zip cases, because they're standard library anyway
+    # (after writing the new record, so that an interruption leaves at most an unused file, not a record pointing at nothing)
+    if previous is not None  and  previous.get('file') not in (None, os.path.basename(data_path))  and  _is_newer( version, previous.get('version') ):
+        old_path = os.path.join( os.path.dirname(data_path), previous['file'] )
+        if os.path.exists( old_path ):
+            os.unlink( old_path )
 
-        else: # assume it was uncompressed, just move it into place
-            os.rename( tmp_path, data_path )
 
-    return data_path
+def _apply_delta(store_path:str, delta_path:str, manifest:dict):
+    ''' Within a single transaction: put the items and meta from the delta into the store,
+        remove the items that the manifest does not mention, then check every item against the manifest.
+        If anything does not match, nothing is changed.
 
+        Note that the check reads (but does not fetch) all of the store, which is still a lot faster than fetching it again.
+        Applying the same delta twice is harmless, which matters if we are interrupted after this but before we note the new version.
 
-def _path_to_data(data_path):
+        @raise ValueError: if the result does not match the manifest.
+    '''
+    conn = sqlite3.connect( store_path, isolation_level=None )  # we control the transaction ourselves
+    try:
+        conn.execute( 'ATTACH DATABASE ? AS delta', (delta_path,) )
+        conn.execute( 'BEGIN' )
+        try:
+            # (the WHERE true is needed for sqlite to not think ON is part of a join)
+            conn.execute( 'INSERT INTO kv (key, value)   SELECT key, value FROM delta.kv   WHERE true  ON CONFLICT (key) DO UPDATE SET value=excluded.value' )
+            conn.execute( 'INSERT INTO meta (key, value) SELECT key, value FROM delta.meta WHERE true  ON CONFLICT (key) DO UPDATE SET value=excluded.value' )
+
+            remove, seen = [], 0
+            for key, value in conn.execute( 'SELECT key, value FROM kv' ):
+                expect = manifest.get( key )
+                if expect is None:
+                    remove.append( key )
+                elif expect != item_hash( value ):
+                    raise ValueError( "After applying the delta, item %r does not match the manifest"%key )
+                else:
+                    seen += 1
+            if seen != len(manifest):
+                raise ValueError( "After applying the delta, %d items that the manifest mentions are missing"%(len(manifest) - seen) )
+            conn.executemany( 'DELETE FROM kv WHERE key=?', ((key,) for key in remove) )
+            conn.execute( 'COMMIT' )
+        except BaseException:
+            conn.execute( 'ROLLBACK' )
+            raise
+    finally:
+        conn.close()
+
+
+def _update_from_delta(dataset_name:str, dataset_details:dict, data_path:str, verbose=False):
+    ''' If we have an earlier version of this dataset, and the index mentions a delta from that version (and a manifest),
+        fetch those, update our copy in place, and move it to data_path.
+
+        @return: True if data_path is now the new version;
+        False if we could not do that (nothing to update from, no delta, or something went wrong, which we warn about),
+        in which case the caller should fetch it in full.
+    '''
+    if 'deltas' not in dataset_details  or  'manifest_url' not in dataset_details:
+        return False
+    installed = _read_installed( dataset_name )
+    if installed is None  or  installed.get('version') is None:
+        return False
+    delta_details = dataset_details['deltas'].get( str(installed['version']) ) # (JSON object keys are always strings)
+    datasets_dir  = os.path.dirname( data_path )
+    old_path      = os.path.join( datasets_dir, installed['file'] )
+    if delta_details is None  or  not os.path.exists( old_path ):
+        return False
+
+    if verbose:
+        print( "Updating %r to version %r, from %r"%(old_path, dataset_details.get('version'), delta_details['url']), file=sys.stderr )
+    delta_path, manifest_path = None, None
+    try:
+        delta_path    = _fetch_to_temp( delta_details['url'], datasets_dir, expect_sha256=delta_details.get('sha256'), verbose=verbose )
+        manifest_path = _fetch_to_temp( dataset_details['manifest_url'], datasets_dir, verbose=verbose )
+        with open(manifest_path, 'rb') as f:
+            manifest = json.loads( f.read() )
+        _apply_delta( old_path, delta_path, manifest )
+        os.replace( old_path, data_path )
+        return True
+    except Exception as e:
+        warnings.warn( "Could not update dataset %r from a delta (%s), will fetch it in full"%(dataset_name, e) )
+        return False
+    finally:
+        for tmp_path in (delta_path, manifest_path):
+            if tmp_path is not None  and  os.path.exists( tmp_path ):
+                os.unlink( tmp_path )
+
+
+def _json_to_store(json_path, store_path):
+    ''' Converts a JSON dataset (a dict with 'data' and 'description') into a MsgpackKV at store_path,
+        streaming the items of its data, so that we never have all of it in memory.
+
+        Writes to a temporary file that is renamed into place when complete,
+        so concurrent loads never see a half-converted store.
+
+        If data is not a dict (e.g. a list, which a key-value store would not imitate well), 
+        this instead writes an empty marker file (see _json_converted), so that we need not look again.
+
+        @raise ValueError: if the JSON does not have the structure we expect.
+    '''
+    tmp_handle, tmp_path = tempfile.mkstemp( prefix='tmp_dataset_convert', dir=os.path.dirname(store_path) )
+    os.close( tmp_handle )
+    try:
+        store = wetsuite.helpers.localdata.MsgpackKV( tmp_path )
+        try:
+            siblings = {}
+            with open(json_path, 'rb') as f:
+                try:
+                    for i, item in enumerate( wetsuite.helpers.util.json_stream_items( f, ('data',), siblings=siblings ) ):
+                        if not isinstance(item, tuple): # data is an array, not an object
+                            if os.path.exists( store_path ): # from an earlier version of this dataset, that was
+                                os.unlink( store_path )
+                            with open( _not_converted_marker_path(json_path), 'wb' ):
+                                pass
+                            return
+                        store.put( item[0], item[1], commit=False )
+                        if i % 10000 == 9999:
+                            store.commit()
+                except KeyError as ke:
+                    raise ValueError("This JSON does not have the structure we expect.") from ke
+            store.commit()
+            if 'description' not in siblings:
+                raise ValueError("This JSON does not have the structure we expect.")
+            store._put_meta( 'description', siblings['description'] )
+        finally:
+            store.close()
+        os.replace( tmp_path, store_path )
+        if os.path.exists( _not_converted_marker_path(json_path) ): # from an earlier version of this dataset, that was list-valued
+            os.unlink( _not_converted_marker_path(json_path) )
+    finally:
+        if os.path.exists( tmp_path ):
+            os.unlink( tmp_path )
+
+
+def _not_converted_marker_path(json_path):
+    ' the path of the (empty) file that says "we looked at this JSON, and it cannot be converted", see _json_to_store '
+    return json_path + '.notkv'
+
+
+def _json_converted(json_path):
+    ''' The first time, we convert a JSON dataset to a store next to it, so that this and later loads need not have it all in RAM.
+        If it was (re)downloaded after that, we convert again.
+        @return: the path of that store, or None if there is none (because data is not a dict, see _json_to_store)
+    '''
+    store_path  = json_path + '.kv'
+    marker_path = _not_converted_marker_path( json_path )
+    json_mtime  = os.path.getmtime( json_path )
+    if os.path.exists( marker_path )  and  os.path.getmtime( marker_path ) >= json_mtime: # known not to convert, so don't scan it again
+        return None
+    if not os.path.exists( store_path )  or  os.path.getmtime( store_path ) < json_mtime:
+        _json_to_store( json_path, store_path )
+    if os.path.exists( store_path ):
+        return store_path
+    return None
+
+
+def _path_to_data(data_path, check_same_thread=True):
     ''' Given a filename,
         return the data and description (based on contents)
         regardless of what data type it is
+
+        @param check_same_thread: handed to the store we open, see L{wetsuite.helpers.localdata.LocalKV}.
+        False when we open it in one thread to hand it to another (see load_async).
     '''
+    if wetsuite.helpers.seekable.is_seekable_file( data_path ):
+        # we only ever make these from SQLite files (see _load_bare)
+        data = wetsuite.helpers.seekable.open_store( data_path )
+        return data, data._get_meta('description', missing_as_none=True)
+
     f = open(data_path,'rb')
     first_bytes = f.read(15)
     f.seek(0)
@@ -298,19 +1122,26 @@ def _path_to_data(data_path):
         f.close()
 
         # the type enforcement is irrelevant when opened read-only
-        data = wetsuite.helpers.localdata.LocalKV( data_path, None, None, read_only=True )
+        data = wetsuite.helpers.localdata.LocalKV( data_path, None, None, read_only=True, check_same_thread=check_same_thread )
 
         description = data._get_meta('description', missing_as_none=True)
         # This seems very hackish - TODO: avoid this
         if data._get_meta('valtype', missing_as_none=True) == 'msgpack':
             data.close()
-            data = wetsuite.helpers.localdata.MsgpackKV( data_path, None, None, read_only=True)
+            data = wetsuite.helpers.localdata.MsgpackKV( data_path, None, None, read_only=True, check_same_thread=check_same_thread )
 
     elif first_bytes.strip().startswith(b'{'): # Assume that's a decent indicator of JSON
-        # expected to be a dict with two main keys, 'data' and 'description'
-        loaded = json.loads( f.read() )
         f.close()
 
+        store_path = _json_converted( data_path )
+        if store_path is not None:
+            return _path_to_data( store_path, check_same_thread=check_same_thread )
+
+        # _json_to_store did not do it, because data is not a dict.   Fall back to having it all in RAM.
+        # expected to be a dict with two main keys, 'data' and 'description'
+        with open(data_path, 'rb') as f:
+            loaded = json.loads( f.read() )
+
         # TODO: remove the need for JSON, or at least make this alternative go away
         #       by being more consistent in dataset generation
         if 'description' in loaded:
@@ -326,7 +1157,7 @@ def _path_to_data(data_path):
     return (data, description)
 
 
-def load(dataset_name: str, verbose=None, force_refetch=False, augment=True):
+def load(dataset_name: str, verbose=None, force_refetch=False, augment=True, seekable=False):
     ''' Takes a dataset name (that you learned of from the index),
         downloads it if necessary - after the first time it's cached in your home directory
 
@@ -347,8 +1178,16 @@ def load(dataset_name: str, verbose=None, force_refetch=False, augment=True):
 
         @param force_refetch: whether to remove the current contents before fetching
         dataset naming should prevent the need for this (except if you're the wetsuite programmer)
+
+        @param seekable: keep SQLite-based datasets compressed in the cache, while still being usable as a store.
+        This takes several times less disk space, at the cost of some speed, and needs the apsw module.
+        See L{_load_bare} for details.
     '''
+    return _load( dataset_name, verbose=verbose, force_refetch=force_refetch, seekable=seekable )
+
 
+def _load(dataset_name: str, verbose=None, force_refetch=False, seekable=False, check_same_thread=True):
+    ' does the work for load() and load_async(), see load(), and _path_to_data about check_same_thread '
     #if '*' in dataset_name:
     global _index_data
     if _index_data is None:
@@ -360,10 +1199,8 @@ def load(dataset_name: str, verbose=None, force_refetch=False, augment=True):
         raise ValueError("Your dataset name/pattern %r matched none of %s"%(dataset_name, ', '.join(all_dataset_names)))
 
     elif len(dataname_matches) == 1:
-        # TODO: huh?
-        data_path = _load_bare( dataname_matches[0] )
-        data, description = _path_to_data( data_path )
-        data_path = _load_bare( dataset_name=dataname_matches[0], verbose=verbose, force_refetch=force_refetch )
+        data_path = _load_bare( dataset_name=dataname_matches[0], verbose=verbose, force_refetch=force_refetch, seekable=seekable )
+        data, description = _path_to_data( data_path, check_same_thread=check_same_thread )
         return Dataset( data=data, description=description, name=dataname_matches[0] )
 
     else:            # implied  >=1
@@ -384,6 +1221,93 @@ def load(dataset_name: str, verbose=None, force_refetch=False, augment=True):
         # return merge_datasets( datasets )
 
 
+_background_executor = None
+_background_workers  = 2    # downloads are mostly network-bound, decompression already has its own threads
+_background_lock     = threading.Lock()
+
+
+def _background():
+    ' the thread pool that prefetch() and load_async() use, created the first time we need it '
+    global _background_executor
+    with _background_lock:
+        if _background_executor is None:
+            _background_executor = concurrent.futures.ThreadPoolExecutor( max_workers=_background_workers, thread_name_prefix='wetsuite dataset' )
+        return _background_executor
+
+
+def _matching_names(dataset_name_or_names):
+    ' expands a name, pattern, or list of them into the dataset names they match, in order, without duplicates '
+    global _index_data
+    if _index_data is None:
+        _index_data = fetch_index()
+    if isinstance(dataset_name_or_names, str):
+        dataset_name_or_names = [dataset_name_or_names]
+
+    ret = []
+    all_dataset_names = list( _index_data.keys() )
+    for dataset_name in dataset_name_or_names:
+        dataname_matches = fnmatch.filter(all_dataset_names, dataset_name)
+        if len(dataname_matches) == 0:
+            raise ValueError("Your dataset name/pattern %r matched none of %s"%(dataset_name, ', '.join(all_dataset_names)))
+        for dataname_match in dataname_matches:
+            if dataname_match not in ret:
+                ret.append( dataname_match )
+    return ret
+
+
+def _prefetch_one(dataset_name: str, seekable=False):
+    ''' Does everything load() would before opening the data:  download, decompress, 
+        and for JSON datasets, convert them to a store.
+        @return: the filename that load() will open
+    '''
+    data_path = _load_bare( dataset_name=dataset_name, verbose=False, seekable=seekable )
+    with open(data_path, 'rb') as f:
+        is_json = f.read(15).strip().startswith(b'{')
+    if is_json:
+        _json_converted( data_path )
+    return data_path
+
+
+def prefetch(dataset_names, seekable=False):
+    ''' Start fetching datasets in background threads, so that a later load() of them is fast.
+        This returns immediately, and you can keep working meanwhile.
+
+        For example, a notebook (or a notebook server, at startup) might do: ::
+            wetsuite.datasets.prefetch( ['kamervragen-struc', 'kansspelautoriteit-*'] )
+        and a load() of one of those will wait only for what has not finished yet.
+
+        Datasets we already have are not fetched again (this does not take force_refetch).
+        Errors (e.g. network trouble) are not raised here, but stored in the according future, 
+        and a later load() will try again.
+
+        @param dataset_names: a dataset name, or a list of them (each may be a pattern, as in load())
+        @param seekable: as in load() - which you would also hand seekable=True later.
+        @return: a dict from each dataset name to a concurrent.futures.Future,
+        whose result() is the filename it was fetched to.
+        @raise ValueError: if a name or pattern matches no datasets (before anything is started).
+    '''
+    executor = _background()
+    ret = {}
+    for dataset_name in _matching_names( dataset_names ):
+        ret[dataset_name] = executor.submit( _prefetch_one, dataset_name, seekable=seekable )
+    return ret
+
+
+def load_async(dataset_name: str, force_refetch=False, augment=True, seekable=False):
+    ''' Like load(), but returns immediately, with a concurrent.futures.Future 
+        whose result() will be the Dataset object (or raise what load() would have raised).
+
+        For example: ::
+            future = wetsuite.datasets.load_async('kamervragen-struc')
+            # ...do other things...
+            kv = future.result().data
+
+        Takes the same arguments as load(), except verbose (nothing is shown, as it happens in the background).
+    '''
+    # the store is opened in a worker thread and then used in yours, so it should allow that
+    return _background().submit( _load, dataset_name, verbose=False, force_refetch=force_refetch, seekable=seekable, check_same_thread=False )
+
+
 
 # @classmethod
 # def files_as_dataset(self, in_dir):
@@ -6,8 +6,11 @@
 # https://koop.gitlab.io/STOP/standaard/1.3.0/identificatie_niet-tekst.html
 
 import re
+import time
+import concurrent.futures
 
 import requests
+import requests.adapters
 
 import wetsuite.helpers.net
 import wetsuite.helpers.etree
@@ -16,42 +19,181 @@ import wetsuite.helpers.localdata
 
 _akn_cache = None
 
-def cached_resolve(akn, store=None):
-    ' like resolve(), but stores results in your user dir, so repeated searches are fast'
+# Failures to resolve are also remembered, in the same store, as this prefix followed by the time it was tried.
+# (the store is str-to-str, and a URL will never start with this)
+_UNRESOLVED_PREFIX = 'unresolved:'
+
+# how long we believe that an AKN that did not resolve keeps not resolving, before we ask again
+NEGATIVE_EXPIRY_SEC = 7*86400
+
+
+def _cache_store(store=None):
+    ' the store we were handed, or (opening it if necessary) the default one in your user dir '
     global _akn_cache
+    if store is not None:
+        return store
     if _akn_cache is None:
         _akn_cache = wetsuite.helpers.localdata.LocalKV('akn_cache.db', key_type=str, value_type=str)
+    return _akn_cache
+
+
+def _cached_value(store, akn, negative_expiry_sec):
+    ''' Look in the cache.
+        @return: (True, url) if it is known to resolve, (True, None) if it is known to not resolve (and that has not expired),
+        (False, None) if we should ask.
+    '''
+    storeval = store.get(akn, missing_as_none=True)
+    if storeval is None:
+        return False, None
+    if storeval.startswith( _UNRESOLVED_PREFIX ):
+        tried = float( storeval[len(_UNRESOLVED_PREFIX):] )
+        if time.time() - tried > negative_expiry_sec:
+            return False, None
+        return True, None
+    return True, storeval
+
+
+def _unresolved_value():
+    ' what we store to remember that something did not resolve, just now '
+    return '%s%.0f'%(_UNRESOLVED_PREFIX, time.time())
 
-    storeval = _akn_cache.get(akn, missing_as_none=True)
-    if storeval is not None:
-        return storeval
-    else:
+
+def cached_resolve(akn, store=None, negative_expiry_sec=NEGATIVE_EXPIRY_SEC):
+    ''' like resolve(), but stores results in your user dir, so repeated searches are fast.
+
+        This also remembers AKNs that did not resolve, for negative_expiry_sec seconds, 
+        and raises the same ValueError for those without asking again.
+
+        @param store: the store to cache in, defaults to akn_cache.db in your user dir
+    '''
+    store = _cache_store( store )
+
+    known, url = _cached_value( store, akn, negative_expiry_sec )
+    if known:
+        if url is None:
+            raise ValueError("AKN did not resolve (when we last tried)")
+        return url
+
+    try:
         ret = resolve( akn )
-        _akn_cache.put( akn, ret )
+    except ValueError:
+        if akn.startswith('/akn/nl'): # not worth storing things that we refuse without asking
+            store.put( akn, _unresolved_value() )
+        raise
+    store.put( akn, ret )
+    return ret
+
+
+def resolve_many(akns, store=None, workers=8, negative_expiry_sec=NEGATIVE_EXPIRY_SEC, timeout=10, commit_every=100, verbose=False):
+    ''' Resolve many AKNs, using the same cache as cached_resolve(), 
+        and for the ones not in there, doing a number of requests at the same time, over shared connections.
+
+        Each distinct AKN is looked up at most once, however many times it appears in akns.
+
+        @param akns: an iterable of AKN strings
+        @param store: the store to cache in, defaults to akn_cache.db in your user dir
+        @param workers: how many requests to do at the same time
+        @param negative_expiry_sec: how long to believe earlier failures to resolve, before asking again
+        @param timeout: per request
+        @param commit_every: how often to commit new results to the store, so that an interrupted run does not lose them all
+        @param verbose: whether to print progress
+        @return: a dict from each (distinct) AKN to the URL it resolves to, 
+        or to None if it did not resolve (including things that were not Dutch AKNs).
+        Network and server errors are also None, but are not remembered, so will be asked again next time.
+    '''
+    store = _cache_store( store )
+
+    ret, to_fetch = {}, []
+    for akn in akns:
+        if akn in ret:
+            continue
+        ret[akn] = None
+        if not akn.startswith('/akn/nl'):
+            continue
+        known, url = _cached_value( store, akn, negative_expiry_sec )
+        if known:
+            ret[akn] = url
+        else:
+            to_fetch.append( akn )
+
+    if verbose:
+        print( '%d distinct AKNs, %d of which we need to look up'%(len(ret), len(to_fetch)) )
+    if len(to_fetch) == 0:
         return ret
 
-
-def resolve(akn, timeout=10):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter( pool_connections=workers, pool_maxsize=workers )
+    session.mount( 'https://', adapter )
+    session.mount( 'http://',  adapter )
+
+    uncommitted, done = 0, 0
+    try:
+        with concurrent.futures.ThreadPoolExecutor( max_workers=workers ) as executor:
+            futures = {}
+            for akn in to_fetch:
+                futures[ executor.submit( resolve, akn, timeout=timeout, session=session ) ] = akn
+
+            # all store writes happen in this thread
+            for future in concurrent.futures.as_completed( futures ):
+                akn = futures[future]
+                done += 1
+                try:
+                    ret[akn] = future.result()
+                    store.put( akn, ret[akn], commit=False )
+                    uncommitted += 1
+                except ValueError:
+                    store.put( akn, _unresolved_value(), commit=False )
+                    uncommitted += 1
+                except requests.exceptions.RequestException as e:
+                    if verbose:
+                        print( 'failed to look up %r: %s'%(akn, e) )
+
+                if uncommitted >= commit_every:
+                    store.commit()
+                    uncommitted = 0
+                if verbose and done % 100 == 0:
+                    print( 'looked up %d of %d'%(done, len(to_fetch)) )
+    finally:
+        if uncommitted > 0:
+            store.commit()
+        session.close()
+
+    return ret
+
+
+def resolve(akn, timeout=10, session=None):
     ''' Resolve a Dutch AKN - currently on https://identifier.overheid.nl/
         @param akn: the AKN string 
+        @param session: optionally, a requests.Session to do the request with
         @return: the URL it went to.
+        Raises ValueError if it did not resolve (including a 404 or 410), which cached_resolve and resolve_many remember,
+        and a requests.exceptions.HTTPError if the server was having problems (a 5xx, or 429 for rate limiting), 
+        which says nothing about the AKN, so should not be remembered.
     '''
     # both to ensure it's an AKN at all (/akn) and to signal this only does Dutch ones
     if not akn.startswith('/akn/nl'): 
         raise ValueError('The AKN should start with /akn/nl')
 
     #CONSIDER: think about escaping against injection issues
-    resp = requests.get(
+    # We follow the redirects, but stream so that we never download the document it points at - we only want to know where it is.
+    resp = wetsuite.helpers.net.get(
         'https://identifier.overheid.nl/'+akn.lstrip('/'),
         allow_redirects=True,
+        stream=True,
         timeout=timeout,
+        session=session,
     )
+    try:
+        if resp.status_code >= 500  or  resp.status_code == 429: # transient, try again some other time
+            raise requests.exceptions.HTTPError( 'HTTP %d while resolving %r'%(resp.status_code, akn), response=resp )
 
-    if 'identifier.overheid.nl' in resp.url: # didn't resolve
-        raise ValueError("AKN did not resolve")
-        # could get error from '.form .alert__inner'
+        if resp.status_code in (404, 410)  or  'identifier.overheid.nl' in resp.url: # didn't resolve
+            raise ValueError("AKN did not resolve")
+            # could get error from '.form .alert__inner'
 
-    return resp.url
+        return resp.url
+    finally:
+        resp.close()
 
 
 # def resolve(akn):
@@ -217,14 +217,17 @@ def days_in_range( from_date, to_date, strftime_format=None ):
     return ret
 
 
-def date_ranges( from_date, to_date, increment_days, strftime_format=None ):
+def date_ranges( from_date, to_date, increment_days, strftime_format=None, overlap=True ):
     ''' Given a larger interval, return a series of shorter intervals no larger than increment_days long.
-        (currently first and last days overlap; TODO: parameter to control that)
+        By default, the first and last days of consecutive ranges overlap; see the overlap parameter.
 
         @param from_date:      start of range, as a date object, datetime object, or string to parse (using dateutil library)
         (please do not use formats like 02/02/11 and also expect the output to do what you want)
         @param to_date:        end of range, inclusive
         @param increment_days: size of each range
+        @param overlap:        if True (the default), each range ends on the day the next one starts.
+        If False, each range ends the day before the next starts, so that when handing these to something that 
+        treats both ends as inclusive, no day is in two ranges (and the last range may be a single day).
     
         @return: a list of tuples, which are either 
           - date objects (if strftime==None), or 
@@ -236,9 +239,13 @@ def date_ranges( from_date, to_date, increment_days, strftime_format=None ):
     ret = []
     ongoing = from_date
     span = datetime.timedelta( days=increment_days ) 
-    while ongoing < to_date:
+    if overlap:
+        end_span = span
+    else:
+        end_span = span - datetime.timedelta( days=1 )
+    while ongoing < to_date  or  (not overlap  and  ongoing == to_date):
         thisrange_from  = ongoing
-        thisrange_to    = min( (ongoing + span), to_date )
+        thisrange_to    = min( (ongoing + end_span), to_date )
         if strftime_format is None:
             ret.append( (thisrange_from, thisrange_to) )
         else:
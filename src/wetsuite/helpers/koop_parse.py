@@ -7,12 +7,14 @@ For more general things, see
 '''
 import re
 import sys
+import time
 import urllib.parse
 import warnings
 from collections import OrderedDict
 
 import wetsuite.datacollect.koop_repositories
 import wetsuite.helpers.meta
+import wetsuite.helpers.localdata
 
 import wetsuite.helpers.etree
 
@@ -870,30 +872,111 @@ def bwb_toestand_text(tree):
     #    print(' RET: %s '%ret)
 
 
-_versions_cache = {}
+_versions_cache = {}  # in-process, on top of the store
+_versions_store = None
 
-def cvdr_versions_for_work( cvdrid:str ) -> list:
+# how long we trust a stored list of versions (new versions of regulations keep appearing)
+VERSIONS_EXPIRY_SEC = 7*86400
+
+
+def _cvdr_versions_store(store=None):
+    ' the store we were handed, or (opening it if necessary) the default one in your user dir '
+    global _versions_store
+    if store is not None:
+        return store
+    if _versions_store is None:
+        _versions_store = wetsuite.helpers.localdata.MsgpackKV('cvdr_versions.db')
+    return _versions_store
+
+
+def cvdr_versions_for_work( cvdrid:str, store=None, expiry_sec:float=VERSIONS_EXPIRY_SEC ) -> list:
     ''' takes a CVDR id (with or without _version, i.e. expression id or work id),
         searches KOOP's CVDR repo, 
         Returns: a list of all matching version expression ids  
 
-        Keep in mind that this actively does requests, so preferably don't do this in bulk, and/or cache your results.
+        Results are remembered in a store in your user dir (see L{cvdr_versions_for_works}),
+        but if you have many to look up, use L{cvdr_versions_for_works}, which is much faster than calling this repeatedly.
     '''
-    if cvdrid in _versions_cache:
-        #print( "HIT %r -> %r"%(cvdrid, _versions_cache[cvdrid]) )
-        return _versions_cache[cvdrid]
-
-    sru_cvdr = wetsuite.datacollect.koop_repositories.CVDR() # TODO: see if doing this here stays valid
-    work_id, expression_id = cvdr_parse_identifier(cvdrid)
-    results = sru_cvdr.search_retrieve_many("workid = CVDR%s"%work_id, up_to=10000)   # only fetches as many as needed, usually a single page of results. TODO: maybe think about injection?
-    #print(f"amt results: {len(results)}")
-    ret=[]
-    for record in results:
-        meta = cvdr_meta(record)
-        result_expression_id = meta['identifier'][0]['text']
-        ret.append( result_expression_id )
-    ret = sorted( ret )
-    _versions_cache[cvdrid] = ret
+    return cvdr_versions_for_works( [cvdrid], store=store, expiry_sec=expiry_sec )[cvdrid]
+
+
+def cvdr_versions_for_works( cvdrids, store=None, expiry_sec:float=VERSIONS_EXPIRY_SEC,
+                             works_per_query:int=50, wait_between_sec:float=0.5, verbose:bool=False ) -> dict:
+    ''' Like L{cvdr_versions_for_work}, for many CVDR ids at once.
+
+        What we did not look up recently (see expiry_sec) is searched for in batches,
+        as a single SRU query that ORs together the workid of up to works_per_query works,
+        so that looking up many works takes (many times) fewer requests.
+
+        @param cvdrids: an iterable of CVDR ids (work ids or expression ids, with or without CVDR)
+        @param store: where to remember results, a store that can hold dicts.
+        Defaults to a L{wetsuite.helpers.localdata.MsgpackKV} called cvdr_versions.db in your user dir.
+        @param expiry_sec: how old stored results can get before we ask again.
+        @param works_per_query: how many works to put in one query.
+        Much larger makes for long URLs, which servers may refuse.
+        @param wait_between_sec: a pause between queries, to not hammer the server.
+        @param verbose: whether to print progress.
+        @return: a dict from each given id to a sorted list of version expression ids (each like 'CVDR101405_1').
+        Works that do not exist give an empty list.
+    '''
+    store = _cvdr_versions_store( store )
+    now = time.time()
+
+    work_of = {}      # what was asked -> work id
+    versions = {}     # work id -> list of expression ids
+    to_fetch = []     # work ids
+    to_fetch_set = set()
+    for cvdrid in cvdrids:
+        if cvdrid in work_of:
+            continue
+        work_id, _ = cvdr_parse_identifier( cvdrid )
+        work_of[cvdrid] = work_id
+        if work_id in versions or work_id in to_fetch_set:
+            continue
+        if work_id in _versions_cache  and  now - _versions_cache[work_id]['fetched'] <= expiry_sec:
+            versions[work_id] = _versions_cache[work_id]['versions']
+            continue
+        stored = store.get( work_id, missing_as_none=True )
+        if stored is not None  and  now - stored['fetched'] <= expiry_sec:
+            _versions_cache[work_id] = stored
+            versions[work_id] = stored['versions']
+            continue
+        to_fetch.append( work_id )
+        to_fetch_set.add( work_id )
+
+    if len(to_fetch) > 0:
+        sru_cvdr = wetsuite.datacollect.koop_repositories.CVDR() # TODO: see if doing this here stays valid
+        for batch_start in range(0, len(to_fetch), works_per_query):
+            if batch_start > 0:
+                time.sleep( wait_between_sec )
+            batch = to_fetch[batch_start:batch_start+works_per_query]
+            if verbose:
+                print( 'fetching versions for works %d..%d of %d'%(batch_start+1, batch_start+len(batch), len(to_fetch)) )
+
+            found = {}
+            for work_id in batch:
+                found[work_id] = []
+            query = ' or '.join( 'workid = CVDR%s'%work_id  for work_id in batch ) # TODO: maybe think about injection?
+            # search results arrive with namespaces stripped, so looking for the identifier directly is much cheaper than cvdr_meta()
+            for record in sru_cvdr.iter_search_retrieve( query, at_a_time=100, up_to=10000000, wait_between_sec=wait_between_sec ):
+                identifier = record.find('recordData/gzd/originalData/meta/owmskern/identifier')
+                if identifier is None  or  identifier.text is None:
+                    continue
+                result_work_id, _ = cvdr_parse_identifier( identifier.text )
+                if result_work_id in found: # should always be true, but don't trust a search to never be creative
+                    found[result_work_id].append( identifier.text )
+
+            fetched = time.time()
+            for work_id, expression_ids in found.items():
+                value = {'versions':sorted(expression_ids), 'fetched':fetched}
+                _versions_cache[work_id] = value
+                versions[work_id] = value['versions']
+                store.put( work_id, value, commit=False )
+            store.commit()
+
+    ret = {}
+    for cvdrid, work_id in work_of.items():
+        ret[cvdrid] = versions[work_id]
     return ret
 
 
@@ -40,6 +40,8 @@ CONSIDER: writing variants that do convert specific data, letting you e.g. set/f
 import os
 import os.path
 import time
+import math
+import hashlib
 import pathlib
 import random
 import collections.abc
@@ -116,7 +118,7 @@ class LocalKV:
 
         TODO: make a final decision where to sit between clean abstractions and convenience.
     '''
-    def __init__(self, path, key_type, value_type, read_only=False):
+    def __init__(self, path, key_type, value_type, read_only=False, check_same_thread=True):
         ''' Specify the path to the database file to open. 
 
             key_type and value_type do not have defaults, 
@@ -133,11 +135,15 @@ class LocalKV:
 
             @param read_only: is only enforced in this wrapper to give slightly more useful errors. (we also give SQLite a PRAGMA)
 
+            @param check_same_thread: handed to sqlite3.connect(). By default, only the thread that opened a store may use it.
+            Set this to False only if you intend to share this store between threads - and note that we do not lock anything, 
+            so e.g. interleaving put(commit=False) calls from different threads is your problem.
         '''
         self.path = path
         self.path = resolve_path(self.path)   # tries to centralize the absolute/relative path handling code logic
 
         self.read_only = read_only
+        self.check_same_thread = check_same_thread
         #self.use_wal = use_wal
 
         self._open()
@@ -163,7 +169,7 @@ class LocalKV:
         '''
         #make_tables = (self.path==':memory:')  or  ( not os.path.exists( self.path ) )
         #    will be creating that file, or are using an in-memory database ?  Also how to combine with read_only?
-        self.conn = sqlite3.connect( self.path, timeout=timeout )
+        self.conn = sqlite3.connect( self.path, timeout=timeout, check_same_thread=self.check_same_thread )
         # Note: curs.execute is the regular DB-API way,  conn.execute is a shorthand that gets a temporary cursor
         with self.conn:
             if self.read_only:
@@ -536,10 +542,10 @@ class MsgpackKV(LocalKV):
     
         Note that this does _not_ change how the meta table works.
     '''
-    def __init__(self, path, key_type=str, value_type=None, read_only=False):
+    def __init__(self, path, key_type=str, value_type=None, read_only=False, check_same_thread=True):
         ''' value_type is ignored; I need to restructure this
         '''
-        super().__init__( path, key_type=key_type, value_type=value_type, read_only=read_only )
+        super().__init__( path, key_type=key_type, value_type=value_type, read_only=read_only, check_same_thread=check_same_thread )
 
         # this is meant to be able to detect/signal incorrect interpretation, not fully used yet
         if self._get_meta('valtype', missing_as_none=True) is None:
@@ -585,7 +591,7 @@ class MsgpackKV(LocalKV):
 
 
 
-def cached_fetch(store:LocalKV, url:str, force_refetch:bool=False, sleep_sec:float=None, commit:bool=True) -> Tuple[bytes, bool]:
+def cached_fetch(store:LocalKV, url:str, force_refetch:bool=False, sleep_sec:float=None, commit:bool=True, known=None) -> Tuple[bytes, bool]:
     ''' Helper to use a str-to-bytes LocalKV to back URL fetches:
           - if URL is a key in the given store, 
             fetch from the store and return its value
@@ -601,6 +607,10 @@ def cached_fetch(store:LocalKV, url:str, force_refetch:bool=False, sleep_sec:flo
         @param url:       an URL string to fetch
         @param sleep_sec: whenever we fetch (rather than return from cache), sleep this long,
         so that when you use this in scraping, we can be nicer to a server.
+        (See also wetsuite.helpers.net.rate_limit(), which applies here too, and unlike this holds across threads and processes)
+        @param known:     optionally, a ScalableBloomFilter that holds all keys in the store (see its docstring).
+        When it says a URL is definitely not in there, we fetch without asking the store first.
+        Whatever we fetch and store gets added to it.
         @return: (data:bytes, whether_it_came_from_cache:bool)
 
         May raise 
@@ -620,23 +630,176 @@ def cached_fetch(store:LocalKV, url:str, force_refetch:bool=False, sleep_sec:flo
     # yes, the following could be a few lines shorter, but this is arguably a little more readable
     if force_refetch is False:
         try: # use cache?
+            if known is not None  and  url not in known:
+                raise KeyError('not in store, according to the filter')
             ret = store.get(url)
             return ret, True
         except KeyError: # get() notices it's not there, so fetch it ourselves
             data = wetsuite.helpers.net.download( url ) # note that this can error out, which we don't handle
             store.put( url, data, commit=commit )
+            if known is not None:
+                known.add( url )
             if sleep_sec is not None:
                 time.sleep( sleep_sec )
             return data, False
     else: # force_refetch is True
         data = wetsuite.helpers.net.download( url )
         store.put( url, data, commit=commit )
+        if known is not None:
+            known.add( url )
         if sleep_sec is not None:
             time.sleep( sleep_sec )
         return data, False
 
 
 
+class BloomFilter:
+    ''' A fixed-size Bloom filter over strings:
+        a set that answers "definitely not in here" or "probably in here" (wrong at most at about error_rate),
+        in a fixed amount of memory -- a few bits per item, regardless of how long the strings are.
+
+        You probably want ScalableBloomFilter, which grows as necessary.
+    '''
+    def __init__(self, capacity:int, error_rate:float=0.000001, _bits=None, _count=0):
+        ''' @param capacity: the amount of items after which the error rate starts going above what you asked for
+            @param error_rate: the false positive rate at capacity
+        '''
+        self.capacity   = int(capacity)
+        self.error_rate = error_rate
+        self.num_bits   = max(8, int( math.ceil( -self.capacity * math.log(error_rate) / (math.log(2)**2) ) ))
+        self.num_hashes = max(1, int( round( (self.num_bits / self.capacity) * math.log(2) ) ))
+        if _bits is None:
+            self.bits = bytearray( (self.num_bits + 7) // 8 )
+        else:
+            self.bits = bytearray( _bits )
+        self.count = _count
+
+    def _positions(self, key:str):
+        # enhanced double hashing (Dillinger & Manolios) - two 64-bit values from one digest give us as many positions as we need
+        # (plain double hashing correlates noticeably more when num_bits shares factors with the step).
+        # Plain python ints on a bytearray turn out to be a good deal faster than numpy for this few positions at a time.
+        digest = hashlib.sha1( key.encode('utf8') ).digest()
+        num_bits = self.num_bits
+        a = int.from_bytes( digest[:8],   'little' ) % num_bits
+        b = int.from_bytes( digest[8:16], 'little' ) % num_bits
+        ret = []
+        for i in range( self.num_hashes ):
+            ret.append( a )
+            a = (a + b) % num_bits
+            b = (b + i) % num_bits
+        return ret
+
+    def add(self, key:str):
+        ' add a string to the set '
+        bits = self.bits
+        for pos in self._positions( key ):
+            bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key:str):
+        bits = self.bits
+        for pos in self._positions( key ):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        ' the amount of add()s, which is an overestimate of the amount of unique items if you added things more than once '
+        return self.count
+
+
+
+class ScalableBloomFilter:
+    ''' A Bloom filter that adds larger filters as it fills up, so that you need not know the amount of items beforehand
+        (see "Scalable Bloom Filters", Almeida et al. 2007), and the error rate stays around what you asked for.
+
+        For example, ten million URLs at the default error rate take on the order of 40MB, 
+        where a set of those URL strings would be gigabytes.
+
+        Since it will occasionally say "probably yes" for something you never added, 
+        use it to skip work for things that are definitely new, 
+        and do an exact check (e.g. in a store) when you can't afford to be wrong -- see e.g. cached_fetch()'s known argument.
+
+        Can be persisted with to_bytes()/from_bytes() (e.g. into a MsgpackKV), or save()/load() to a file.
+    '''
+    def __init__(self, initial_capacity:int=100000, error_rate:float=0.000001, growth:int=4, tightening:float=0.8):
+        ''' @param initial_capacity: size of the first filter
+            @param error_rate: the overall false positive rate to aim for
+            @param growth:     each next filter is this many times larger than the last
+            @param tightening: each next filter has its error rate multiplied by this, which is what keeps the overall error rate bounded
+        '''
+        self.initial_capacity = initial_capacity
+        self.error_rate       = error_rate
+        self.growth           = growth
+        self.tightening       = tightening
+        self.filters          = []
+
+    def add(self, key:str):
+        ' add a string to the set (does nothing if it seems to be in there already, which keeps count more accurate) '
+        if key in self:
+            return
+        if len(self.filters) == 0  or  self.filters[-1].count >= self.filters[-1].capacity:
+            self.filters.append( BloomFilter(
+                capacity   = self.initial_capacity * (self.growth ** len(self.filters)),
+                # the first filter gets part of the error budget, and the tightening means the sum of all of them stays below error_rate
+                error_rate = self.error_rate * (1 - self.tightening) * (self.tightening ** len(self.filters)),
+            ) )
+        self.filters[-1].add( key )
+
+    def __contains__(self, key:str):
+        for bf in self.filters:
+            if key in bf:
+                return True
+        return False
+
+    def __len__(self):
+        return sum( len(bf)  for bf in self.filters )
+
+    def bytesize(self) -> int:
+        ' the amount of memory the bit arrays take '
+        return sum( len(bf.bits)  for bf in self.filters )
+
+    def to_bytes(self) -> bytes:
+        ' everything needed to reconstruct this filter, as bytes '
+        return msgpack.dumps( {
+            'initial_capacity':self.initial_capacity, 'error_rate':self.error_rate, 'growth':self.growth, 'tightening':self.tightening,
+            'filters':list( (bf.capacity, bf.error_rate, bf.count, bytes(bf.bits))  for bf in self.filters ),
+        } )
+
+    @classmethod
+    def from_bytes(cls, data:bytes):
+        ' the reverse of to_bytes() '
+        d = msgpack.loads( data )
+        ret = cls( initial_capacity=d['initial_capacity'], error_rate=d['error_rate'], growth=d['growth'], tightening=d['tightening'] )
+        ret.filters = list( BloomFilter( capacity, error_rate, _bits=bits, _count=count )  for capacity, error_rate, count, bits in d['filters'] )
+        return ret
+
+    def save(self, path:str):
+        ' write to a file (via a temporary file, so that you never see a half-written one) '
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write( self.to_bytes() )
+        os.replace( tmp_path, path )
+
+    @classmethod
+    def load(cls, path:str):
+        ' read from a file written by save() '
+        with open(path, 'rb') as f:
+            return cls.from_bytes( f.read() )
+
+    @classmethod
+    def from_store_keys(cls, store:LocalKV, **kwargs):
+        ''' Create a filter that holds all keys currently in a store, 
+            e.g. to then hand into cached_fetch()'s known argument. (This reads through all keys once.)
+            Keyword arguments are passed to the constructor.
+        '''
+        ret = cls( **kwargs )
+        for key in store.iterkeys():
+            ret.add( key )
+        return ret
+
+
+
 def resolve_path( name:str ):
     ''' Note: the KV classes call this internally. 
         This is here less for you to use directly, more explain why.
@@ -1,34 +1,65 @@
 #!/usr/bin/python3
-' network related helper functions, such as fetching from URLs '
+''' network related helper functions, such as fetching from URLs 
+
+    Also contains a record/replay ("cassette") mode, mostly for testing and benchmarking: ::
+        cassette_record( wetsuite.helpers.localdata.MsgpackKV('cassette.db') )
+        # ...do things that fetch, which will also be saved into that store...
+        cassette_replay( wetsuite.helpers.localdata.MsgpackKV('cassette.db'), simulate_latency=True )
+        # ...do the same things, which will now be answered from that store, without network access
+
+    This applies to everything that fetches via L{get} or L{download}, 
+    which is most of wetsuite's own fetching code (including sru, rechtspraaknl, and cached_fetch).
+
+    Also contains a rate limiter that is shared between processes on the same computer, e.g.: ::
+        rate_limit( 'overheid.nl', requests_per_sec=2 )
+    ...when done in each of several collecting scripts, keeps the combined rate of requests to *.overheid.nl 
+    at or under 2 per second, no matter how many processes and threads are fetching.
+    This also applies to everything that fetches via L{get} or L{download}.
+'''
 import sys
+import os
+import time
+import json
+import sqlite3
+import threading
+import urllib.parse
 
 import requests
 
 import wetsuite.helpers.format
+import wetsuite.helpers.util
 
 
-def download( url:str, tofile_path:str = None, show_progress=None, chunk_size=131072, timeout=10 ):
+def download( url:str, tofile_path:str = None, show_progress=None, chunk_size=131072, timeout=10, handle_chunk=None ):
     ''' Mostly just requests.get(), for byte-data download, with some optional extras,
         that make it a little more specifically useful for downloading.
 
         the main addition is the option to stream-download to filesystem:     
           - if tofile is not None, we stream-save to that file path, by name  (and return None)
           - if tofile is None      we return the data as a bytes object (which means we kept it in RAM, which may not be wise for huge downloads) 
+          - if handle_chunk is not None, we hand each chunk to that function as it comes in (and return None),
+            which lets you process a download while it happens (e.g. decompress it, hash it)
         uses requests's stream=True, which seems chunked HTTP transfer, or just a TCP window? TOCHECK
 
         @param tofile_path: If this is non-None, we open it as a filename and _stream_ the download to that if we can.
         @param show_progress: whether to print/show output on stderr while downloading.
         @param url: the URL to fetch data from
         @param chunk_size:
+        @param handle_chunk: If this is non-None, it should be a function that takes a bytes object. 
+        Overrides tofile_path.
 
         @return: byte
         if the HTTP response code is >=400 (actually if !response.ok, see requests's documentation), we raise a ValueError 
     '''
-    if tofile_path is not None:
+    return_data = False
+    if handle_chunk is not None:
+        pass
+    elif tofile_path is not None:
         f = open(tofile_path,'wb')
         def handle_chunk(data):
             f.write(data)
     else:
+        return_data = True
         ret = []
         def handle_chunk(data):
             ret.append(data)  # CONSIDER: using bytesIO to collect that
@@ -45,7 +76,7 @@ def download( url:str, tofile_path:str = None, show_progress=None, chunk_size=13
             )
         return "\rDownloaded %8sB  %s"%(wetsuite.helpers.format.kmgtp( fetched, kilo=1024 ), bar_str)
 
-    response = requests.get(
+    response = get(
         url,
         stream=True,
         headers={
@@ -75,5 +106,242 @@ def download( url:str, tofile_path:str = None, show_progress=None, chunk_size=13
         sys.stderr.write( progress_update()+'\n' )
         sys.stderr.flush()
 
-    if tofile_path is None:
+    if return_data:
         return b''.join( ret )
+
+
+
+### Record/replay
+
+_cassette_store            = None
+_cassette_mode             = None  # None, 'record', or 'replay'
+_cassette_simulate_latency = False
+_cassette_lock             = threading.Lock()  # get() may be called from multiple threads, the store should only see one at a time
+
+
+def cassette_record(store):
+    ''' From now on, every get() (and so download()) also saves the response into the given store,
+        keyed by URL, along with how long it took.
+
+        @param store: a store that can hold dicts, e.g. a L{wetsuite.helpers.localdata.MsgpackKV}.
+        If the fetching happens in more than one thread (as e.g. with workers= arguments), open it with check_same_thread=False
+        (we serialize our own access to it).
+    '''
+    global _cassette_store, _cassette_mode
+    _cassette_store, _cassette_mode = store, 'record'
+
+
+def cassette_replay(store, simulate_latency=False):
+    ''' From now on, every get() (and so download()) is answered from the given store, and never touches the network.
+        URLs that were not recorded raise a KeyError.
+
+        @param store: a store previously filled via cassette_record() (see the note there about threads)
+        @param simulate_latency: if False, answer immediately.
+        If True, sleep as long as the original request took.
+        If a number, sleep as long as the original request took times that number. 
+    '''
+    global _cassette_store, _cassette_mode, _cassette_simulate_latency
+    _cassette_store, _cassette_mode = store, 'replay'
+    _cassette_simulate_latency = simulate_latency
+
+
+def cassette_off():
+    ' Go back to regular network fetching '
+    global _cassette_store, _cassette_mode
+    _cassette_store, _cassette_mode = None, None
+
+
+class _CassetteResponse:
+    ''' Imitates enough of requests.Response for what our own code uses of it.  
+        (status_code, ok, url, headers, content, text, json(), iter_content(), close()) 
+    '''
+    def __init__(self, recorded:dict):
+        self.status_code = recorded['status_code']
+        self.url         = recorded['url']
+        self.headers     = requests.structures.CaseInsensitiveDict( recorded['headers'] )
+        self.content     = recorded['content']
+        self.ok          = self.status_code < 400
+
+    @property
+    def text(self):
+        ' decoded content (we assume UTF8, unlike requests, which is cleverer) '
+        return self.content.decode('utf8')
+
+    def json(self):
+        ' parse content as JSON '
+        return json.loads( self.content )
+
+    def iter_content(self, chunk_size=1):
+        ' yields the content in chunks, like the requests function of the same name '
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i+chunk_size]
+
+    def close(self):
+        ' does nothing, there is no connection to give back '
+
+
+### Spacing out requests within a process
+
+class RequestSpacing:
+    ''' Shared between threads, makes sure that the start of any two requests is at least some time apart 
+        (a politeness budget for the server, regardless of how many workers we have).
+
+        Unlike rate_limit(), this applies only to the code that waits on this object, 
+        e.g. one harvest that fetches with several threads, and it changes nothing for the rest of the process.
+    '''
+    def __init__(self, min_interval_sec:float):
+        self.min_interval_sec = min_interval_sec
+        self.next_time        = 0
+        self.lock             = threading.Lock()
+
+    def wait(self):
+        " blocks until it is this caller's turn to start a request "
+        with self.lock:
+            now       = time.time()
+            start_at  = max(now, self.next_time)
+            self.next_time = start_at + self.min_interval_sec
+        if start_at > now:
+            time.sleep( start_at - now )
+
+
+### Rate limiting shared between processes
+
+_rate_limits     = {}    # domain -> (requests_per_sec, burst)
+_rate_limit_path = None
+_rate_limit_conn = None
+_rate_limit_lock = threading.Lock()
+
+
+def rate_limit(domain:str, requests_per_sec:float, burst:int=1, path:str=None):
+    ''' From now on, requests (via get(), and so download() and cached_fetch()) to this domain and its subdomains
+        are held back so that, combined over all threads and all processes that do the same, 
+        they stay at or under requests_per_sec.
+
+        This is a token bucket, with its state in a small SQLite file that all processes on this computer share,
+        so do this in each process (with the same values).
+
+        @param domain: e.g. 'overheid.nl' also applies to zoek.officielebekendmakingen.nl and data.overheid.nl;
+        'repository.overheid.nl' applies only to that host.  All hosts under the same domain share one budget.
+        @param requests_per_sec: the sustained rate, which must be more than zero. None removes the limit for that domain.
+        @param burst: how many requests may go immediately after a quiet period, before the rate applies.
+        @param path: the shared file. By default this is rate_limits.db in wetsuite's stores directory. 
+        Can only be set once per process (the first time you call this).
+    '''
+    global _rate_limit_path
+    if requests_per_sec is not None  and  not requests_per_sec > 0:
+        raise ValueError('requests_per_sec should be more than zero (or None to remove the limit), not %r'%(requests_per_sec,))
+    with _rate_limit_lock:
+        if _rate_limit_path is None:
+            if path is None:
+                path = os.path.join( wetsuite.helpers.util.wetsuite_dir()['stores_dir'], 'rate_limits.db' )
+            _rate_limit_path = path
+        elif path is not None  and  path != _rate_limit_path:
+            raise ValueError('rate limiting already uses %r, cannot also use %r'%(_rate_limit_path, path))
+
+        if requests_per_sec is None:
+            _rate_limits.pop( domain.lower(), None )
+        else:
+            _rate_limits[ domain.lower() ] = (float(requests_per_sec), max(1, int(burst)))
+
+
+def rate_limit_off():
+    ' Remove all rate limits (in this process) '
+    global _rate_limit_path, _rate_limit_conn
+    with _rate_limit_lock:
+        _rate_limits.clear()
+        if _rate_limit_conn is not None:
+            _rate_limit_conn.close()
+        _rate_limit_path, _rate_limit_conn = None, None
+
+
+def _rate_limit_domain(url:str):
+    ' the domain we have a rate limit for that applies to this URL, or None '
+    host = (urllib.parse.urlparse( url ).hostname or '').lower()
+    while True:
+        if host in _rate_limits:
+            return host
+        if '.' not in host:
+            return None
+        host = host.split('.', 1)[1]
+
+
+def _rate_limit_wait(url:str):
+    ''' If there is a rate limit for this URL's host, take a token from its shared bucket, 
+        sleeping until there is one if necessary.
+
+        We let the bucket go negative, meaning "the next this-many tokens are already claimed",
+        so each caller only needs one short transaction, and callers are served in the order they asked.
+    '''
+    global _rate_limit_conn
+    if len(_rate_limits) == 0:
+        return
+    domain = _rate_limit_domain( url )
+    if domain is None:
+        return
+    requests_per_sec, burst = _rate_limits[domain]
+
+    with _rate_limit_lock:
+        if _rate_limit_conn is None:
+            # isolation_level=None so we control the transactions ourselves;  our own lock makes sharing between threads fine
+            _rate_limit_conn = sqlite3.connect( _rate_limit_path, timeout=60, isolation_level=None, check_same_thread=False )
+            _rate_limit_conn.execute( 'CREATE TABLE IF NOT EXISTS bucket (domain TEXT PRIMARY KEY, tokens REAL, updated REAL)' )
+        curs = _rate_limit_conn.cursor()
+        curs.execute( 'BEGIN IMMEDIATE' ) # take the write lock before reading, so that no other process reads the same state
+        try:
+            now = time.time()
+            curs.execute( 'SELECT tokens, updated FROM bucket WHERE domain=?', (domain,) )
+            row = curs.fetchone()
+            if row is None:
+                tokens = burst
+            else:
+                tokens = min( burst, row[0] + (now - row[1]) * requests_per_sec )
+            tokens -= 1
+            curs.execute( 'INSERT INTO bucket (domain, tokens, updated) VALUES (?, ?, ?)  ON CONFLICT (domain) DO UPDATE SET tokens=?, updated=?',
+                          (domain, tokens, now, tokens, now) )
+            curs.execute( 'COMMIT' )
+        except BaseException:
+            curs.execute( 'ROLLBACK' )
+            raise
+
+    if tokens < 0:
+        time.sleep( -tokens / requests_per_sec )
+
+
+
+def get(url:str, timeout=10, headers=None, stream=False, allow_redirects=True, session=None):
+    ''' requests.get(), except that it listens to the record/replay setting (see cassette_record and cassette_replay),
+        and to rate limits (see rate_limit).
+        Use this instead of requests.get when you want your fetching code to be testable/benchmarkable without network.
+
+        @param session: if not None, a requests.Session to do the request with, 
+        e.g. to reuse connections when doing many requests to the same host.
+
+        @return: a requests.Response object, or in replay mode a lookalike.
+        Note that this does not raise on HTTP errors, that is up to you.
+    '''
+    if _cassette_mode == 'replay':
+        with _cassette_lock:
+            recorded = _cassette_store.get( url, missing_as_none=True )
+        if recorded is None:
+            raise KeyError("URL %r is not in the cassette we are replaying"%url)
+        if _cassette_simulate_latency not in (False, None):
+            time.sleep( recorded['elapsed_sec'] * float(_cassette_simulate_latency) )
+        return _CassetteResponse( recorded )
+
+    _rate_limit_wait( url )
+
+    started  = time.time()
+    response = (session or requests).get( url, timeout=timeout, headers=headers, stream=stream and _cassette_mode is None, allow_redirects=allow_redirects )
+
+    if _cassette_mode == 'record':
+        recorded = {
+            'status_code': response.status_code,
+            'url':         response.url,
+            'headers':     dict( response.headers ),
+            'content':     response.content,   # which means we don't stream when recording
+            'elapsed_sec': time.time() - started,
+        }
+        with _cassette_lock:
+            _cassette_store.put( url, recorded )
+
+    return response
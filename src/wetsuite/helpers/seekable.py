@@ -0,0 +1,395 @@
+''' A compressed file format that still allows reading at any offset,
+    so that e.g. a SQLite database can be used while it stays compressed on disk.
+
+    The data is cut into fixed-size blocks that are compressed independently, followed by an index of where each block starts.
+    Reading at an offset means decompressing only the block(s) it falls in (and we keep recently used blocks around),
+    which suits SQLite, which reads pages of a few kilobytes at a time, and often the same ones.
+
+    The layout is: ::
+        compressed block 0, compressed block 1, ...
+        index: the file offset of each block, and of the end of the last, as little-endian uint64s
+        footer: index offset, uncompressed size, block size (all uint64), codec (uint32), MAGIC
+
+    For example: ::
+        compress_file( 'dataset.db', 'dataset.db.seekable' )
+        store = open_store( 'dataset.db.seekable' )   # a read-only LocalKV (or MsgpackKV), via apsw
+        store.get('somekey')
+
+    Reading the file as bytes needs only the standard library (unless it was compressed with zstd);
+    opening it as a SQLite database needs the apsw module, because python's own sqlite3 module cannot be told how to read files.
+
+    CONSIDER: also reading standard seekable formats (e.g. zstd's seekable format, or xz files with many blocks).
+'''
+import os
+import lzma
+import zlib
+import struct
+import threading
+import collections
+import concurrent.futures
+
+import wetsuite.helpers.localdata
+
+
+MAGIC = b'WSSEEK01'
+_FOOTER = struct.Struct( '<QQQI8s' )
+
+_CODECS = {'xz':1, 'zlib':2, 'zstd':3}
+
+
+def _zstandard():
+    ' import zstandard, which is not a hard dependency, so only when we need it '
+    try:
+        import zstandard
+    except ImportError as ie:
+        raise ImportError("The zstd codec needs the zstandard module (e.g. pip3 install zstandard)") from ie
+    return zstandard
+
+
+def _compressor(codec:str, level:int=None):
+    ' returns a function that compresses a block '
+    if codec == 'xz':
+        preset = 6 if level is None else level
+        return lambda data: lzma.compress( data, preset=preset )
+    elif codec == 'zlib':
+        zlevel = 6 if level is None else level
+        return lambda data: zlib.compress( data, zlevel )
+    elif codec == 'zstd':
+        zstandard = _zstandard()
+        zlevel = 3 if level is None else level
+        return lambda data: zstandard.ZstdCompressor( level=zlevel ).compress( data )
+    else:
+        raise ValueError( 'Do not know codec %r, choose one of %s'%(codec, ', '.join(_CODECS)) )
+
+
+def _decompressor(codec_id:int):
+    ' returns a function that decompresses a block '
+    if codec_id == _CODECS['xz']:
+        return lzma.decompress
+    elif codec_id == _CODECS['zlib']:
+        return zlib.decompress
+    elif codec_id == _CODECS['zstd']:
+        zstandard = _zstandard()
+        return lambda data: zstandard.ZstdDecompressor().decompress( data )
+    else:
+        raise ValueError( 'Do not know codec number %r - maybe this file was written by a newer version?'%codec_id )
+
+
+def is_seekable_file(path:str) -> bool:
+    ' Does this file look like one written by this module (checks the footer) '
+    with open(path, 'rb') as f:
+        f.seek( 0, os.SEEK_END )
+        if f.tell() < _FOOTER.size:
+            return False
+        f.seek( -len(MAGIC), os.SEEK_END )
+        return f.read( len(MAGIC) ) == MAGIC
+
+
+class SeekableWriter:
+    ''' Write data in (any size of) pieces, which get compressed into the seekable format.
+
+        Compression of blocks can be spread over threads (lzma, zlib, and zstandard all let go of the GIL while they work),
+        while blocks are still written in order.
+    '''
+    def __init__(self, fileobj, block_size:int=131072, codec:str='xz', level:int=None, workers:int=1):
+        ''' @param fileobj: a file object opened for binary writing. We do not close it.
+            @param block_size: the uncompressed size of each block.
+            Smaller means less work per random read, larger means better compression.
+            @param codec: 'xz' (best compression), 'zlib' (faster to read), or 'zstd' (both, but needs the zstandard module)
+            @param level: compression level, the default depends on codec.
+            @param workers: how many threads to compress with.
+        '''
+        self.fileobj    = fileobj
+        self.block_size = block_size
+        self.codec_id   = _CODECS.get( codec )
+        self.compress   = _compressor( codec, level )
+        self.offsets    = []
+        self.size       = 0
+        self.position   = 0
+        self._buffer    = bytearray()
+        self._executor  = None
+        self._in_flight = collections.deque()
+        if workers > 1:
+            self._executor = concurrent.futures.ThreadPoolExecutor( max_workers=workers )
+        self._max_in_flight = 2 * workers
+
+
+    def write(self, data:bytes):
+        ' add data '
+        self._buffer += data
+        self.size += len(data)
+        while len(self._buffer) >= self.block_size:
+            self._add_block( bytes(self._buffer[:self.block_size]) )
+            del self._buffer[:self.block_size]
+
+
+    def _add_block(self, block:bytes):
+        if self._executor is None:
+            self._write_compressed( self.compress( block ) )
+        else:
+            self._in_flight.append( self._executor.submit( self.compress, block ) )
+            while len(self._in_flight) >= self._max_in_flight:
+                self._write_compressed( self._in_flight.popleft().result() )
+
+
+    def _write_compressed(self, compressed:bytes):
+        self.offsets.append( self.position )
+        self.fileobj.write( compressed )
+        self.position += len(compressed)
+
+
+    def close(self):
+        ' writes the last block, the index, and the footer.  Does not close the file object. '
+        if len(self._buffer) > 0:
+            self._add_block( bytes(self._buffer) )
+            self._buffer = bytearray()
+        while len(self._in_flight) > 0:
+            self._write_compressed( self._in_flight.popleft().result() )
+        if self._executor is not None:
+            self._executor.shutdown()
+
+        index_offset = self.position
+        offsets = self.offsets + [self.position]
+        self.fileobj.write( struct.pack( '<%dQ'%len(offsets), *offsets ) )
+        self.fileobj.write( _FOOTER.pack( index_offset, self.size, self.block_size, self.codec_id, MAGIC ) )
+
+
+def compress_file(in_path:str, out_path:str, block_size:int=131072, codec:str='xz', level:int=None, workers:int=None):
+    ''' Compress a file into the seekable format.
+
+        @param in_path: the file to read
+        @param out_path: the file to write (overwritten if it exists)
+        @param workers: threads to compress with, None means as many as there are CPUs
+        (other parameters are as in SeekableWriter)
+    '''
+    if workers is None:
+        workers = os.cpu_count() or 1
+    with open(in_path, 'rb') as inf, open(out_path, 'wb') as outf:
+        writer = SeekableWriter( outf, block_size=block_size, codec=codec, level=level, workers=workers )
+        while True:
+            data = inf.read( 16*block_size )
+            if len(data) == 0:
+                break
+            writer.write( data )
+        writer.close()
+
+
+class SeekableReader:
+    ''' Reads a file in the seekable format, as if it were the uncompressed file.
+
+        Can be used as a (read-only, binary) file object, and also has pread(), which is safe to call from multiple threads.
+    '''
+    def __init__(self, path:str, cache_blocks:int=64):
+        ''' @param path: the file to open
+            @param cache_blocks: how many decompressed blocks to keep around
+        '''
+        self.path = path
+        self._f = open(path, 'rb')
+        self._f.seek( -_FOOTER.size, os.SEEK_END )
+        index_offset, self.size, self.block_size, codec_id, magic = _FOOTER.unpack( self._f.read(_FOOTER.size) )
+        if magic != MAGIC:
+            self._f.close()
+            raise ValueError( '%r does not look like a seekable compressed file'%path )
+        self.decompress = _decompressor( codec_id )
+
+        num_blocks = (self.size + self.block_size - 1) // self.block_size
+        self._f.seek( index_offset )
+        self.offsets = struct.unpack( '<%dQ'%(num_blocks+1), self._f.read( 8*(num_blocks+1) ) )
+
+        self.cache_blocks = cache_blocks
+        self._cache       = collections.OrderedDict()  # block number -> decompressed bytes, in order of use
+        self._lock        = threading.Lock()
+        self._position    = 0
+
+
+    def _block(self, num:int) -> bytes:
+        ' the decompressed contents of a block, from our cache if we can '
+        with self._lock:
+            if num in self._cache:
+                self._cache.move_to_end( num )
+                return self._cache[num]
+            start, end = self.offsets[num], self.offsets[num+1]
+            self._f.seek( start )
+            compressed = self._f.read( end - start )
+        # decompress outside the lock, so that threads can do that at the same time
+        data = self.decompress( compressed )
+        with self._lock:
+            self._cache[num] = data
+            while len(self._cache) > self.cache_blocks:
+                self._cache.popitem( last=False )
+        return data
+
+
+    def pread(self, offset:int, amount:int) -> bytes:
+        ' read amount bytes at offset (fewer at the end of the data), without changing the position that read() uses '
+        if offset < 0:
+            raise ValueError('negative offset')
+        amount = max(0, min(amount, self.size - offset))
+        ret = []
+        while amount > 0:
+            num, within = divmod( offset, self.block_size )
+            piece = self._block( num )[within:within+amount]
+            ret.append( piece )
+            offset += len(piece)
+            amount -= len(piece)
+        return b''.join( ret )
+
+
+    def read(self, amount:int=-1) -> bytes:
+        ' read from the current position, like a file object '
+        if amount is None  or  amount < 0:
+            amount = self.size - self._position
+        data = self.pread( self._position, amount )
+        self._position += len(data)
+        return data
+
+
+    def seek(self, offset:int, whence:int=os.SEEK_SET) -> int:
+        ' like a file object '
+        if whence == os.SEEK_SET:
+            self._position = offset
+        elif whence == os.SEEK_CUR:
+            self._position += offset
+        elif whence == os.SEEK_END:
+            self._position = self.size + offset
+        else:
+            raise ValueError('bad whence %r'%whence)
+        return self._position
+
+
+    def tell(self) -> int:
+        ' like a file object '
+        return self._position
+
+
+    def close(self):
+        ' close the underlying file '
+        self._f.close()
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+
+
+### Letting SQLite read these files
+
+_VFS_NAME = 'wetsuite_seekable'
+_vfs      = None
+_vfs_lock = threading.Lock()
+
+
+def _apsw():
+    ' import apsw, which is not a hard dependency, so only when we need it '
+    try:
+        import apsw
+    except ImportError as ie:
+        raise ImportError("Opening compressed SQLite files needs the apsw module (e.g. pip3 install apsw)") from ie
+    return apsw
+
+
+def _register_vfs():
+    ''' Tells SQLite (via apsw) about a VFS that reads our format.
+        Only files opened with that VFS are affected, which is only what open_connection() opens.
+    '''
+    global _vfs
+    apsw = _apsw()
+
+    class _SeekableVFSFile:
+        ' what SQLite sees as a (read-only) file '
+        def __init__(self, path):
+            self.reader = SeekableReader( path )
+
+        def xRead(self, amount, offset):
+            return self.reader.pread( offset, amount ) # SQLite deals with short reads at the end
+
+        def xFileSize(self):
+            return self.reader.size
+
+        def xClose(self):
+            self.reader.close()
+
+        def xWrite(self, data, offset):
+            raise apsw.ReadOnlyError('seekable compressed files are read-only')
+
+        def xTruncate(self, newsize):
+            raise apsw.ReadOnlyError('seekable compressed files are read-only')
+
+        def xSync(self, flags):
+            pass
+
+        # immutable=1 means SQLite should not need to lock, but answer sensibly anyway
+        def xLock(self, level):
+            pass
+
+        def xUnlock(self, level):
+            pass
+
+        def xCheckReservedLock(self):
+            return False
+
+        def xFileControl(self, op, ptr):
+            return False
+
+        def xSectorSize(self):
+            return 4096
+
+        def xDeviceCharacteristics(self):
+            return apsw.mapping_device_characteristics['SQLITE_IOCAP_IMMUTABLE']
+
+    class _SeekableVFS(apsw.VFS):
+        ' opens the main database with _SeekableVFSFile; leaves everything else (e.g. checking for journals) to the default VFS '
+        def __init__(self):
+            super().__init__( _VFS_NAME, base='' )
+
+        def xOpen(self, name, flags):
+            if isinstance(name, apsw.URIFilename):
+                name = name.filename()
+            if flags[0] & apsw.SQLITE_OPEN_MAIN_DB:
+                return _SeekableVFSFile( name )
+            raise apsw.CantOpenError('only the main database can be opened from a seekable compressed file')
+
+    with _vfs_lock:
+        if _vfs is None:
+            _vfs = _SeekableVFS()
+
+
+def open_connection(path:str):
+    ''' Open a SQLite database stored in our seekable format, read-only.
+        @return: an apsw.Connection
+    '''
+    apsw = _apsw()
+    _register_vfs()
+    path = os.path.abspath( path )
+    return apsw.Connection( 'file:%s?immutable=1'%path,
+                            flags=apsw.SQLITE_OPEN_READONLY | apsw.SQLITE_OPEN_URI, vfs=_VFS_NAME )
+
+
+class _SeekableOpen:
+    ' makes a LocalKV subclass open its path as a seekable compressed file (read-only) instead of a regular database file '
+    def _open(self, timeout=3.0):
+        if not self.read_only:
+            raise ValueError('seekable compressed stores can only be opened read-only')
+        self.conn = open_connection( self.path )
+
+
+class SeekableLocalKV(_SeekableOpen, wetsuite.helpers.localdata.LocalKV):
+    ' A read-only LocalKV that reads from a seekable compressed file. You probably want open_store() instead. '
+
+
+class SeekableMsgpackKV(_SeekableOpen, wetsuite.helpers.localdata.MsgpackKV):
+    ' A read-only MsgpackKV that reads from a seekable compressed file. You probably want open_store() instead. '
+
+
+def open_store(path:str):
+    ''' Open a compressed copy of a LocalKV or MsgpackKV store (read-only),
+        as whichever of the two it was (according to the metadata it was written with).
+    '''
+    store = SeekableLocalKV( path, None, None, read_only=True )
+    if store._get_meta('valtype', missing_as_none=True) == 'msgpack':
+        store.close()
+        store = SeekableMsgpackKV( path, None, None, read_only=True )
+    return store
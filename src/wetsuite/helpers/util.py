@@ -1,6 +1,8 @@
 ''' General utility functions, like "give me a path to where wetsuite can store data" and debug tools to the end of inspecting data. 
 '''
 import os
+import json
+import codecs
 import difflib
 import hashlib
 
@@ -129,3 +131,122 @@ def hash_hex(data:bytes, as_bytes:bool=False):
         return s1h.digest()
     else:
         return s1h.hexdigest()
+
+
+def json_stream_items(fileobj, path=(), chunk_size:int=1048576, siblings:dict=None):
+    ''' Reads a JSON document from a file object a chunk at a time, 
+        and yields the contents of the array or object at the given path, one item at a time,
+        so that you never need the whole parsed document in memory (only one item, and a chunk of the text).
+
+        For example, given a file containing ::
+            {"description":"...", "data":{"a":[1,2], "b":[3]}}
+        json_stream_items(f, ['data']) yields ('a', [1, 2]) and then ('b', [3]) - (key, value) pairs for an object,
+        and for an array it would yield just each value.
+
+        Everything not on the path is parsed and thrown away (so e.g. a large sibling still costs time, but not memory after).
+        This uses only the standard library's JSON decoder, for each item.
+
+        @param fileobj: a file object opened in binary (assumed UTF-8) or text mode
+        @param path: a sequence of object keys to go into, starting from the top. Empty means the top itself.
+        @param chunk_size: how much to read at a time
+        @param siblings: if you hand in a dict, it is filled with the other members of the object that contains the last key of the path.
+        e.g. in the example above, after you consume all items, it would be {'description':'...'}.
+        Those are decoded whole, so this is meant for the small parts next to a large one.
+        @raise KeyError: if the path is not in the document
+        @raise ValueError: if the document is not valid JSON (in the parts we look at), or the thing at path is not an array or object
+    '''
+    decoder = json.JSONDecoder()
+    if isinstance( fileobj.read(0), bytes ):
+        text_decoder = codecs.getincrementaldecoder('utf-8')()
+        def read(amount):
+            data = fileobj.read( amount )
+            return text_decoder.decode( data, final=(len(data) == 0) ), len(data) == 0
+    else:
+        def read(amount):
+            data = fileobj.read( amount )
+            return data, len(data) == 0
+
+    state = {'buf':'', 'pos':0, 'eof':False}
+
+    def more(amount=chunk_size):
+        ' read more, dropping what we have already handled.  Returns False at end of file '
+        if state['eof']:
+            return False
+        state['buf'] = state['buf'][ state['pos']: ]
+        state['pos'] = 0
+        data, state['eof'] = read( amount )
+        state['buf'] += data
+        return True
+
+    def peek():
+        ' skip whitespace, return the next character (without consuming it), or None at the end '
+        while True:
+            buf, pos = state['buf'], state['pos']
+            while pos < len(buf)  and  buf[pos] in ' \t\r\n':
+                pos += 1
+            state['pos'] = pos
+            if pos < len(buf):
+                return buf[pos]
+            if not more():
+                return None
+
+    def expect(chars):
+        char = peek()
+        if char is None  or  char not in chars:
+            raise ValueError('Expected one of %r, found %r'%(chars, char))
+        state['pos'] += 1
+        return char
+
+    def value():
+        ' decode the next value '
+        peek()
+        while True:
+            try:
+                ret, end = decoder.raw_decode( state['buf'], state['pos'] )
+                # a number that seems to end at the end of (or partway into) what we have may continue in the next chunk,
+                # so only believe it when we see what comes after it
+                if state['eof']  or  (end < len(state['buf'])  and  state['buf'][end] in ' \t\r\n,:]}'):
+                    state['pos'] = end
+                    return ret
+            except json.JSONDecodeError:
+                if state['eof']:
+                    raise
+            # not complete yet.  Grow what we read each time, so that large values are not re-parsed too many times
+            more( max(chunk_size, len(state['buf']) - state['pos']) )
+
+    for i, key in enumerate(path):
+        keep = siblings is not None  and  i == len(path)-1
+        expect('{')
+        if peek() == '}':
+            raise KeyError('%r not in the document'%key)
+        while True:
+            member = value()
+            expect(':')
+            if member == key:
+                break
+            sibling = value()
+            if keep:
+                siblings[member] = sibling
+            if expect(',}') == '}':
+                raise KeyError('%r not in the document'%key)
+
+    opener = expect('[{')
+    closer = ']' if opener == '[' else '}'
+    if peek() != closer:
+        while True:
+            if opener == '[':
+                yield value()
+            else:
+                member = value()
+                expect(':')
+                yield member, value()
+            if expect(','+closer) == closer:
+                break
+    else:
+        expect(closer)
+
+    if siblings is not None  and  len(path) > 0: # the rest of the object we were in
+        while expect(',}') == ',':
+            member = value()
+            expect(':')
+            siblings[member] = value()
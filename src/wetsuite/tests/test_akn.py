@@ -34,3 +34,74 @@ def test_invalid2():
     ' test that we signal remote failure to resolve '
     with pytest.raises(ValueError):
         resolve('/akn/nl/officialGazette/stcrt/2018')
+
+
+def test_resolve_many(monkeypatch):
+    ' test that resolve_many looks up each AKN once, and caches both results and failures '
+    import wetsuite.extras.akn
+    import wetsuite.helpers.net
+    import wetsuite.helpers.localdata
+
+    good, bad = '/akn/nl/act/gemeente/2024/CVDR696162', '/akn/nl/officialGazette/stcrt/2018'
+    cassette = wetsuite.helpers.localdata.MsgpackKV(':memory:', check_same_thread=False)
+    for akn, final_url in ( (good, 'https://lokaleregelgeving.overheid.nl/CVDR696162/1'),
+                            (bad,  'https://identifier.overheid.nl/akn/nl/officialGazette/stcrt/2018') ):
+        url = 'https://identifier.overheid.nl/'+akn.lstrip('/')
+        cassette.put( url, {'status_code':200, 'url':final_url, 'headers':{}, 'content':b'', 'elapsed_sec':0.0} )
+
+    asked = []
+    real_resolve = wetsuite.extras.akn.resolve
+    def counting_resolve(akn, **kwargs):
+        asked.append( akn )
+        return real_resolve( akn, **kwargs )
+    monkeypatch.setattr( wetsuite.extras.akn, 'resolve', counting_resolve )
+
+    store = wetsuite.helpers.localdata.LocalKV(':memory:', str, str)
+    wetsuite.helpers.net.cassette_replay( cassette )
+    try:
+        expect = {good:'https://lokaleregelgeving.overheid.nl/CVDR696162/1', bad:None, 'BLAH':None}
+        assert wetsuite.extras.akn.resolve_many( [good, bad, good, 'BLAH', bad, good], store=store, workers=3 ) == expect
+        assert sorted(asked) == sorted([good, bad])
+
+        # second time around, both the success and the failure come from the store
+        assert wetsuite.extras.akn.resolve_many( [good, bad, 'BLAH'], store=store ) == expect
+        assert len(asked) == 2
+        with pytest.raises(ValueError):
+            wetsuite.extras.akn.cached_resolve( bad, store=store )
+        assert len(asked) == 2
+
+        # ...until the failure expires
+        wetsuite.extras.akn.resolve_many( [good, bad], store=store, negative_expiry_sec=-1 )
+        assert asked[2:] == [bad]
+    finally:
+        wetsuite.helpers.net.cassette_off()
+
+
+def test_server_errors_not_remembered():
+    ' test that server errors and rate limiting (unlike AKNs that do not resolve, including a 404) are not cached as failures '
+    import requests
+    import wetsuite.extras.akn
+    import wetsuite.helpers.net
+    import wetsuite.helpers.localdata
+
+    busy, limited, gone = '/akn/nl/act/gemeente/2024/CVDR696163', '/akn/nl/act/gemeente/2024/CVDR696164', '/akn/nl/act/gemeente/2024/CVDR696165'
+    cassette = wetsuite.helpers.localdata.MsgpackKV(':memory:', check_same_thread=False)
+    for akn, status in ( (busy, 503), (limited, 429), (gone, 404) ):
+        url = 'https://identifier.overheid.nl/'+akn.lstrip('/')
+        cassette.put( url, {'status_code':status, 'url':url, 'headers':{}, 'content':b'', 'elapsed_sec':0.0} )
+
+    store = wetsuite.helpers.localdata.LocalKV(':memory:', str, str)
+    wetsuite.helpers.net.cassette_replay( cassette )
+    try:
+        for akn in (busy, limited):
+            with pytest.raises(requests.exceptions.HTTPError):
+                wetsuite.extras.akn.cached_resolve( akn, store=store )
+        assert wetsuite.extras.akn.resolve_many( [busy, limited], store=store ) == {busy:None, limited:None}
+        assert len(store) == 0
+
+        # whereas a 404 means it did not resolve, which is remembered
+        with pytest.raises(ValueError):
+            wetsuite.extras.akn.cached_resolve( gone, store=store )
+        assert list(store.keys()) == [gone]
+    finally:
+        wetsuite.helpers.net.cassette_off()
@@ -41,3 +41,423 @@ def test_dataset_class_export( tmp_path ):
     ds.export_files( tmp_path )
 
     # TODO: more        
+
+
+def test_stream_decompressor():
+    ' test that chunked decompression gives the original data, also across concatenated streams (as parallel compressors make) '
+    import bz2, lzma, gzip
+    data = b'foo bar quu '*10000
+    for url, compress in ( ('x.xz', lzma.compress), ('x.bz2', bz2.compress), ('x.gz', gzip.compress) ):
+        compressed = compress( data[:50000] ) + compress( data[50000:] )
+        sd = wetsuite.datasets._decompressor_for_url( url )
+        out = []
+        for i in range(0, len(compressed), 1000):
+            out.append( sd.decompress( compressed[i:i+1000] ) )
+        assert sd.eof
+        assert b''.join(out) == data
+
+    assert wetsuite.datasets._decompressor_for_url( 'x.json' ) is None
+
+
+def test_stream_decompressor_xz_padding():
+    ' test that xz stream padding (NUL bytes in multiples of four, between and after streams) is skipped, also across chunks '
+    import lzma
+    data = b'foo bar quu '*10000
+    compressed = lzma.compress( data[:50000] ) + b'\0'*8 + lzma.compress( data[50000:] ) + b'\0'*4
+    for chunk_size in (1000, 3, len(compressed)):
+        sd = wetsuite.datasets._decompressor_for_url( 'x.xz' )
+        out = list( sd.decompress( compressed[i:i+chunk_size] )  for i in range(0, len(compressed), chunk_size) )
+        assert sd.eof
+        assert b''.join(out) == data
+
+    sd = wetsuite.datasets._decompressor_for_url( 'x.xz' )
+    sd.decompress( lzma.compress(data) + b'\0'*3 )
+    assert not sd.eof  # not valid padding, unless more follows
+    with pytest.raises(ValueError):
+        sd.decompress( lzma.compress(data) )
+
+
+def test_stream_decompressor_truncated():
+    ' test that we can tell a truncated download from a complete one '
+    import lzma
+    compressed = lzma.compress( b'foo bar quu '*10000 )
+    sd = wetsuite.datasets._decompressor_for_url( 'x.xz' )
+    sd.decompress( compressed[:len(compressed)//2] )
+    assert not sd.eof
+
+
+def test_json_dataset_to_store( tmp_path, monkeypatch ):
+    ' test that a JSON dataset is converted to a store once, which later loads then use, and that list-valued data still loads '
+    import json, os, time
+    data = {'k%d'%i:{'text':'é'*i, 'num':i}  for i in range(100)}
+    json_path = str( tmp_path / 'dataset' )
+    with open(json_path, 'w', encoding='utf8') as f:
+        json.dump( {'data':data, 'description':'descr'}, f )
+
+    loaded, description = wetsuite.datasets._path_to_data( json_path )
+    assert description == 'descr'
+    assert dict( loaded.items() ) == data
+    assert os.path.exists( json_path+'.kv' )
+    loaded.close()
+
+    mtime = os.path.getmtime( json_path+'.kv' )
+    loaded, description = wetsuite.datasets._path_to_data( json_path )
+    assert os.path.getmtime( json_path+'.kv' ) == mtime   # not converted again
+    assert loaded.get('k5') == data['k5']
+    loaded.close()
+
+    time.sleep(0.01) # a redownload (here to list-valued data) means converting again
+    with open(json_path, 'w', encoding='utf8') as f:
+        json.dump( {'description':'descr2', 'data':[1, 2, 3]}, f )
+    assert wetsuite.datasets._path_to_data( json_path ) == ([1, 2, 3], 'descr2')
+    assert not os.path.exists( json_path+'.kv' )
+
+    # which is remembered, so that later loads do not scan it again
+    assert os.path.exists( json_path+'.notkv' )
+    def no_scanning( *args, **kwargs ):
+        raise AssertionError('should not be converted again')
+    with monkeypatch.context() as m:
+        m.setattr( wetsuite.datasets, '_json_to_store', no_scanning )
+        assert wetsuite.datasets._path_to_data( json_path ) == ([1, 2, 3], 'descr2')
+
+    time.sleep(0.01) # and a redownload back to dict-valued data converts again
+    with open(json_path, 'w', encoding='utf8') as f:
+        json.dump( {'data':data, 'description':'descr3'}, f )
+    loaded, description = wetsuite.datasets._path_to_data( json_path )
+    assert description == 'descr3'  and  len(loaded) == 100
+    loaded.close()
+    assert not os.path.exists( json_path+'.notkv' )
+
+
+def test_load_seekable( tmp_path, monkeypatch ):
+    ' test that a SQLite dataset can be kept compressed in the cache, and loaded from there '
+    pytest.importorskip('apsw')
+    import lzma
+    import wetsuite.helpers.net
+    import wetsuite.helpers.util
+    import wetsuite.helpers.localdata
+
+    db_path = str( tmp_path/'made.db' )
+    store = wetsuite.helpers.localdata.LocalKV( db_path, str, str )
+    for i in range(1000):
+        store.put( 'k%d'%i, 'value %d'%i, commit=False )
+    store.commit()
+    store._put_meta( 'description', 'a test dataset' )
+    store.close()
+    with open(db_path, 'rb') as f:
+        compressed = lzma.compress( f.read() )
+
+    url = 'https://example.com/test.db.xz'
+    cassette = wetsuite.helpers.localdata.MsgpackKV(':memory:', check_same_thread=False)
+    cassette.put( url, {'status_code':200, 'url':url, 'headers':{}, 'content':compressed, 'elapsed_sec':0.0} )
+
+    datasets_dir = tmp_path/'datasets'
+    datasets_dir.mkdir()
+    monkeypatch.setattr( wetsuite.helpers.util, 'wetsuite_dir', lambda: {'datasets_dir':str(datasets_dir)} )
+    monkeypatch.setattr( wetsuite.datasets, '_index_data', {'test-seekable':{'url':url}} )
+
+    wetsuite.helpers.net.cassette_replay( cassette )
+    try:
+        ds = wetsuite.datasets.load( 'test-seekable', verbose=False, seekable=True )
+        assert ds.description == 'a test dataset'
+        assert ds.num_items == 1000
+        assert ds.data.get('k500') == 'value 500'
+        ds.data.close()
+        assert list( p.name.endswith('.seekable')  for p in datasets_dir.iterdir() ) == [True]
+
+        # later loads use that, also without asking, and without fetching
+        cassette.delete( url )
+        ds = wetsuite.datasets.load( 'test-seekable', verbose=False )
+        assert ds.data.get('k999') == 'value 999'
+        ds.data.close()
+    finally:
+        wetsuite.helpers.net.cassette_off()
+
+
+def test_index_cache( tmp_path, monkeypatch ):
+    ' test that the index is kept on disk, used when offline, and revalidated conditionally '
+    import wetsuite.helpers.net
+    import wetsuite.helpers.util
+    import wetsuite.helpers.localdata
+
+    monkeypatch.setattr( wetsuite.helpers.util, 'wetsuite_dir', lambda: {'datasets_dir':str(tmp_path)} )
+    monkeypatch.setattr( wetsuite.datasets, '_index_data', None )
+    monkeypatch.setattr( wetsuite.datasets, '_index_fetch_time', 0 )
+
+    sent_headers = []
+    real_get = wetsuite.helpers.net.get
+    def recording_get(url, headers=None, **kwargs):
+        sent_headers.append( headers )
+        return real_get(url, headers=headers, **kwargs)
+    monkeypatch.setattr( wetsuite.helpers.net, 'get', recording_get )
+
+    url = wetsuite.datasets._INDEX_URL
+    cassette = wetsuite.helpers.localdata.MsgpackKV(':memory:', check_same_thread=False)
+    cassette.put( url, {'status_code':200, 'url':url, 'headers':{'ETag':'"v1"'}, 'content':b'{"one":{}}', 'elapsed_sec':0.0} )
+    wetsuite.helpers.net.cassette_replay( cassette )
+    try:
+        assert wetsuite.datasets.list_datasets() == ['one']
+        assert wetsuite.datasets._read_index_cache()['etag'] == '"v1"'
+
+        # a new interpreter, offline, with an old copy:  we use that copy, and failing to refresh is not an error
+        monkeypatch.setattr( wetsuite.datasets, '_index_data', None )
+        monkeypatch.setattr( wetsuite.datasets, '_index_fetch_no_more_often_than_sec', 0 )
+        cassette.delete( url )
+        assert wetsuite.datasets.list_datasets() == ['one']
+        wetsuite.datasets._index_refresh_thread.join()
+        assert wetsuite.datasets._index_data == {'one':{}}
+
+        # the server says nothing changed
+        cassette.put( url, {'status_code':304, 'url':url, 'headers':{}, 'content':b'', 'elapsed_sec':0.0} )
+        assert wetsuite.datasets.fetch_index( force_refresh=True ) == {'one':{}}
+        assert sent_headers[-1] == {'If-None-Match':'"v1"'}
+
+        # the server has a new version, which we pick up in the background
+        cassette.put( url, {'status_code':200, 'url':url, 'headers':{'ETag':'"v2"'}, 'content':b'{"two":{}}', 'elapsed_sec':0.0} )
+        assert wetsuite.datasets.list_datasets() == ['one']
+        wetsuite.datasets._index_refresh_thread.join()
+        assert wetsuite.datasets.list_datasets() == ['two']
+        wetsuite.datasets._index_refresh_thread.join()
+
+        # without a copy and without network, we have nothing to work with
+        cassette.delete( url )
+        monkeypatch.setattr( wetsuite.datasets, '_index_data', None )
+        (tmp_path/'index_cache.json').unlink()
+        with pytest.raises( KeyError ):
+            wetsuite.datasets.fetch_index()
+    finally:
+        wetsuite.helpers.net.cassette_off()
+
+
+def test_prefetch_and_load_async( tmp_path, monkeypatch ):
+    ' test that prefetch() fetches and converts in the background, and that load_async() gives a Dataset '
+    import os, json, lzma
+    import wetsuite.helpers.net
+    import wetsuite.helpers.util
+    import wetsuite.helpers.localdata
+
+    cassette = wetsuite.helpers.localdata.MsgpackKV(':memory:', check_same_thread=False)
+    index = {}
+    for name in ('test-a', 'test-b'):
+        url = 'https://example.com/%s.json.xz'%name
+        content = lzma.compress( json.dumps( {'description':name, 'data':{'k':name}} ).encode('utf8') )
+        cassette.put( url, {'status_code':200, 'url':url, 'headers':{}, 'content':content, 'elapsed_sec':0.0} )
+        index[name] = {'url':url}
+    index['test-missing'] = {'url':'https://example.com/missing.json'}
+
+    monkeypatch.setattr( wetsuite.helpers.util, 'wetsuite_dir', lambda: {'datasets_dir':str(tmp_path)} )
+    monkeypatch.setattr( wetsuite.datasets, '_index_data', index )
+
+    wetsuite.helpers.net.cassette_replay( cassette )
+    try:
+        futures = wetsuite.datasets.prefetch( ['test-?', 'test-a'] )
+        assert sorted( futures ) == ['test-a', 'test-b']
+        for future in futures.values():
+            assert os.path.exists( future.result() + '.kv' )  # also already converted
+
+        # loading uses what was prefetched, without fetching
+        cassette.delete( index['test-a']['url'] )
+        ds = wetsuite.datasets.load_async( 'test-a' ).result()
+        assert ds.description == 'test-a'
+        assert ds.data.get('k') == 'test-a'
+        ds.data.close()
+
+        # errors end up in the future
+        assert isinstance( wetsuite.datasets.prefetch( 'test-missing' )['test-missing'].exception(), KeyError )
+        with pytest.raises( ValueError ):
+            wetsuite.datasets.prefetch( 'nonexistent' )
+    finally:
+        wetsuite.helpers.net.cassette_off()
+
+
+def test_delta_update( tmp_path, monkeypatch ):
+    ' test that a new version of a dataset is made from our copy plus a delta, and that a bad delta makes us fetch in full '
+    import os, json, lzma
+    import wetsuite.helpers.net
+    import wetsuite.helpers.util
+    import wetsuite.helpers.localdata
+
+    def make_version(version, change):
+        path = str( tmp_path/('v%d.db'%version) )
+        store = wetsuite.helpers.localdata.MsgpackKV( path )
+        for i in range(200):
+            if i != change:   # one removed
+                store.put( 'k%d'%i, {'i':i, 'v':version if i < change else 1}, commit=False ) # some changed
+        store.put( 'new%d'%version, [version], commit=False ) # one added
+        store.commit()
+        store._put_meta( 'description', 'version %d'%version )
+        store.close()
+        with open(path, 'rb') as f:
+            return path, f.read()
+
+    v1_path, v1_data = make_version(1, 10)
+    v2_path, v2_data = make_version(2, 20)
+    v3_path, v3_data = make_version(3, 30)
+    delta_path = str( tmp_path/'delta.db' )
+    assert wetsuite.datasets.make_delta( v1_path, v2_path, delta_path ) == 21  # of 200
+    with open(delta_path, 'rb') as f:
+        delta_data = f.read()
+
+    cassette = wetsuite.helpers.localdata.MsgpackKV(':memory:', check_same_thread=False)
+    def serve(url, content):
+        cassette.put( url, {'status_code':200, 'url':url, 'headers':{}, 'content':content, 'elapsed_sec':0.0} )
+    serve( 'https://example.com/v1.db', v1_data )
+    serve( 'https://example.com/delta-1-2.db.xz', lzma.compress(delta_data) )
+    serve( 'https://example.com/manifest-2.json', json.dumps( wetsuite.datasets.store_manifest(v2_path) ).encode('utf8') )
+    serve( 'https://example.com/v3.db', v3_data )
+    # a manifest that the delta does not lead to
+    serve( 'https://example.com/manifest-3.json', json.dumps( wetsuite.datasets.store_manifest(v1_path) ).encode('utf8') )
+
+    datasets_dir = tmp_path/'datasets'
+    datasets_dir.mkdir()
+    monkeypatch.setattr( wetsuite.helpers.util, 'wetsuite_dir', lambda: {'datasets_dir':str(datasets_dir)} )
+
+    wetsuite.helpers.net.cassette_replay( cassette )
+    try:
+        monkeypatch.setattr( wetsuite.datasets, '_index_data', {'test-delta':{'url':'https://example.com/v1.db', 'version':1}} )
+        ds = wetsuite.datasets.load( 'test-delta', verbose=False )
+        assert ds.data.get('k15') == {'i':15, 'v':1}
+        ds.data.close()
+
+        # v2 is not there in full, so this has to come from the delta
+        monkeypatch.setattr( wetsuite.datasets, '_index_data', {'test-delta':{
+            'url':'https://example.com/v2.db', 'version':2, 'manifest_url':'https://example.com/manifest-2.json',
+            'deltas':{'1':{'url':'https://example.com/delta-1-2.db.xz'}} }} )
+        ds = wetsuite.datasets.load( 'test-delta', verbose=False )
+        assert ds.description == 'version 2'
+        assert dict( ds.data.items() ) == dict( wetsuite.helpers.localdata.MsgpackKV( v2_path, read_only=True ).items() )
+        ds.data.close()
+        assert len( [p for p in datasets_dir.iterdir()  if not p.name.endswith('.installed')] ) == 1  # updated, not copied
+
+        # if the result does not match the manifest, we leave our copy alone and fetch in full
+        monkeypatch.setattr( wetsuite.datasets, '_index_data', {'test-delta':{
+            'url':'https://example.com/v3.db', 'version':3, 'manifest_url':'https://example.com/manifest-3.json',
+            'deltas':{'2':{'url':'https://example.com/delta-1-2.db.xz'}} }} )
+        with pytest.warns( UserWarning ):
+            ds = wetsuite.datasets.load( 'test-delta', verbose=False )
+        assert ds.description == 'version 3'
+        assert ds.data.get('new3') == [3]
+        ds.data.close()
+        # and the version 2 copy that it replaces is removed
+        assert len( [p for p in datasets_dir.iterdir()  if not p.name.endswith('.installed')] ) == 1
+    finally:
+        wetsuite.helpers.net.cassette_off()
+
+
+def test_delta_update_from_unrecorded_copy( tmp_path, monkeypatch ):
+    ' test that a copy fetched before we kept .installed records gets one when it is next loaded, so that it can be updated from a delta '
+    import os, json
+    import wetsuite.helpers.net
+    import wetsuite.helpers.util
+    import wetsuite.helpers.localdata
+
+    paths = {}
+    for version in (1, 2):
+        paths[version] = str( tmp_path/('v%d.db'%version) )
+        store = wetsuite.helpers.localdata.MsgpackKV( paths[version] )
+        store.put( 'k', version )
+        store._put_meta( 'description', 'version %d'%version )
+        store.close()
+    delta_path = str( tmp_path/'delta.db' )
+    wetsuite.datasets.make_delta( paths[1], paths[2], delta_path )
+
+    cassette = wetsuite.helpers.localdata.MsgpackKV(':memory:', check_same_thread=False)
+    def serve(url, content):
+        cassette.put( url, {'status_code':200, 'url':url, 'headers':{}, 'content':content, 'elapsed_sec':0.0} )
+    with open(delta_path, 'rb') as f:
+        serve( 'https://example.com/delta-1-2.db', f.read() )
+    serve( 'https://example.com/manifest-2.json', json.dumps( wetsuite.datasets.store_manifest(paths[2]) ).encode('utf8') )
+
+    datasets_dir = tmp_path/'datasets'
+    datasets_dir.mkdir()
+    monkeypatch.setattr( wetsuite.helpers.util, 'wetsuite_dir', lambda: {'datasets_dir':str(datasets_dir)} )
+    # as an older version of this code would have left it: the file, but no record
+    with open(paths[1], 'rb') as f:
+        v1_data = f.read()
+    with open( datasets_dir/wetsuite.helpers.util.hash_hex( b'https://example.com/v1.db' ), 'wb' ) as f:
+        f.write( v1_data )
+
+    wetsuite.helpers.net.cassette_replay( cassette )   # (v1.db is not in there, so must not be fetched)
+    try:
+        monkeypatch.setattr( wetsuite.datasets, '_index_data', {'test-delta':{'url':'https://example.com/v1.db', 'version':1}} )
+        ds = wetsuite.datasets.load( 'test-delta', verbose=False )
+        ds.data.close()
+        assert os.path.exists( wetsuite.datasets._installed_path('test-delta') )
+
+        monkeypatch.setattr( wetsuite.datasets, '_index_data', {'test-delta':{
+            'url':'https://example.com/v2.db', 'version':2, 'manifest_url':'https://example.com/manifest-2.json',
+            'deltas':{'1':{'url':'https://example.com/delta-1-2.db'}} }} )
+        ds = wetsuite.datasets.load( 'test-delta', verbose=False )
+        assert ds.description == 'version 2'  and  ds.data.get('k') == 2
+        ds.data.close()
+        assert len( [p for p in datasets_dir.iterdir()  if not p.name.endswith('.installed')] ) == 1
+
+        # a process that still has the old index fetches the old version again, but neither removes the newer copy nor forgets about it
+        serve( 'https://example.com/v1.db', v1_data )
+        monkeypatch.setattr( wetsuite.datasets, '_index_data', {'test-delta':{'url':'https://example.com/v1.db', 'version':1}} )
+        for _ in range(2): # (the second time from the copy it has)
+            ds = wetsuite.datasets.load( 'test-delta', verbose=False )
+            assert ds.description == 'version 1'
+            ds.data.close()
+        assert len( [p for p in datasets_dir.iterdir()  if not p.name.endswith('.installed')] ) == 2
+        assert wetsuite.datasets._read_installed('test-delta')['version'] == 2
+    finally:
+        wetsuite.helpers.net.cassette_off()
+
+
+def test_is_newer():
+    ' test the comparison of dataset versions '
+    assert wetsuite.datasets._is_newer( 2, 1 )
+    assert wetsuite.datasets._is_newer( '1.10', '1.9' )
+    assert not wetsuite.datasets._is_newer( 1, 1 )
+    assert not wetsuite.datasets._is_newer( 1, 2 )
+    assert not wetsuite.datasets._is_newer( 'beta', 1 )
+    assert not wetsuite.datasets._is_newer( 2, None )
+
+
+def test_parallel_decompressor():
+    ' test that parallel decompression gives the original data in order, for the formats it splits, and notices truncation '
+    import bz2, lzma, gzip, random
+    rnd = random.Random(0)
+    data = b''.join( rnd.choice([b'foo ', b'bar ', b'quu ', b'%d '%i])  for i in range(300000) )
+
+    def run(url, compressed, chunk_size=10000):
+        pd = wetsuite.datasets._parallel_decompressor_for_url( url, workers=3 )
+        out = []
+        for i in range(0, len(compressed), chunk_size):
+            out.append( pd.decompress( compressed[i:i+chunk_size] ) )
+        out.append( pd.finish() )
+        return b''.join(out), pd.eof
+
+    # as pbzip2 would make it: many streams
+    concatenated = b''.join( bz2.compress(data[i:i+100000])  for i in range(0, len(data), 100000) )
+    assert run( 'x.bz2', concatenated ) == (data, True)
+    assert run( 'x.bz2', bz2.compress(data) ) == (data, True)
+    assert run( 'x.bz2', concatenated[:-100] )[1] is False
+
+    # python's lzma does not record block sizes, so this tests the fallback;  the multi-block case is tested below
+    assert run( 'x.xz', lzma.compress(data[:500000]) + lzma.compress(data[500000:]) ) == (data, True)
+    assert run( 'x.xz', lzma.compress(data[:500000]) + b'\0'*4 + lzma.compress(data[500000:]) + b'\0'*4 ) == (data, True)
+    assert run( 'x.gz', gzip.compress(data) ) == (data, True)
+
+
+def test_xz_block_splitter():
+    ' test that xz blocks are re-wrapped into streams that decompress by themselves (requires the xz command, for multi-block files) '
+    import lzma, shutil, subprocess
+    if shutil.which('xz') is None:
+        pytest.skip('no xz command to make a multi-block file with')
+    data = b''.join( b'%d foo bar '%i  for i in range(200000) )
+    compressed = subprocess.run( ['xz', '-T2', '--block-size=100000', '-c'], input=data, stdout=subprocess.PIPE, check=True ).stdout
+
+    splitter = wetsuite.datasets._XZBlockSplitter()
+    pieces = []
+    for i in range(0, len(compressed), 777):
+        pieces.extend( splitter.feed( compressed[i:i+777] ) )
+    pieces.extend( splitter.finish() )
+    assert len(pieces) > 10
+    assert set( kind  for kind, _ in pieces ) == {'unit'}
+    assert b''.join( lzma.decompress(unit)  for _, unit in pieces ) == data
+
+    splitter = wetsuite.datasets._XZBlockSplitter()
+    pieces = splitter.feed( compressed[:-30] ) + splitter.finish()
+    assert pieces[-1][0] == 'incomplete'
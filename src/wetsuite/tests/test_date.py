@@ -55,6 +55,15 @@ def test_date_ranges():
     ]
     # possible regression - because if you <=, you get  [('1988-11-01', '1988-11-08'), ('1988-11-08', '1988-11-15'), ('1988-11-15', '1988-11-15')]
 
+    assert date_ranges( '1 nov 1988', '15 nov 1988', increment_days=7, overlap=False ) == [
+        (datetime.date(1988, 11, 1),  datetime.date(1988, 11, 7)),
+        (datetime.date(1988, 11, 8),  datetime.date(1988, 11, 14)),
+        (datetime.date(1988, 11, 15), datetime.date(1988, 11, 15)),
+    ]
+    assert date_ranges( '1 nov 1988', '1 nov 1988', increment_days=7, overlap=False ) == [
+        (datetime.date(1988, 11, 1),  datetime.date(1988, 11, 1)),
+    ]
+
 
 def test_format_date_ranges():
     ' test the string output of date_ranges '
@@ -1,5 +1,6 @@
 ' test eurlex fetching and parsing code '
 import os
+import pytest
 import wetsuite.datacollect.eurlex
 import wetsuite.helpers.net
 
@@ -16,6 +17,57 @@ def test_extract_html():
     assert d['celex'] == '32016R0679'
 
 
+def _judg_page(celex):
+    ' a small page with the sections a JUDG page has, including the data lists the example above lacks '
+    return ('''<!DOCTYPE html><html><head><meta charset="utf-8"><meta name="WT.z_docID" content="%s"></head><body>
+<div id="PP1Contents"><p id="title">Judgment</p><p id="englishTitle">Judgment</p><p id="originalTitle">Arrest</p>
+  <p>ECLI identifier: ECLI:EU:C:2021:658</p></div>
+<div id="PPDates_Contents"><dl><dt>Date of document: </dt><dd>03/09/2021</dd><dt>Date of lodgment:</dt><dd>24/04/2020; Application</dd></dl></div>
+<div id="PPProc_Contents"><dl><dt>Defendant:</dt><dd>Raad</dd><dt>Procedure:</dt><dd><ul><li><a href="./x">2018/0395/NLE</a></li></ul></dd></dl></div>
+<div id="PPLinked_Contents"><dl><dt>Interpreted:</dt><dd><ul><li>Interpreting <a data-celex="32016R0679" href="#">32016R0679</a></li></ul></dd></dl></div>
+<div id="PPClass_Contents"><dl><dt>Subject matter:</dt><dd><ul><li>Agriculture</li><li><div><span>Law </span> <a>Privacy</a></div></li></ul></dd></dl></div>
+<div id="PP4Contents"><div>intro <h2>Section</h2><p>para <b>one</b></p> tail</div></div>
+</body></html>'''%celex).encode('utf8')
+
+
+def test_extract_html_judg():
+    ' test the data list sections '
+    d = wetsuite.datacollect.eurlex.extract_html( _judg_page('62020CJ0180') )
+    assert d['ecli'] == 'ECLI:EU:C:2021:658'
+    assert d['dates'] == {'Date of document':'2021-09-03', 'Date of lodgment':'2020-04-24'}
+    assert d['proc'] == {'Defendant':['Raad'], 'Procedure':['2018/0395/NLE']}
+    assert d['linked'] == {'Interpreted':[('CELEX:32016R0679', 'Interpreting 32016R0679')]}
+    assert d['classifications'] == {'Subject matter':['Agriculture', ['Law', 'Privacy']]}
+    assert d['text'] == [('', ['intro']), ('Section', ['para ', 'one', 'tail'])]
+
+
+def test_extract_html_scoped_ids():
+    ' test that ids are looked for only in the section they belong to, not e.g. an earlier element with the same id '
+    page = _judg_page('62020CJ0180').replace( b'<body>', b'<body><div id="title">Site banner</div><div id="TexteOnly">Menu</div>' )
+    d = wetsuite.datacollect.eurlex.extract_html( page )
+    assert d['titles']['title'] == 'Judgment'
+    assert d['text'] == [('', ['intro']), ('Section', ['para ', 'one', 'tail'])]
+
+
+def test_extract_html_store():
+    ' test that the multiprocess batch version gives everything, in order, and handles errors as asked '
+    import pytest
+    import wetsuite.helpers.localdata
+    eurlex = wetsuite.datacollect.eurlex
+
+    pages = wetsuite.helpers.localdata.LocalKV(':memory:', str, bytes)
+    for i in range(25):
+        pages.put( 'page%02d'%i, _judg_page('6202%dCJ0180'%i), commit=False )
+    pages.put( 'page99', b'<html><body>not a eurlex page</body></html>' )
+
+    results = list( eurlex.extract_html_store( pages, workers=2, chunk_size=3, skip_errors=True ) )
+    assert list( key  for key, _ in results ) == list( 'page%02d'%i  for i in range(25) )
+    assert results[7][1] == eurlex.extract_html( pages.get('page07') )
+
+    with pytest.raises(ValueError, match='page99'):
+        list( eurlex.extract_html_store( pages, workers=2 ) )
+
+
 def test_fetch_by_resource_type():
     ' test that fetching from the sparql API does not return an error (does not do anything with the data) '
     wetsuite.datacollect.eurlex.fetch_by_resource_type('LET') # choosing something with very little output
@@ -25,6 +77,50 @@ def test_fetch_by_resource_type():
     #     url = item_dict.get('work').get('value')
 
 
+
+def test_iter_by_resource_type():
+    ' test that paging by work URI gives every row once, keeps the rows of a work together, and that the cache keeps only full pages '
+    import json
+    import wetsuite.helpers.localdata
+    eurlex = wetsuite.datacollect.eurlex
+
+    prefix = eurlex._CELLAR_PREFIX  # pylint: disable=W0212
+    rows = list( {'work':{'type':'uri', 'value':prefix+work}, 'celex':{'type':'typed-literal', 'value':celex}}
+                 for work, celex in (('0x', 'c1'), ('a0', 'c2'), ('a0', 'c3'), ('a1', 'c4'), ('a2', 'c5'), ('b0', 'c6')) )
+
+    # a fake endpoint, answering every range query the client could ask
+    cassette = wetsuite.helpers.localdata.MsgpackKV(':memory:', check_same_thread=False)
+    starts = set( eurlex._work_ranges() )  # pylint: disable=W0212
+    for row in rows:
+        for start, end in eurlex._work_ranges():  # pylint: disable=W0212
+            if (start is None or start <= row['work']['value'])  and  (end is None or row['work']['value'] < end):
+                starts.add( (row['work']['value'], end) )
+    for start, end in starts:
+        for limit in (2, 3):
+            url = eurlex._resource_type_query_url( 'LET', limit, start, end )  # pylint: disable=W0212
+            answer = list( row  for row in rows  if (start is None or start <= row['work']['value'])  and  (end is None or row['work']['value'] < end) )[:limit]
+            content = json.dumps( {'head':{'vars':[]}, 'results':{'bindings':answer}} ).encode('utf8')
+            cassette.put( url, {'status_code':200, 'url':url, 'headers':{}, 'content':content, 'elapsed_sec':0.0} )
+
+    cache_store = wetsuite.helpers.localdata.LocalKV(':memory:', str, bytes)
+    wetsuite.helpers.net.cassette_replay( cassette )
+    try:
+        assert list( eurlex.iter_by_resource_type( 'LET', page_size=3, workers=1 ) ) == rows
+        got = list( eurlex.iter_by_resource_type( 'LET', page_size=3, workers=4, cache_store=cache_store ) )
+        assert sorted( got, key=json.dumps ) == sorted( rows, key=json.dumps )
+        assert len(cache_store) == 1   # only the one full page
+
+        # the cached page is not fetched again
+        cassette.delete( eurlex._resource_type_query_url( 'LET', 3, prefix+'a', prefix+'b' ) )  # pylint: disable=W0212
+        assert eurlex.fetch_by_resource_type( 'LET', page_size=3, workers=1, cache_store=cache_store )['results']['bindings'] == rows
+
+        # a work with more rows than fit in a page
+        with pytest.raises( ValueError ):
+            list( eurlex.iter_by_resource_type( 'LET', page_size=2, workers=1 ) )
+    finally:
+        wetsuite.helpers.net.cassette_off()
+
+
 ### for reference, as of somewhere late 2023:
 #
 #      0   ABSTRACT_JUR                     Abstract
@@ -153,7 +153,6 @@ def test_more_parsing():
 
 # bwb_wti_usefuls
 
-# cvdr_versions_for_work
 
 
 # alineas_with_selective_path
@@ -161,3 +160,243 @@ def test_more_parsing():
 # merge_alinea_data
 
 # merge_alinea_data
+
+
+
+def test_cvdr_versions_for_works():
+    ' test that version lookup batches works into one query, spreads the results back per work, and remembers them '
+    import wetsuite.datacollect.koop_repositories
+    import wetsuite.helpers.koop_parse
+    import wetsuite.helpers.net
+    import wetsuite.helpers.escape
+    import wetsuite.helpers.localdata
+
+    cvdr = wetsuite.datacollect.koop_repositories.CVDR()
+    cassette = wetsuite.helpers.localdata.MsgpackKV(':memory:', check_same_thread=False)
+    query = 'workid = CVDR101 or workid = CVDR102 or workid = CVDR103'
+    url = cvdr._url() + '&operation=searchRetrieve&startRecord=1&maximumRecords=100&query=%s'%wetsuite.helpers.escape.uri_component(query)
+    recs = ''.join( '<record><recordData><gzd><originalData><meta><owmskern><identifier>%s</identifier></owmskern></meta></originalData></gzd></recordData></record>'%expr
+                    for expr in ('CVDR102_2', 'CVDR101_1', 'CVDR102_1') )
+    xml = '<searchRetrieveResponse><numberOfRecords>3</numberOfRecords><records>%s</records></searchRetrieveResponse>'%recs
+    cassette.put( url, {'status_code':200, 'url':url, 'headers':{}, 'content':xml.encode('utf8'), 'elapsed_sec':0.0} )
+
+    store = wetsuite.helpers.localdata.MsgpackKV(':memory:')
+    wetsuite.helpers.koop_parse._versions_cache.clear()  # pylint: disable=W0212
+    wetsuite.helpers.net.cassette_replay( cassette )
+    try:
+        expect = {'CVDR101':['CVDR101_1'], '102_1':['CVDR102_1', 'CVDR102_2'], 'CVDR103':[], 'CVDR102':['CVDR102_1', 'CVDR102_2']}
+        assert wetsuite.helpers.koop_parse.cvdr_versions_for_works( ['CVDR101', '102_1', 'CVDR103', 'CVDR102'], store=store, works_per_query=3 ) == expect
+        assert store.get('103')['versions'] == []
+
+        # answered from the store, without asking again
+        cassette.delete( url )
+        wetsuite.helpers.koop_parse._versions_cache.clear()  # pylint: disable=W0212
+        assert wetsuite.helpers.koop_parse.cvdr_versions_for_work( 'CVDR102_2', store=store ) == ['CVDR102_1', 'CVDR102_2']
+
+        # ...until that expires
+        with pytest.raises(KeyError):
+            wetsuite.helpers.koop_parse.cvdr_versions_for_work( 'CVDR101', store=store, expiry_sec=-1 )
+    finally:
+        wetsuite.helpers.net.cassette_off()
+
+
+def test_incremental_harvester():
+    ' test that IncrementalHarvester stores records, remembers how far it got, and resumes after interruption '
+    import wetsuite.datacollect.koop_repositories
+    import wetsuite.helpers.net
+    import wetsuite.helpers.escape
+    import wetsuite.helpers.localdata
+
+    cvdr = wetsuite.datacollect.koop_repositories.CVDR()
+    cassette = wetsuite.helpers.localdata.MsgpackKV(':memory:', check_same_thread=False)
+    def add_pages( query, num_records, skip_start=() ):
+        for start_record in range(1, num_records+1, 4):
+            if start_record in skip_start:
+                continue
+            url = cvdr._url() + '&operation=searchRetrieve&startRecord=%d&maximumRecords=4&query=%s'%(
+                start_record, wetsuite.helpers.escape.uri_component(query) )
+            recs = ''.join( '<record><recordData><meta><identifier>CVDR%d_1</identifier><modified>2024-01-%02d</modified></meta></recordData></record>'%(i, i)
+                            for i in range(start_record, min(num_records+1, start_record+4)) )
+            xml = '<searchRetrieveResponse><numberOfRecords>%d</numberOfRecords><records>%s</records></searchRetrieveResponse>'%(num_records, recs)
+            cassette.put( url, {'status_code':200, 'url':url, 'headers':{}, 'content':xml.encode('utf8'), 'elapsed_sec':0.0} )
+
+    record_store = wetsuite.helpers.localdata.LocalKV(':memory:', str, bytes)
+    state_store  = wetsuite.helpers.localdata.MsgpackKV(':memory:')
+    harvester = wetsuite.datacollect.koop_repositories.IncrementalHarvester( cvdr, record_store, state_store,
+                    start_date='2024-01-01', at_a_time=4, wait_between_sec=0 )
+
+    add_pages( 'dcterms.modified>=2024-01-01', 10, skip_start=(9,) )
+    wetsuite.helpers.net.cassette_replay( cassette )
+    try:
+        with pytest.raises(KeyError): # page missing from cassette acts as our crash
+            harvester.harvest()
+        assert len(record_store) == 8
+        assert harvester.state()['run_next_start_record'] == 9
+
+        add_pages( 'dcterms.modified>=2024-01-01', 10 )
+        assert harvester.harvest() == 2   # resumes, does not re-fetch the first pages
+        assert len(record_store) == 10
+        assert harvester.state() == {'high_water_mark':'2024-01-10'}
+
+        add_pages( 'dcterms.modified>=2024-01-10', 10 )  # pretend the same things come back, as they would for >= on that day
+        harvester.harvest()
+        assert harvester.state() == {'high_water_mark':'2024-01-10'}
+    finally:
+        wetsuite.helpers.net.cassette_off()
+
+
+def _fake_frbr_cassette(num_pages=2):
+    ' a tiny imitation of a repository.overheid.nl/frbr/ listing: some pages (each linking to all), each with a folder, each with a document '
+    import wetsuite.helpers.localdata
+    cassette = wetsuite.helpers.localdata.MsgpackKV(':memory:', check_same_thread=False)
+    def put( url, html ):
+        cassette.put( url, {'status_code':200, 'url':url, 'headers':{}, 'content':html.encode('utf8'), 'elapsed_sec':0.0} )
+    base = 'https://repository.overheid.nl/frbr/test'
+    pagination = '<div class="pagination__index"><ul>%s</ul></div>'%''.join(
+        f'<li><a href="/frbr/test?start={pagenum}">{pagenum}</a></li>'  for pagenum in range(1, num_pages+1) )
+    for pagenum in range(1, num_pages+1):
+        put( f'{base}?start={pagenum}',
+             f'<div><ul class="browse__list"><li class="browse__item"><a href="/frbr/test/doc{pagenum}">doc{pagenum}</a></li></ul></div>'+pagination )
+        put( f'{base}/doc{pagenum}',
+             f'<ul class="list--sources"><li><div class="list--source__information">doc{pagenum}.xml</div><a href="/frbr/test/doc{pagenum}/doc{pagenum}.xml">x</a></li></ul>' )
+        put( f'{base}/doc{pagenum}/doc{pagenum}.xml', f'<doc>{pagenum}</doc>' )
+    return cassette, base
+
+
+def test_frbrfetcher_resume():
+    ' test that FRBRFetcher does its work from a queue, and that with a state_store it resumes after interruption '
+    import wetsuite.datacollect.koop_repositories
+    import wetsuite.helpers.net
+    import wetsuite.helpers.localdata
+
+    cassette, base = _fake_frbr_cassette()
+    missing = cassette.get( f'{base}?start=2' )
+    cassette.delete( f'{base}?start=2' )
+
+    fetch_store = wetsuite.helpers.localdata.LocalKV(':memory:', str, bytes)
+    cache_store = wetsuite.helpers.localdata.LocalKV(':memory:', str, bytes)
+    state_store = wetsuite.helpers.localdata.MsgpackKV(':memory:')
+
+    wetsuite.helpers.net.cassette_replay( cassette )
+    try:
+        fetcher = wetsuite.datacollect.koop_repositories.FRBRFetcher( fetch_store, cache_store, verbose=False, waittime_sec=0, state_store=state_store )
+        fetcher.add_page( f'{base}?start=1' )
+        with pytest.raises(KeyError): # page missing from cassette acts as our crash
+            list( fetcher.work() )
+        assert list(fetch_store.keys()) == [f'{base}/doc1/doc1.xml']
+
+        cassette.put( f'{base}?start=2', missing )
+        fetcher = wetsuite.datacollect.koop_repositories.FRBRFetcher( fetch_store, cache_store, verbose=False, waittime_sec=0, state_store=state_store )
+        assert list(fetcher.to_fetch_pages) == [f'{base}?start=2']
+        fetcher.add_page( f'{base}?start=1' ) # already visited, so ignored
+        list( fetcher.work() )
+        assert sorted(fetch_store.keys()) == [f'{base}/doc1/doc1.xml', f'{base}/doc2/doc2.xml']
+        assert fetcher.count_pages == 1
+        assert len(fetcher.to_fetch_pages) == 0  and  len(fetcher.to_fetch_folders) == 0
+    finally:
+        wetsuite.helpers.net.cassette_off()
+
+
+def test_frbrfetcher_concurrent():
+    ' test that the concurrent mode fetches the same things, and counts the same, as the sequential one '
+    import wetsuite.datacollect.koop_repositories
+    import wetsuite.helpers.net
+    import wetsuite.helpers.localdata
+
+    cassette, base = _fake_frbr_cassette()
+    wetsuite.helpers.net.cassette_replay( cassette )
+    try:
+        results = []
+        for workers in (1, 4):
+            fetch_store = wetsuite.helpers.localdata.LocalKV(':memory:', str, bytes)
+            cache_store = wetsuite.helpers.localdata.LocalKV(':memory:', str, bytes)
+            fetcher = wetsuite.datacollect.koop_repositories.FRBRFetcher( fetch_store, cache_store, verbose=False, waittime_sec=0, workers=workers, commit_every=1 )
+            fetcher.add_page( f'{base}?start=1' )
+            list( fetcher.work() )
+            results.append( (sorted(fetch_store.items()), sorted(cache_store.keys()),
+                             fetcher.count_items, fetcher.count_folders, fetcher.count_pages, fetcher.count_fetches, fetcher.count_errors) )
+        assert results[0] == results[1]
+        assert results[1][2:] == (2, 2, 2, 6, 0)
+    finally:
+        wetsuite.helpers.net.cassette_off()
+
+
+def test_frbrfetcher_resumed_items_errors():
+    ' test that items left over from a concurrent-mode checkpoint are fetched, and that ones that fail are counted, not raised '
+    import wetsuite.datacollect.koop_repositories
+    import wetsuite.helpers.net
+    import wetsuite.helpers.localdata
+
+    cassette, base = _fake_frbr_cassette()
+    cassette.put( f'{base}/gone.xml', {'status_code':404, 'url':f'{base}/gone.xml', 'headers':{}, 'content':b'', 'elapsed_sec':0.0} )
+
+    fetch_store = wetsuite.helpers.localdata.LocalKV(':memory:', str, bytes)
+    cache_store = wetsuite.helpers.localdata.LocalKV(':memory:', str, bytes)
+    state_store = wetsuite.helpers.localdata.MsgpackKV(':memory:')
+    checkpointed = wetsuite.datacollect.koop_repositories.FRBRFetcher( fetch_store, cache_store, verbose=False, waittime_sec=0, state_store=state_store )
+    checkpointed.to_fetch_items.extend( [f'{base}/gone.xml', f'{base}/doc1/doc1.xml'] ) # as the concurrent mode might leave them
+    checkpointed.save_state()
+
+    wetsuite.helpers.net.cassette_replay( cassette )
+    try:
+        fetcher = wetsuite.datacollect.koop_repositories.FRBRFetcher( fetch_store, cache_store, verbose=False, waittime_sec=0, state_store=state_store )
+        list( fetcher.work() )
+        assert list(fetch_store.keys()) == [f'{base}/doc1/doc1.xml']
+        assert fetcher.count_errors == 1
+        assert fetcher.count_items == 1  and  fetcher.count_fetches == 1
+        assert len(fetcher.to_fetch_items) == 0
+    finally:
+        wetsuite.helpers.net.cassette_off()
+
+
+def test_frbrfetcher_page_visited_exact():
+    ' test that a page the visited filter (wrongly) claims to have seen is still added '
+    import wetsuite.datacollect.koop_repositories
+    import wetsuite.helpers.localdata
+
+    fetch_store = wetsuite.helpers.localdata.LocalKV(':memory:', str, bytes)
+    cache_store = wetsuite.helpers.localdata.LocalKV(':memory:', str, bytes)
+    state_store = wetsuite.helpers.localdata.MsgpackKV(':memory:')
+    fetcher = wetsuite.datacollect.koop_repositories.FRBRFetcher( fetch_store, cache_store, verbose=False, state_store=state_store )
+    fetcher._mark_visited( 'https://repository.overheid.nl/frbr/test?start=1', is_folder=False )
+    fetcher.fetched.add( 'https://repository.overheid.nl/frbr/test?start=2' )  # imitates a false positive
+    fetcher.add_page( 'https://repository.overheid.nl/frbr/test?start=1' )
+    fetcher.add_page( 'https://repository.overheid.nl/frbr/test?start=2' )
+    assert list(fetcher.to_fetch_pages) == ['https://repository.overheid.nl/frbr/test?start=2']
+
+    # and that survives a checkpoint
+    fetcher.to_fetch_pages.clear()
+    fetcher.to_fetch_queued.clear()
+    fetcher.save_state()
+    resumed = wetsuite.datacollect.koop_repositories.FRBRFetcher( fetch_store, cache_store, verbose=False, state_store=state_store )
+    resumed.add_page( 'https://repository.overheid.nl/frbr/test?start=1' )
+    resumed.add_page( 'https://repository.overheid.nl/frbr/test?start=2' )
+    assert list(resumed.to_fetch_pages) == ['https://repository.overheid.nl/frbr/test?start=2']
+
+
+def test_frbrfetcher_concurrent_fetches_once( monkeypatch ):
+    ' test that in the concurrent mode, pages that listings link back to while they are being fetched are still fetched only once '
+    import collections
+    import wetsuite.datacollect.koop_repositories
+    import wetsuite.helpers.net
+    import wetsuite.helpers.localdata
+
+    fetched = collections.Counter()
+    real_download = wetsuite.helpers.net.download
+    def counting_download( url, *args, **kwargs ):
+        fetched[url] += 1
+        return real_download( url, *args, **kwargs )
+    monkeypatch.setattr( wetsuite.helpers.net, 'download', counting_download )
+
+    cassette, base = _fake_frbr_cassette( num_pages=8 )
+    wetsuite.helpers.net.cassette_replay( cassette, simulate_latency=False )
+    try:
+        fetch_store = wetsuite.helpers.localdata.LocalKV(':memory:', str, bytes)
+        cache_store = wetsuite.helpers.localdata.LocalKV(':memory:', str, bytes)
+        fetcher = wetsuite.datacollect.koop_repositories.FRBRFetcher( fetch_store, cache_store, verbose=False, waittime_sec=0, workers=4 )
+        fetcher.add_page( f'{base}?start=1' )
+        list( fetcher.work() )
+        assert fetcher.count_pages == 8  and  fetcher.count_folders == 8  and  fetcher.count_items == 8
+        assert len(fetched) == 24  and  set( fetched.values() ) == {1}
+    finally:
+        wetsuite.helpers.net.cassette_off()
@@ -440,3 +440,41 @@ def test_is_file_a_store( tmp_path ):
     kv = wetsuite.helpers.localdata.LocalKV( path, str, str )
     kv.close()
     assert wetsuite.helpers.localdata.is_file_a_store( kv.path ) is True
+
+
+def test_scalable_bloom_filter( tmp_path ):
+    ' test that the bloom filter has no false negatives, few false positives, grows, and survives saving/loading '
+    bf = wetsuite.helpers.localdata.ScalableBloomFilter( initial_capacity=100, error_rate=0.0001 )
+    for i in range(2000):
+        bf.add( 'https://example.com/%d'%i )
+    bf.add( 'https://example.com/5' ) # adding again should not count
+    assert len(bf) == 2000
+    assert len(bf.filters) > 1
+
+    assert all( ('https://example.com/%d'%i) in bf   for i in range(2000) )
+    assert sum( ('https://example.org/%d'%i) in bf   for i in range(10000) ) <= 5
+
+    path = str( tmp_path / 'visited.bloom' )
+    bf.save( path )
+    loaded = wetsuite.helpers.localdata.ScalableBloomFilter.load( path )
+    assert len(loaded) == 2000
+    assert 'https://example.com/1999' in loaded
+    assert 'https://example.org/1' not in loaded
+
+    kv = wetsuite.helpers.localdata.LocalKV( ':memory:', str, str )
+    kv.put( 'a', '1' )
+    assert 'a' in wetsuite.helpers.localdata.ScalableBloomFilter.from_store_keys( kv )
+
+
+def test_check_same_thread():
+    ' test that a store refuses use from other threads, unless asked to allow that '
+    import sqlite3, concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor( max_workers=1 ) as pool:
+        kv = wetsuite.helpers.localdata.LocalKV( ':memory:', str, str )
+        kv.put( 'a', '1' )
+        with pytest.raises( sqlite3.ProgrammingError ):
+            pool.submit( kv.get, 'a' ).result()
+
+        kv = wetsuite.helpers.localdata.MsgpackKV( ':memory:', check_same_thread=False )
+        kv.put( 'a', [1] )
+        assert pool.submit( kv.get, 'a' ).result() == [1]
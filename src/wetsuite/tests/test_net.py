@@ -27,3 +27,94 @@ def test_download_to_file( tmp_path ): # note: pytest fixture will create a temp
     with pytest.raises(ValueError, match=r'.*(404|500).*'):
         download('https://www.example.com/noexist', tofile_path=tofile_path)
         assert not os.path.exists( tofile_path )
+
+
+def test_cassette_replay():
+    ' test that replay mode answers from the store, and does not go to the network '
+    import wetsuite.helpers.net
+    import wetsuite.helpers.localdata
+    store = wetsuite.helpers.localdata.MsgpackKV(':memory:')
+    store.put('http://nonexistent.example.com/', {
+        'status_code':200, 'url':'http://nonexistent.example.com/', 'headers':{'Content-Length':'3'}, 
+        'content':b'foo', 'elapsed_sec':0.01 })
+    store.put('http://nonexistent.example.com/404', {
+        'status_code':404, 'url':'http://nonexistent.example.com/404', 'headers':{}, 
+        'content':b'', 'elapsed_sec':0.01 })
+    wetsuite.helpers.net.cassette_replay( store, simulate_latency=True )
+    try:
+        assert download('http://nonexistent.example.com/') == b'foo'
+        assert wetsuite.helpers.net.get('http://nonexistent.example.com/').headers['content-length'] == '3'
+
+        with pytest.raises(ValueError, match=r'.*404.*'):
+            download('http://nonexistent.example.com/404')
+
+        with pytest.raises(KeyError):
+            download('http://nonexistent.example.com/not_recorded')
+    finally:
+        wetsuite.helpers.net.cassette_off()
+
+
+def test_cassette_record():
+    ' test that record mode stores what we fetched '
+    import wetsuite.helpers.net
+    import wetsuite.helpers.localdata
+    store = wetsuite.helpers.localdata.MsgpackKV(':memory:')
+    wetsuite.helpers.net.cassette_record( store )
+    try:
+        data = download('https://www.example.com')
+    finally:
+        wetsuite.helpers.net.cassette_off()
+    assert store.get('https://www.example.com')['content'] == data
+
+
+def _take_tokens(path, count):
+    ' what each process in test_rate_limit_shared does '
+    import wetsuite.helpers.net
+    wetsuite.helpers.net.rate_limit( 'example.com', requests_per_sec=20, path=path )
+    for _ in range(count):
+        wetsuite.helpers.net._rate_limit_wait( 'https://www.example.com/' )  # pylint: disable=W0212
+
+
+def test_rate_limit_shared( tmp_path ):
+    ' test that the rate limit holds for the combination of several processes '
+    import time
+    import multiprocessing
+    import wetsuite.helpers.net
+    path = str( tmp_path / 'rate_limits.db' )
+
+    started = time.time()
+    procs = list( multiprocessing.Process( target=_take_tokens, args=(path, 10) )  for _ in range(3) )
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+    assert time.time() - started >= 29/20.   # 30 requests at 20/sec, the first free
+
+    # URLs for other hosts are not held back
+    wetsuite.helpers.net.rate_limit( 'example.com', requests_per_sec=0.001, path=path )
+    try:
+        started = time.time()
+        wetsuite.helpers.net._rate_limit_wait( 'https://example.org/' )  # pylint: disable=W0212
+        wetsuite.helpers.net._rate_limit_wait( 'https://notexample.com/' )  # pylint: disable=W0212
+        assert time.time() - started < 1
+    finally:
+        wetsuite.helpers.net.rate_limit_off()
+
+    for bad_rate in (0, -1):
+        with pytest.raises(ValueError):
+            wetsuite.helpers.net.rate_limit( 'example.com', requests_per_sec=bad_rate, path=path )
+    wetsuite.helpers.net.rate_limit_off()
+
+
+def test_request_spacing():
+    ' test that RequestSpacing spaces out the starts of requests from several threads '
+    import time
+    import concurrent.futures
+    import wetsuite.helpers.net
+    spacing = wetsuite.helpers.net.RequestSpacing( 0.05 )
+    def start():
+        spacing.wait()
+        return time.time()
+    with concurrent.futures.ThreadPoolExecutor( max_workers=4 ) as executor:
+        starts = sorted( executor.map( lambda _: start(), range(8) ) )
+    assert all( later - earlier >= 0.04  for earlier, later in zip(starts, starts[1:]) )
@@ -45,4 +45,185 @@ def test_parse():
 
 
 #def test_website_zoek():
-#    wetsuite.datacollect.rechtspraaknl.website_zoek('fork')
\ No newline at end of file
+#    wetsuite.datacollect.rechtspraaknl.website_zoek('fork')
+
+def test_import_opendata_zip( tmp_path ):
+    ' test importing from a (small imitation of) OpenDataUitspraken.zip, which contains zips '
+    import io
+    import zipfile
+    import wetsuite.helpers.localdata
+
+    def inner_zip( eclis ):
+        bio = io.BytesIO()
+        with zipfile.ZipFile( bio, 'w', compression=zipfile.ZIP_DEFLATED ) as z:
+            for ecli in eclis:
+                z.writestr( ecli.replace(':','_')+'.xml', '<open-rechtspraak>%s</open-rechtspraak>'%ecli )
+        return bio.getvalue()
+
+    zip_path = str( tmp_path / 'OpenDataUitspraken.zip' )
+    with zipfile.ZipFile( zip_path, 'w' ) as outer:
+        outer.writestr( '2021/202101.zip', inner_zip( ['ECLI:NL:RBAMS:2021:1', 'ECLI:NL:RBAMS:2021:2'] ), compress_type=zipfile.ZIP_STORED )
+        outer.writestr( '2021/202102.zip', inner_zip( ['ECLI:NL:HR:2021:AB1234', 'ECLI:NL:HR:2021:3'] ), compress_type=zipfile.ZIP_DEFLATED )
+        outer.writestr( 'README.txt', 'not a zip' )
+
+    store = wetsuite.helpers.localdata.LocalKV( ':memory:', str, bytes )
+    url = wetsuite.datacollect.rechtspraaknl.CONTENT_URL
+    store.put( url+'ECLI:NL:HR:2021:3', b'already there' )
+
+    inserted, skipped = wetsuite.datacollect.rechtspraaknl.import_opendata_zip( zip_path, store, batch_size=2, workers=2 )
+    assert (inserted, skipped) == (3, 1)
+    assert store.get( url+'ECLI:NL:HR:2021:AB1234' ) == b'<open-rechtspraak>ECLI:NL:HR:2021:AB1234</open-rechtspraak>'
+    assert store.get( url+'ECLI:NL:HR:2021:3' ) == b'already there'
+    assert len(store) == 4
+
+    assert wetsuite.datacollect.rechtspraaknl.import_opendata_zip( zip_path, store ) == (0, 4)
+
+    # a store in a file is checked by the workers themselves
+    store = wetsuite.helpers.localdata.LocalKV( str( tmp_path / 'store.db' ), str, bytes )
+    store.put( url+'ECLI:NL:HR:2021:3', b'already there' )
+    assert wetsuite.datacollect.rechtspraaknl.import_opendata_zip( zip_path, store, batch_size=2, workers=2 ) == (3, 1)
+    assert wetsuite.datacollect.rechtspraaknl.import_opendata_zip( zip_path, store ) == (0, 4)
+    store.close()
+
+
+def _fake_harvest_cassette(eclis, with_count=True):
+    ''' a cassette with search results (at most 2 per page) for every date range and offset that harvest_search might ask for,
+        for the ECLIs in eclis (a dict from day to list of ECLIs).  If not with_count, the feed does not say how many results there are.
+    '''
+    import urllib.parse
+    import wetsuite.helpers.localdata
+    rnl = wetsuite.datacollect.rechtspraaknl
+    days = sorted(eclis)
+    cassette = wetsuite.helpers.localdata.MsgpackKV(':memory:', check_same_thread=False)
+    for i, frm in enumerate(days):
+        for to in days[i:]:
+            found = sum( (eclis[day]  for day in days  if frm <= day <= to), [] )
+            for offset in range(0, len(found)+2, 2):
+                url = urllib.parse.urljoin(rnl.BASE_URL, "/uitspraken/zoeken?"+urllib.parse.urlencode(
+                    [('date', frm), ('date', to), ('max', '2'), ('from', str(offset))] ))
+                entries = ''.join( '<entry><id>%s</id><title>%s</title><updated>2021-02-01T00:00:00Z</updated></entry>'%(e,e)  for e in found[offset:offset+2] )
+                subtitle = '<subtitle>Aantal gevonden ECLI\'s: %d</subtitle>'%len(found)  if with_count  else  ''
+                xml = '<feed xmlns="http://www.w3.org/2005/Atom">%s%s</feed>'%(subtitle, entries)
+                cassette.put( url, {'status_code':200, 'url':url, 'headers':{}, 'content':xml.encode('utf8'), 'elapsed_sec':0.0} )
+    return cassette
+
+
+def test_harvest_search():
+    ' test that harvest_search splits and pages so that it gets everything exactly once, and can resume '
+    import datetime
+    import wetsuite.helpers.localdata
+    rnl = wetsuite.datacollect.rechtspraaknl
+
+    per_day = { '2021-01-01':1, '2021-01-02':3, '2021-01-03':0, '2021-01-04':5 }
+    eclis   = { day: list( 'ECLI:NL:RBAMS:2021:%s%d'%(day[-1], i)  for i in range(n) )  for day, n in per_day.items() }
+    cassette = _fake_harvest_cassette( eclis )
+
+    state_store = wetsuite.helpers.localdata.MsgpackKV(':memory:')
+    wetsuite.helpers.net.cassette_replay( cassette )
+    try:
+        harvest = rnl.harvest_search( '2021-01-01', '2021-01-04', max_per_request=2, workers=3, state_store=state_store )
+        got = [ next(harvest)['ecli'] ] # then pretend we got interrupted
+        harvest.close()
+        assert len( state_store.get('rechtspraaknl_harvest')['pending'] ) > 0
+
+        got += list( d['ecli']  for d in rnl.harvest_search( '2021-01-01', '2021-01-04', max_per_request=2, workers=3, state_store=state_store ) )
+        assert set(got) == set( sum(eclis.values(), []) )
+        assert len(got) - len(set(got)) <= 1  # the interrupted partition's first entry may come again
+        assert state_store.get('rechtspraaknl_harvest')['pending'] == []
+
+        assert sorted( d['ecli']  for d in rnl.harvest_search( datetime.date(2021,1,1), '2021-01-04', max_per_request=2 ) ) == sorted( sum(eclis.values(), []) )
+    finally:
+        wetsuite.helpers.net.cassette_off()
+
+
+def test_harvest_search_without_count():
+    ' test that when the feed does not say how many results there are, harvest_search pages until a short page, rather than stop at the first '
+    rnl = wetsuite.datacollect.rechtspraaknl
+    for per_day in ( {'2021-01-01':1, '2021-01-02':3, '2021-01-03':0, '2021-01-04':5},   # ends on a short page
+                     {'2021-01-01':2, '2021-01-02':4} ):                                   # ends on an empty one
+        eclis = { day: list( 'ECLI:NL:RBAMS:2021:%s%d'%(day[-1], i)  for i in range(n) )  for day, n in per_day.items() }
+        days  = sorted(eclis)
+        wetsuite.helpers.net.cassette_replay( _fake_harvest_cassette( eclis, with_count=False ) )
+        try:
+            got = list( d['ecli']  for d in rnl.harvest_search( days[0], days[-1], max_per_request=2, workers=2 ) )
+            assert sorted(got) == sorted( sum(eclis.values(), []) )
+        finally:
+            wetsuite.helpers.net.cassette_off()
+
+
+_content_example = b'''<?xml version="1.0" encoding="utf-8"?>
+<open-rechtspraak xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#" xmlns:dcterms="http://purl.org/dc/terms/" xmlns:psi="http://psi.rechtspraak.nl/" xmlns="http://www.rechtspraak.nl/schema/rechtspraak-1.0">
+  <rdf:RDF>
+    <rdf:Description><dcterms:identifier>ECLI:NL:RBAMS:2021:1</dcterms:identifier><dcterms:date>2021-01-01</dcterms:date><psi:zaaknummer>C/13/1234</psi:zaaknummer></rdf:Description>
+    <rdf:Description><dcterms:identifier>something else</dcterms:identifier></rdf:Description>
+  </rdf:RDF>
+  <inhoudsindicatie><para>Kort gezegd.</para></inhoudsindicatie>
+  <uitspraak><uitspraak.info/><section><title>1. De procedure</title><para>Eerste alinea.</para><parablock><para>Tweede alinea.</para></parablock></section></uitspraak>
+</open-rechtspraak>'''
+
+
+def test_parse_content_stream():
+    ' test that parse_content (on a tree) and parse_content_stream (on bytes) agree, and see through namespaces '
+    tree = wetsuite.helpers.etree.fromstring( _content_example )
+    parsed = wetsuite.datacollect.rechtspraaknl.parse_content( tree )
+    assert parsed['identifier'] == 'ECLI:NL:RBAMS:2021:1'
+    assert parsed['zaaknummer'] == 'C/13/1234'
+    assert parsed['inhoudsindicatie'] == 'Kort gezegd.'
+    assert 'Eerste alinea.' in parsed['bodytext']  and  'Tweede alinea.' in parsed['bodytext']
+
+    assert wetsuite.datacollect.rechtspraaknl.parse_content_stream( _content_example ) == parsed
+    # the stripped tree (what this used to do internally) gives the same
+    assert wetsuite.datacollect.rechtspraaknl.parse_content( wetsuite.helpers.etree.strip_namespace(tree) ) == parsed
+
+
+_content_example_both = b'''<?xml version="1.0" encoding="utf-8"?>
+<open-rechtspraak xmlns="http://www.rechtspraak.nl/schema/rechtspraak-1.0">
+  <inhoudsindicatie><para>Kort gezegd.</para></inhoudsindicatie>
+  <conclusie><para>Conclusie tekst.</para></conclusie>
+  <uitspraak><uitspraak.info/><!-- comment --><section><title>1. De procedure</title><para>Eerste <emphasis>alinea</emphasis>.</para>
+    <paragroup><nr>2.</nr><orderedlist><listitem><para>Punt een.</para></listitem><listitem><para>Punt twee.</para></listitem></orderedlist></paragroup>
+    <section><informaltable><tgroup><tbody><row><entry>cel</entry></row></tbody></tgroup></informaltable></section></section></uitspraak>
+  <uitspraak><para>A second one, which is ignored.</para></uitspraak>
+</open-rechtspraak>'''
+
+
+def test_parse_content_stream_sections():
+    ' test that the uitspraak is preferred over the conclusie (wherever they are), and that nested structure streams the same as the tree '
+    rnl = wetsuite.datacollect.rechtspraaknl
+    parsed = rnl.parse_content( wetsuite.helpers.etree.fromstring( _content_example_both ) )
+    assert parsed['inhoudsindicatie'] == 'Kort gezegd.'
+    assert 'Punt twee.' in parsed['bodytext']  and  'Conclusie' not in parsed['bodytext']  and  'second' not in parsed['bodytext']
+    assert rnl.parse_content_stream( _content_example_both ) == parsed
+
+    only_conclusie = b'<open-rechtspraak><conclusie><section><para>Conclusie tekst.</para></section></conclusie></open-rechtspraak>'
+    assert rnl.parse_content_stream( only_conclusie ) == rnl.parse_content( wetsuite.helpers.etree.fromstring( only_conclusie ) )
+    assert rnl.parse_content_stream( only_conclusie )['bodytext'].strip() == 'Conclusie tekst.'
+
+    with pytest.raises(ValueError):
+        rnl.parse_content_stream( b'<open-rechtspraak><uitspraak><unknowntag/></uitspraak></open-rechtspraak>' )
+
+
+def test_search_iter():
+    ' test that the streaming search parse gives the same as parse_search_results '
+    import urllib.parse
+    import wetsuite.helpers.localdata
+    rnl = wetsuite.datacollect.rechtspraaknl
+
+    entries = ''.join( '<entry><id>ECLI:NL:HR:2021:%d</id><title>t%d</title><summary>-</summary><updated>2021-02-01T00:00:00Z</updated>'
+                       '<link rel="alternate" type="text/html" href="https://uitspraken.rechtspraak.nl/InzienDocument?id=ECLI:NL:HR:2021:%d"/></entry>'%(i,i,i)
+                       for i in range(50) )
+    xml = ('<feed xmlns="http://www.w3.org/2005/Atom"><title>x</title><subtitle>Aantal gevonden ECLI\'s: 1234</subtitle>%s</feed>'%entries).encode('utf8')
+
+    params = [('max','50')]
+    url = urllib.parse.urljoin(rnl.BASE_URL, "/uitspraken/zoeken?"+urllib.parse.urlencode(params))
+    cassette = wetsuite.helpers.localdata.MsgpackKV(':memory:', check_same_thread=False)
+    cassette.put( url, {'status_code':200, 'url':url, 'headers':{}, 'content':xml, 'elapsed_sec':0.0} )
+    wetsuite.helpers.net.cassette_replay( cassette )
+    try:
+        tree = rnl.search( params )
+        assert rnl.search_result_count( tree ) == 1234
+        assert list( rnl.search_iter( params, chunk_size=100 ) ) == rnl.parse_search_results( tree )
+        assert rnl.parse_search_results( tree )[3] == {'ecli':'ECLI:NL:HR:2021:3', 'xml':rnl.CONTENT_URL+'ECLI:NL:HR:2021:3', 'title':'t3',
+                                                        'updated':'2021-02-01T00:00:00Z', 'link':'https://uitspraken.rechtspraak.nl/InzienDocument?id=ECLI:NL:HR:2021:3'}
+    finally:
+        wetsuite.helpers.net.cassette_off()
@@ -0,0 +1,60 @@
+' tests of the seekable compressed format '
+import os
+import random
+
+import pytest
+
+import wetsuite.helpers.seekable
+import wetsuite.helpers.localdata
+
+
+def test_reader_roundtrip( tmp_path ):
+    ' test that reading at any offset gives the same as the original, for each codec, and with threaded compression '
+    rnd = random.Random(0)
+    data = b''.join( rnd.choice([b'foo ', b'bar ', b'quu ', bytes([rnd.randrange(256)])])  for _ in range(100000) )
+    in_path = str( tmp_path/'in' )
+    with open(in_path, 'wb') as f:
+        f.write( data )
+
+    for codec, workers in ( ('xz',1), ('zlib',1), ('zlib',3) ):
+        out_path = str( tmp_path/('out_%s_%d'%(codec, workers)) )
+        wetsuite.helpers.seekable.compress_file( in_path, out_path, block_size=1000, codec=codec, workers=workers )
+        assert wetsuite.helpers.seekable.is_seekable_file( out_path )
+        assert os.path.getsize( out_path ) < len(data)
+
+        with wetsuite.helpers.seekable.SeekableReader( out_path, cache_blocks=4 ) as reader:
+            assert reader.size == len(data)
+            for offset, amount in ( (0,10), (995,10), (1000,1000), (999,2002), (len(data)-5,100), (len(data)+5,10) ):
+                assert reader.pread( offset, amount ) == data[offset:offset+amount]
+            reader.seek( 12345 )
+            assert reader.read( 10 ) == data[12345:12355]
+            assert reader.tell() == 12355
+            reader.seek( -10, os.SEEK_END )
+            assert reader.read() == data[-10:]
+
+    assert not wetsuite.helpers.seekable.is_seekable_file( in_path )
+    with pytest.raises(ValueError):
+        wetsuite.helpers.seekable.compress_file( in_path, str(tmp_path/'x'), codec='nope' )
+
+
+def test_open_store( tmp_path ):
+    ' test that a compressed store can be used as the store it was '
+    pytest.importorskip('apsw')
+    path = str( tmp_path/'store.db' )
+    store = wetsuite.helpers.localdata.MsgpackKV( path )
+    for i in range(5000):
+        store.put( 'key%d'%i, {'i':i, 'text':'text %d'%i*10}, commit=False )
+    store.commit()
+    store._put_meta( 'description', 'descr' )
+    store.close()
+
+    wetsuite.helpers.seekable.compress_file( path, path+'.seekable', block_size=8192 )
+    with wetsuite.helpers.seekable.open_store( path+'.seekable' ) as cstore:
+        assert isinstance( cstore, wetsuite.helpers.seekable.SeekableMsgpackKV )
+        assert len(cstore) == 5000
+        assert cstore.get('key1234') == {'i':1234, 'text':'text 1234'*10}
+        assert 'key4999' in cstore  and  'key5000' not in cstore
+        assert cstore._get_meta('description') == 'descr'
+        assert sum( 1  for _ in cstore.iteritems() ) == 5000
+        with pytest.raises(RuntimeError):
+            cstore.put('a', 'b')
@@ -1,5 +1,30 @@
 import pytest
 from wetsuite.datacollect import sru
+import wetsuite.helpers.net
+import wetsuite.helpers.escape
+import wetsuite.helpers.localdata
+
+
+def _fake_sru_cassette(sru_obj, query, num_records, page_sizes=(1,2,3,5,10), fail_above=None, cap=None):
+    ''' Makes a store usable with net.cassette_replay, with searchRetrieve responses for a fake repository 
+        that has num_records matching records, for the given query, for various page sizes and offsets.
+        If fail_above is given, page sizes above that give a HTTP 500.
+        If cap is given, pages never have more than that many records, whatever was asked for.
+    '''
+    store = wetsuite.helpers.localdata.MsgpackKV(':memory:', check_same_thread=False)
+    for maximum_records in page_sizes:
+        for start_record in range(1, num_records+2):
+            url = sru_obj._url() + '&operation=searchRetrieve&startRecord=%d&maximumRecords=%d&query=%s'%(
+                start_record, maximum_records, wetsuite.helpers.escape.uri_component(query) )
+            recs = ''.join( '<record><recordData><nr>%d</nr></recordData><recordPosition>%d</recordPosition></record>'%(i, i)
+                            for i in range(start_record, min(num_records+1, start_record+min(maximum_records, cap or maximum_records))) )
+            xml = ('<searchRetrieveResponse xmlns="http://www.loc.gov/zing/srw/"><version>1.2</version>'
+                   '<numberOfRecords>%d</numberOfRecords><records>%s</records></searchRetrieveResponse>'%(num_records, recs) )
+            if fail_above is not None  and  maximum_records > fail_above:
+                store.put( url, {'status_code':500, 'url':url, 'headers':{}, 'content':b'', 'elapsed_sec':0.0} )
+            else:
+                store.put( url, {'status_code':200, 'url':url, 'headers':{}, 'content':xml.encode('utf8'), 'elapsed_sec':0.0} )
+    return store
 
 def test_bunch():
     bwb  = sru.SRUBase(
@@ -60,3 +85,147 @@ def _TEMP_DISABLE_test_callback():
         start_record=5, 
         callback=print_rec)
 
+
+
+def test_iter_search_retrieve():
+    ' test that the generator variant gives the same records as the list variant, and knows the count before yielding '
+    bwb = sru.SRUBase( base_url='http://nonexistent.example.com/sru/Search', x_connection='BWB' )
+    wetsuite.helpers.net.cassette_replay( _fake_sru_cassette(bwb, 'foo', 23) )
+    try:
+        gen = bwb.iter_search_retrieve('foo', at_a_time=5, up_to=100, wait_between_sec=0)
+        assert bwb.num_records() == 23
+        nrs = list( int(record.findtext('recordData/nr'))  for record in gen )
+        assert nrs == list(range(1, 24))
+
+        nrs_many = list( int(record.findtext('recordData/nr'))
+                         for record in bwb.search_retrieve_many('foo', at_a_time=5, up_to=100, wait_between_sec=0) )
+        assert nrs_many == nrs
+
+        # up_to is inclusive, and an absolute offset
+        nrs = list( int(record.findtext('recordData/nr'))  for record in bwb.iter_search_retrieve('foo', at_a_time=5, start_record=3, up_to=9, wait_between_sec=0) )
+        assert nrs == list(range(3, 10))
+    finally:
+        wetsuite.helpers.net.cassette_off()
+
+
+def test_iter_search_retrieve_parallel():
+    ' test that concurrent page fetching gives the same records, in the same order '
+    bwb = sru.SRUBase( base_url='http://nonexistent.example.com/sru/Search', x_connection='BWB' )
+    wetsuite.helpers.net.cassette_replay( _fake_sru_cassette(bwb, 'foo', 47), simulate_latency=False )
+    try:
+        for start_record, up_to in ( (1,100), (1,47), (3,20), (1,1), (40, 100) ):
+            sequential = list( int(record.findtext('recordData/nr'))
+                               for record in bwb.iter_search_retrieve('foo', at_a_time=5, start_record=start_record, up_to=up_to, wait_between_sec=0) )
+            parallel   = list( int(record.findtext('recordData/nr'))
+                               for record in bwb.iter_search_retrieve('foo', at_a_time=5, start_record=start_record, up_to=up_to, wait_between_sec=0, workers=4) )
+            assert parallel == sequential
+
+        # stopping early should not leave things hanging
+        gen = bwb.iter_search_retrieve('foo', at_a_time=3, up_to=100, wait_between_sec=0, workers=3)
+        next(gen)
+        gen.close()
+    finally:
+        wetsuite.helpers.net.cassette_off()
+
+
+def test_retrying_only_server_errors( monkeypatch ):
+    ' test that server errors are retried, and other problems are not '
+    repo = sru.SRUBase( base_url='http://nonexistent.example.com/sru/Search', x_connection='retrytest' )
+    sleeps = []
+    monkeypatch.setattr( sru.time, 'sleep', sleeps.append )
+
+    cassette = wetsuite.helpers.localdata.MsgpackKV(':memory:')
+    def url_for(query):
+        return repo._url() + '&operation=searchRetrieve&startRecord=1&maximumRecords=5&query=%s'%wetsuite.helpers.escape.uri_component(query)
+    cassette.put( url_for('busy'), {'status_code':503, 'url':'', 'headers':{}, 'content':b'', 'elapsed_sec':0.0} )
+    bad = b'<searchRetrieveResponse><numberOfRecords>many</numberOfRecords></searchRetrieveResponse>'
+    cassette.put( url_for('bad'),  {'status_code':200, 'url':'', 'headers':{}, 'content':bad, 'elapsed_sec':0.0} )
+
+    wetsuite.helpers.net.cassette_replay( cassette )
+    try:
+        with pytest.raises( sru.SRUServerError ):
+            repo.search_retrieve_retrying( 'busy', start_record=1, maximum_records=5, retries=2 )
+        assert len(sleeps) == 2
+
+        with pytest.raises( ValueError ):
+            repo.search_retrieve_retrying( 'bad', start_record=1, maximum_records=5, retries=2 )
+        assert len(sleeps) == 2  # not retried
+    finally:
+        wetsuite.helpers.net.cassette_off()
+
+
+def test_adaptive_page_size():
+    ' test that the controller grows on success, backs off on failure and slowness '
+    aps = sru.AdaptivePageSize( initial=10, maximum=100, target_latency_sec=1.0 )
+    aps.success(0.1)
+    assert aps.size() == 15
+    for _ in range(20):
+        aps.success(0.1)
+    assert aps.size() == 100
+    aps.failure()
+    assert aps.size() == 50
+    for _ in range(5):
+        aps.success(0.1)
+    assert aps.size() < 100     # does not immediately grow back into what failed
+    size_before = aps.size()
+    aps.success(5.0)
+    assert aps.size() < size_before
+    repr(aps)
+
+
+def test_iter_search_retrieve_adaptive():
+    ' test that adaptive page sizes still give all records in order, and learn to stay under what fails '
+    repo = sru.SRUBase( base_url='http://nonexistent.example.com/sru/Search', x_connection='adaptivetest' )
+    wetsuite.helpers.net.cassette_replay( _fake_sru_cassette(repo, 'foo', 120, page_sizes=range(1, 60), fail_above=25) )
+    try:
+        nrs = list( int(record.findtext('recordData/nr'))
+                    for record in repo.iter_search_retrieve('foo', at_a_time=5, up_to=1000, wait_between_sec=0, adaptive=True) )
+        assert nrs == list(range(1, 121))
+        assert repo.page_size_controller().size() <= 25
+        assert repo.page_size_controller().size() > 5
+
+        with pytest.raises(ValueError):
+            repo.iter_search_retrieve('foo', adaptive=True, workers=2)
+    finally:
+        wetsuite.helpers.net.cassette_off()
+
+
+def test_page_size_store():
+    ' test that a learned page size can be kept in a store, and is picked up from there by a later run '
+    repo = sru.SRUBase( base_url='http://nonexistent.example.com/sru/Search', x_connection='pagesizestoretest' )
+    page_size_store = wetsuite.helpers.localdata.MsgpackKV(':memory:')
+    wetsuite.helpers.net.cassette_replay( _fake_sru_cassette(repo, 'foo', 120, page_sizes=range(1, 60), fail_above=25) )
+    try:
+        nrs = list( int(record.findtext('recordData/nr'))
+                    for record in repo.iter_search_retrieve('foo', at_a_time=5, up_to=1000, wait_between_sec=0, adaptive=True,
+                                                            page_size_store=page_size_store) )
+        assert nrs == list(range(1, 121))
+        learned = repo.page_size_controller()
+        assert len(page_size_store) == 1
+        assert list(page_size_store.values())[0] == learned.to_dict()
+
+        # pretend we are a new interpreter, which has not seen this repository yet
+        sru._page_size_controllers.clear()
+        assert repo.page_size_controller( store=page_size_store ).size() == learned.size()
+        sru._page_size_controllers.clear()
+        assert repo.page_size_controller( initial=5 ).size() == 5   # without the store, we start over
+    finally:
+        wetsuite.helpers.net.cassette_off()
+
+
+def test_iter_search_retrieve_capped():
+    ' test that when a server returns fewer records than we ask for, we continue from what we got, rather than skip records '
+    repo = sru.SRUBase( base_url='http://nonexistent.example.com/sru/Search', x_connection='cappedtest' )
+    wetsuite.helpers.net.cassette_replay( _fake_sru_cassette(repo, 'foo', 60, page_sizes=range(1, 51), cap=4), simulate_latency=False )
+    try:
+        for workers in (1, 3):
+            nrs = list( int(record.findtext('recordData/nr'))
+                        for record in repo.iter_search_retrieve('foo', at_a_time=10, up_to=1000, wait_between_sec=0, workers=workers) )
+            assert nrs == list(range(1, 61))
+
+        sru._page_size_controllers[ (repo._url(), repo.extra_query) ] = sru.AdaptivePageSize( initial=5, maximum=50 )
+        nrs = list( int(record.findtext('recordData/nr'))
+                    for record in repo.iter_search_retrieve('foo', up_to=1000, wait_between_sec=0, adaptive=True) )
+        assert nrs == list(range(1, 61))
+    finally:
+        wetsuite.helpers.net.cassette_off()
@@ -20,3 +20,50 @@ def test_fetch_all():
 
 #     wetsuite.datacollect.tweedekamer_nl.fetch_resource('2d1a7837-c0c4-4971-9e32-feacaa50961b')
         
+
+
+def _feed_page( entries, next_url=None ):
+    ' make a SyncFeed page, entries being (id, updated, naam) '
+    xml = '<feed xmlns="http://www.w3.org/2005/Atom">'
+    if next_url is not None:
+        xml += '<link rel="next" href="%s"/>'%next_url.replace('&', '&amp;')
+    for eid, updated, naam in entries:
+        xml += ( '<entry><title>%s</title><id>%s</id><updated>%s</updated><category term="Zaal"/>'
+                 '<content type="application/xml"><zaal xmlns="http://www.tweedekamer.nl/xsd/tkData/v1-0" id="%s"><naam>%s</naam></zaal></content></entry>'
+               )%(eid, eid, updated, eid, naam)
+    return (xml+'</feed>').encode('utf8')
+
+
+def test_sync_feed():
+    ' test that sync_feed stores entries, and that a later sync continues from where it was and keeps the newest version '
+    import wetsuite.helpers.net
+    import wetsuite.helpers.localdata
+    tk = wetsuite.datacollect.tweedekamer_nl
+
+    first  = tk.SYNCFEED_BASE+'Feed?category=Zaal'
+    second = tk.SYNCFEED_BASE+'Feed?category=Zaal&skiptoken=2'
+    third  = tk.SYNCFEED_BASE+'Feed?category=Zaal&skiptoken=4'
+    cassette = wetsuite.helpers.localdata.MsgpackKV(':memory:', check_same_thread=False)
+    def put( url, content ):
+        cassette.put( url, {'status_code':200, 'url':url, 'headers':{}, 'content':content, 'elapsed_sec':0.0} )
+    put( first,  _feed_page( [('a', '2020-01-01T00:00:00', 'Zaal A'), ('b', '2020-01-01T00:00:00', 'Zaal B')], second ) )
+    put( second, _feed_page( [('c', '2020-01-02T00:00:00', 'Zaal C')] ) )
+
+    store       = wetsuite.helpers.localdata.MsgpackKV(':memory:')
+    state_store = wetsuite.helpers.localdata.MsgpackKV(':memory:')
+    wetsuite.helpers.net.cassette_replay( cassette )
+    try:
+        assert list( e['id']  for e in tk.sync_feed( 'Zaal', store, state_store ) ) == ['a', 'b', 'c']
+        assert store.get('a')['content']['naam'] == 'Zaal A'
+        assert state_store.get('Zaal') == second # the last page, to be looked at again
+
+        # since then, the last page got a next link, with a change to 'a', and an older-dated version of 'b' (which should not win)
+        put( second, _feed_page( [('c', '2020-01-02T00:00:00', 'Zaal C')], third ) )
+        put( third,  _feed_page( [('a', '2020-02-01T00:00:00+00:00', 'Zaal A2'), ('b', '2019-01-01T00:00:00+00:00', 'Zaal B0')] ) )
+        assert list( e['id']  for e in tk.sync_feed( 'Zaal', store, state_store ) ) == ['c', 'a', 'b']
+        assert store.get('a')['content']['naam'] == 'Zaal A2'
+        assert store.get('b')['content']['naam'] == 'Zaal B'
+        assert len(store) == 3
+        assert state_store.get('Zaal') == third
+    finally:
+        wetsuite.helpers.net.cassette_off()
@@ -29,3 +29,24 @@ def test_hash_color():
 
 def test_diff():
     wetsuite.helpers.util.unified_diff('com','communication')
+
+
+def test_json_stream_items():
+    ' test that streaming JSON items gives the same as loading the whole thing, also when values straddle chunks '
+    import io
+    import json
+    doc = {'description':'x'*500, 'data':{str(i):[i, 1.5e-3*i, {'a':'é'*i}]  for i in range(50)}, 'tail':[123, True, None]}
+    data = json.dumps( doc, ensure_ascii=False ).encode('utf8')
+    for chunk_size in (1, 7, 1000000):
+        assert list( wetsuite.helpers.util.json_stream_items( io.BytesIO(data), ['data'], chunk_size=chunk_size ) ) == list( doc['data'].items() )
+        assert list( wetsuite.helpers.util.json_stream_items( io.StringIO(data.decode('utf8')), ['tail'], chunk_size=chunk_size ) ) == [123, True, None]
+        siblings = {}
+        for _ in wetsuite.helpers.util.json_stream_items( io.BytesIO(data), ['data'], chunk_size=chunk_size, siblings=siblings ):
+            pass
+        assert siblings == {'description':doc['description'], 'tail':doc['tail']}
+    siblings = {}
+    assert list( wetsuite.helpers.util.json_stream_items( io.BytesIO(b'{"data": {}, "description": "d"}'), ['data'], siblings=siblings ) ) == []
+    assert siblings == {'description':'d'}
+    assert list( wetsuite.helpers.util.json_stream_items( io.BytesIO(b'[4.5e3, 12]') ) ) == [4500.0, 12]
+    with pytest.raises( KeyError ):
+        list( wetsuite.helpers.util.json_stream_items( io.BytesIO(data), ['nothere'] ) )